@@ -0,0 +1,163 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from raiv_libraries.cnn import Cnn
+
+# Uncertainty-driven active sampling for the data collection : instead of a random pixel of the pick box, the robot
+# picks where the current model is the most uncertain, so each pick gives a more useful label.
+# The candidate crops of the pick box grid are scored in batches by GraspHeatmap.score_points(), then :
+# * 'entropy' : binary entropy of the success probability (maximal for p = 0.5)
+# * 'mc_dropout' : variance of the success probability over nb_mc_samples dropout masks applied to the classifier.
+#   The backbone runs once, the features are repeated nb_mc_samples times and the classifier scores all of them in
+#   one batched pass (the classifier is tiny compared to the backbone).
+# Used by the 'active' mode of InBoxCoord (get_coord_node.py). The main program simulates the acquisition on a labelled
+# image bank to compare the F1 gain per pick of the strategies with random sampling.
+
+UNCERTAINTY_METHODS = ['entropy', 'mc_dropout']
+STRATEGIES = ['random'] + UNCERTAINTY_METHODS
+
+
+def binary_entropy(success_probs):
+    """ Entropy (in nats) of the success probabilities (numpy array) """
+    p = np.clip(success_probs, 1e-7, 1 - 1e-7)
+    return -(p * np.log(p) + (1 - p) * np.log(1 - p))
+
+
+@torch.no_grad()
+def mc_dropout_success_probs(classifier, features, nb_samples=20, dropout=0.2):
+    """
+    Return the [nb_samples, N] success probabilities given by 'classifier' (Cnn.fc) for the features [N, nb_features]
+    with a different dropout mask on the inputs of each linear layer, for all the samples in one batched pass
+    """
+    features = features.to(next(classifier.parameters()).device)
+    t = features.unsqueeze(0).expand(nb_samples, *features.shape).reshape(-1, features.shape[-1])
+    for layer in classifier:
+        if isinstance(layer, torch.nn.Linear):
+            t = F.dropout(t, dropout, training=True)
+        t = layer(t)
+    return torch.softmax(t, dim=1)[:, 1].view(nb_samples, -1).cpu()
+
+
+def uncertainties(model, features, success_probs, method='entropy', nb_mc_samples=20, dropout=0.2):
+    """
+    Return the uncertainty of each candidate (numpy array) from the outputs of 'model' (a RgbCnn or RgbAndDepthCnn) :
+    features (tensor [N, nb_features]) and success_probs (numpy array [N])
+    """
+    if method == 'entropy':
+        return binary_entropy(success_probs)
+    if method == 'mc_dropout':
+        if not hasattr(model, 'fc'):
+            raise ValueError("'mc_dropout' needs a Pytorch model with a 'fc' classifier")
+        return mc_dropout_success_probs(model.fc, features, nb_mc_samples, dropout).var(dim=0).numpy()
+    raise ValueError(f'Unknown uncertainty method : {method}, choose one of {UNCERTAINTY_METHODS}')
+
+
+class ActiveSampler:
+    """ Choose the candidate pixels of the pick box with the highest predictive uncertainty """
+
+    def __init__(self, grasp_heatmap, method='entropy', nb_mc_samples=20, dropout=0.2):
+        """ grasp_heatmap : GraspHeatmap (grid mode) used to build and score the candidate crops """
+        if method not in UNCERTAINTY_METHODS:
+            raise ValueError(f'Unknown uncertainty method : {method}, choose one of {UNCERTAINTY_METHODS}')
+        self.grasp_heatmap = grasp_heatmap
+        self.method = method
+        self.nb_mc_samples = nb_mc_samples
+        self.dropout = dropout
+
+    def score(self, rgb, depth, points):
+        """ Return (uncertainties, success probabilities) of the crops centered on 'points' """
+        probs, features = self.grasp_heatmap.score_points(rgb, depth, points, with_features=True)
+        return uncertainties(self.grasp_heatmap.model, features, probs, self.method, self.nb_mc_samples, self.dropout), probs
+
+    def most_uncertain_points(self, rgb, depth, mask, n):
+        """ Return the n (x, y) pixels of the mask with the highest uncertainties (most uncertain first), their uncertainties and success probabilities """
+        points = self.grasp_heatmap.grid_points(mask)
+        scores, probs = self.score(rgb, depth, points)
+        best = np.argsort(-scores)[:n]
+        return points[best], scores[best], probs[best]
+
+
+@torch.no_grad()
+def loader_uncertainties(model, data_loader, method='entropy', nb_mc_samples=20, dropout=0.2):
+    """ Return the uncertainties of all the images of 'data_loader' (same order) """
+    values = []
+    for batch in data_loader:
+        inputs, _ = Cnn.split_batch(batch)
+        features, log_probs = model(*inputs)
+        values.append(uncertainties(model, features, torch.exp(log_probs[:, 1]).numpy(), method, nb_mc_samples, dropout))
+    return np.concatenate(values) if values else np.zeros(0)
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import json
+    from torch.utils.data import Subset
+    from raiv_libraries.cnn_benchmark import evaluate
+    from raiv_libraries.image_data_module import ImageDataModule, RgbSubset, RgbAndDepthSubset
+
+    parser = argparse.ArgumentParser(description='Simulate the data collection on a labelled image bank : the pool images are acquired by rounds '
+                                                 '(random or most uncertain ones), the model is fine-tuned after each round and its F1 gain per pick is reported.')
+    parser.add_argument('ckpt_file', type=str, help='checkpoint file (.ckpt) of the current model')
+    parser.add_argument('images_folder', type=str, help='images folder with fail and success sub-folders (or <rgb and depth> / <fail and success> with --rgb_and_depth)')
+    parser.add_argument('ckpt_folder', type=str, help='folder path where to stock the model.CKPT files of the fine-tunings')
+    parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='the model is a RgbAndDepthCnn (default : RgbCnn)')
+    parser.add_argument('--strategies', default=STRATEGIES, choices=STRATEGIES, nargs='+', help='acquisition strategies to compare')
+    parser.add_argument('-n', '--nb_rounds', default=5, type=int, help='number of acquisition rounds')
+    parser.add_argument('-p', '--picks_per_round', default=50, type=int, help='number of images acquired at each round')
+    parser.add_argument('-e', '--epochs', default=2, type=int, help='number of fine-tuning epochs after each round')
+    parser.add_argument('--nb_mc_samples', default=20, type=int, help='number of dropout masks of the mc_dropout strategy')
+    parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the random strategy')
+    parser.add_argument('-r', '--report', default=None, type=str, help='Optionnal JSON file where the results are written')
+    args = parser.parse_args()
+
+    if args.rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn as CnnClass
+    else:
+        from raiv_libraries.rgb_cnn import RgbCnn as CnnClass
+    model = CnnClass.load_ckpt_model_file(args.ckpt_file)
+    depth_channels = model.hparams.get('depth_channels', 3)
+    # Fold 0 : test split, fold 1 : validation split, the other folds are the pool of the images which can be acquired
+    data_module = ImageDataModule.from_images_folder(args.images_folder, rgb_and_depth=args.rgb_and_depth, depth_channels=depth_channels,
+                                                     image_size=model.hparams.input_shape[-1], dataset_size=args.dataset_size,
+                                                     batch_size=model.hparams.config['batch_size'], nb_folds=5, fold=0)
+    pool_data = data_module.train_data
+    dataset, pool = pool_data.subset.dataset, np.array(pool_data.subset.indices)
+    subset_class = RgbAndDepthSubset if args.rgb_and_depth else RgbSubset
+    subset_kwargs = {'depth_transform': pool_data.depth_transform} if args.rgb_and_depth else {}
+
+    def images(indices):
+        return subset_class(Subset(dataset, indices=indices.tolist()), transform=pool_data.transform, **subset_kwargs)
+
+    results = {}
+    for strategy in args.strategies:
+        model = CnnClass.load_ckpt_model_file(args.ckpt_file)
+        model.eval()
+        rng = np.random.default_rng(args.seed)
+        remaining, acquired = pool, np.zeros(0, dtype=pool.dtype)
+        f1_scores = [evaluate(model, data_module.test_dataloader())['f1_score']]
+        for _ in range(args.nb_rounds):
+            nb_picks = min(args.picks_per_round, len(remaining))
+            if strategy == 'random':
+                chosen = rng.choice(len(remaining), nb_picks, replace=False)
+            else:
+                scores = loader_uncertainties(model, data_module._generate_dataloader(images(remaining)), strategy, args.nb_mc_samples)
+                chosen = np.argsort(-scores)[:nb_picks]
+            acquired = np.concatenate([acquired, remaining[chosen]])
+            remaining = np.delete(remaining, chosen)
+            data_module.train_data = images(acquired)
+            model.unfreeze()
+            trainer = model.build_trainer(data_module=data_module, model_name=model.hparams.backbone, ckpt_dir=args.ckpt_folder,
+                                          num_epochs=args.epochs, suffix=f'active_{strategy}', dataset_size=args.dataset_size)
+            trainer.fit(model=model, datamodule=data_module)
+            model.eval()
+            f1_scores.append(evaluate(model, data_module.test_dataloader())['f1_score'])
+        results[strategy] = {'f1_scores': f1_scores, 'nb_picks': len(acquired),
+                             'f1_gain_per_pick': (f1_scores[-1] - f1_scores[0]) / max(len(acquired), 1)}
+    print(f"{'strategy':<12}{'picks':>7}{'F1 start':>10}{'F1 end':>9}{'gain/pick':>12}")
+    for strategy, result in results.items():
+        print(f"{strategy:<12}{result['nb_picks']:>7}{result['f1_scores'][0]:>10.4f}{result['f1_scores'][-1]:>9.4f}{result['f1_gain_per_pick']:>12.2e}")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
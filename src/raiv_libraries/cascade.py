@@ -0,0 +1,192 @@
+import numpy as np
+import torch
+from PIL import Image
+from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn
+
+# Two-stage cascade to score many candidate crops quickly :
+# 1. A very cheap classifier (logistic regression on a few statistics of the 8 bits depth crop) scores all the candidates.
+#    The clearly bad ones (box floor, walls) and the clearly good ones exit here.
+# 2. Only the candidates of the uncertain band [low threshold, high threshold] are scored by the full RgbAndDepthCnn.
+# The thresholds are calibrated on the validation split : the fraction of success (resp. fail) crops which exit
+# as fail (resp. success) at the first stage is at most 1 - target_recall.
+
+STATS_SIZE = 32  # The depth crops are reduced to STATS_SIZE x STATS_SIZE pixels to compute their statistics
+FEATURE_NAMES = ['mean', 'std', 'min', 'max', 'table_ratio', 'center_mean', 'gradient_x', 'gradient_y']
+
+
+def depth_statistics(pil_depth_imgs):
+    """ Return the [len(pil_depth_imgs), len(FEATURE_NAMES)] features of the depth images (8 bits, white = table) """
+    depths = np.stack([np.asarray(img.convert('L').resize((STATS_SIZE, STATS_SIZE), Image.BILINEAR), dtype=np.float32)
+                       for img in pil_depth_imgs]) / 255
+    flat = depths.reshape(len(depths), -1)
+    quarter = STATS_SIZE // 4
+    center = depths[:, quarter:-quarter, quarter:-quarter].reshape(len(depths), -1)
+    features = np.stack([flat.mean(axis=1), flat.std(axis=1), flat.min(axis=1), flat.max(axis=1),
+                         (flat > 0.99).mean(axis=1), center.mean(axis=1),
+                         np.abs(np.diff(depths, axis=2)).mean(axis=(1, 2)), np.abs(np.diff(depths, axis=1)).mean(axis=(1, 2))], axis=1)
+    return torch.from_numpy(features)
+
+
+class DepthStatsClassifier(torch.nn.Module):
+    """ Logistic regression on the depth statistics, return the success probability """
+
+    def __init__(self, nb_features=len(FEATURE_NAMES)):
+        super().__init__()
+        self.linear = torch.nn.Linear(nb_features, 1)
+        self.register_buffer('mean', torch.zeros(nb_features))
+        self.register_buffer('std', torch.ones(nb_features))
+
+    def forward(self, features):
+        return torch.sigmoid(self.linear((features - self.mean) / self.std)).squeeze(1)
+
+    def fit(self, features, labels, nb_iterations=100):
+        """ Fit the logistic regression on 'features' (tensor [N, nb_features]) and 'labels' (0 : fail, 1 : success) """
+        self.mean.copy_(features.mean(dim=0))
+        self.std.copy_(features.std(dim=0).clamp(min=1e-6))
+        labels = labels.float()
+        pos_weight = (labels == 0).sum() / (labels == 1).sum().clamp(min=1)  # Balanced classes
+        optimizer = torch.optim.LBFGS(self.linear.parameters(), max_iter=nb_iterations)
+        normalized = (features - self.mean) / self.std
+
+        def closure():
+            optimizer.zero_grad()
+            loss = torch.nn.functional.binary_cross_entropy_with_logits(self.linear(normalized).squeeze(1), labels, pos_weight=pos_weight)
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        return self
+
+
+class CascadePredictor:
+    """ Cheap depth classifier, then RgbAndDepthCnn for the uncertain candidates """
+
+    def __init__(self, model, stage1=None, low_threshold=0.0, high_threshold=1.0, batch_size=64):
+        """
+        model : the full model (RgbAndDepthCnn or any predictor usable by its predict methods)
+        stage1 : fitted DepthStatsClassifier, candidates with a stage1 probability < low_threshold exit as fail,
+                 > high_threshold exit as success
+        """
+        self.model = model
+        self.stage1 = stage1 or DepthStatsClassifier()
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.batch_size = batch_size
+
+    @torch.no_grad()
+    def stage1_probs(self, pil_depth_imgs):
+        return self.stage1(depth_statistics(pil_depth_imgs))
+
+    @torch.no_grad()
+    def full_probs(self, pil_rgb_imgs, pil_depth_imgs):
+        """ Success probabilities given by the full model, in batches """
+        probs = [RgbAndDepthCnn.predict_from_pil_rgb_and_depth_images_batch(self.model, pil_rgb_imgs[start:start + self.batch_size],
+                                                                            pil_depth_imgs[start:start + self.batch_size])[:, 1]
+                 for start in range(0, len(pil_rgb_imgs), self.batch_size)]
+        return torch.cat(probs) if probs else torch.zeros(0)
+
+    @torch.no_grad()
+    def predict(self, pil_rgb_imgs, pil_depth_imgs):
+        """
+        Return (success probabilities, predictions, escalated) : escalated is the boolean tensor of the candidates scored by the full model.
+        The probabilities of the other candidates are the ones of the first stage, they are not comparable to 0.5 :
+        predictions (0 : fail, 1 : success) are the decisions of the cascade, the class of the exit for these candidates
+        and probability > 0.5 for the escalated ones.
+        """
+        probs = self.stage1_probs(pil_depth_imgs)
+        escalated = (probs >= self.low_threshold) & (probs <= self.high_threshold)
+        preds = (probs > self.high_threshold).long()
+        indices = torch.nonzero(escalated).flatten().tolist()
+        if indices:
+            probs[escalated] = self.full_probs([pil_rgb_imgs[i] for i in indices], [pil_depth_imgs[i] for i in indices])
+            preds[escalated] = (probs[escalated] > 0.5).long()
+        return probs, preds, escalated
+
+    def calibrate(self, pil_depth_imgs, labels, target_recall=0.98):
+        """
+        Fit the first stage on the depth images of the validation split and choose the thresholds :
+        at most (1 - target_recall) of the success (resp. fail) images exit as fail (resp. success)
+        """
+        features = depth_statistics(pil_depth_imgs)
+        labels = torch.as_tensor(labels)
+        self.stage1.fit(features, labels)
+        with torch.no_grad():
+            probs = self.stage1(features)
+        quantile = 1 - target_recall
+        self.low_threshold = torch.quantile(probs[labels == 1], quantile).item() if (labels == 1).any() else 0.0
+        self.high_threshold = torch.quantile(probs[labels == 0], 1 - quantile).item() if (labels == 0).any() else 1.0
+        if self.low_threshold > self.high_threshold:  # Well separated classes : no uncertain band
+            self.low_threshold = self.high_threshold = (self.low_threshold + self.high_threshold) / 2
+        return self.low_threshold, self.high_threshold
+
+    def save(self, filename):
+        torch.save({'stage1': self.stage1.state_dict(), 'low_threshold': self.low_threshold,
+                    'high_threshold': self.high_threshold}, filename)
+
+    @staticmethod
+    def load(filename, model, batch_size=64):
+        """ Return the CascadePredictor saved in 'filename', with 'model' as full model """
+        state = torch.load(filename, map_location='cpu')
+        stage1 = DepthStatsClassifier()
+        stage1.load_state_dict(state['stage1'])
+        return CascadePredictor(model, stage1.eval(), state['low_threshold'], state['high_threshold'], batch_size)
+
+
+def raw_images(subset):
+    """ Return (PIL RGB images, PIL depth images, labels) of a RgbAndDepthSubset, without the transforms """
+    rgbs, depths, labels = [], [], []
+    for rgb, depth, y, _ in (subset.subset[i] for i in range(len(subset.subset))):
+        rgbs.append(rgb)
+        depths.append(depth)
+        labels.append(y)
+    return rgbs, depths, labels
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import json
+    import time
+    from torchmetrics.functional import f1_score, recall
+    from raiv_libraries.image_data_module import ImageDataModule
+
+    parser = argparse.ArgumentParser(description='Calibrate a depth statistics + RgbAndDepthCnn cascade on the validation split and compare its throughput with the full model.')
+    parser.add_argument('ckpt_file', type=str, help='RgbAndDepthCnn checkpoint file (.ckpt)')
+    parser.add_argument('images_folder', type=str, help='images folder with <rgb and depth> / <fail and success> sub-folders')
+    parser.add_argument('-o', '--output', default=None, type=str, help='Optionnal file where the calibrated cascade is saved (.pt)')
+    parser.add_argument('-t', '--target_recall', default=0.98, type=float, help='minimum ratio of each class which does not exit with the wrong class at the first stage')
+    parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    parser.add_argument('-r', '--report', default=None, type=str, help='Optionnal JSON file where the results are written')
+    args = parser.parse_args()
+
+    model = RgbAndDepthCnn.load_ckpt_model_file(args.ckpt_file)
+    data_module = ImageDataModule.from_images_folder(args.images_folder, rgb_and_depth=True,
+                                                     depth_channels=model.hparams.get('depth_channels', 3),
+                                                     dataset_size=args.dataset_size)
+    cascade = CascadePredictor(model)
+    _, val_depths, val_labels = raw_images(data_module.val_data)
+    low, high = cascade.calibrate(val_depths, val_labels, args.target_recall)
+    print(f'Thresholds : fail if < {low:.3f}, success if > {high:.3f}')
+    if args.output:
+        cascade.save(args.output)
+    rgbs, depths, labels = raw_images(data_module.test_data)
+    labels = torch.tensor(labels)
+    results = {}
+    for name in ['full', 'cascade']:
+        start = time.perf_counter()
+        if name == 'full':
+            probs, escalated = cascade.full_probs(rgbs, depths), torch.ones(len(labels), dtype=torch.bool)
+            preds = (probs > 0.5).long()
+        else:
+            probs, preds, escalated = cascade.predict(rgbs, depths)
+        duration = time.perf_counter() - start
+        results[name] = {'candidates_per_s': len(labels) / duration,
+                         'escalated_ratio': escalated.float().mean().item(),
+                         'f1_score': f1_score(preds, labels, num_classes=2, average='weighted').item(),
+                         'success_recall': recall(preds, labels, average='none', num_classes=2)[1].item()}
+    print(f"{'predictor':<12}{'candidates/s':>14}{'escalated':>11}{'F1':>8}{'recall':>8}")
+    for name, result in results.items():
+        print(f"{name:<12}{result['candidates_per_s']:>14.1f}{result['escalated_ratio']:>11.1%}{result['f1_score']:>8.4f}{result['success_recall']:>8.4f}")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
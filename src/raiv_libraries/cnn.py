@@ -1,29 +1,34 @@
+import functools
 import torch
 import torch.nn.functional as F
 import pytorch_lightning as pl
 import torchmetrics
-import torchvision
 from torch.optim import lr_scheduler
-from torchmetrics.functional import accuracy, confusion_matrix, f1_score
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping
 from raiv_libraries.image_tools import ImageTools
+from raiv_libraries.training_profiler import ThroughputProfiler
+from raiv_libraries.metrics_store import MetricsStore
 from pytorch_lightning.loggers import TensorBoardLogger
-from ray.tune.integration.pytorch_lightning import TuneReportCallback
+from ray.tune.integration.pytorch_lightning import TuneReportCallback, TuneReportCheckpointCallback
 import matplotlib.pyplot as plt
 import numpy as np
+import cv2
 from pathlib import Path
 import datetime
-import io
-import seaborn as sn
-import pandas as pd
-from PIL import Image
 
-plt.switch_backend('Qt5Agg')
 torch.set_printoptions(linewidth=120)
 
+CLASS_NAMES = ['fail', 'success']
+TUNE_CHECKPOINT_FILE = 'checkpoint'  # Name of the checkpoint file reported to Ray Tune
+# Possible numbers of test time augmentation variants : identity, 180°, 90° and 270° rotations, then the same ones flipped
+TTA_VARIANTS = [1, 2, 4, 8]
+
 
 # --- PYTORCH LIGHTNING MODULE ----
 class Cnn(pl.LightningModule):
+    # Values of the hyper-parameters added after the first models, used when a checkpoint doesn't have them
+    # (save_hyperparameters() would otherwise rebuild the old models with the defaults of the new ones)
+    LEGACY_HPARAMS = {}
 
     def __init__(self,  config, courbe_folder=None,
                  learning_rate: float = 1e-3,
@@ -32,18 +37,31 @@ class Cnn(pl.LightningModule):
                  backbone: str = 'resnet18',
                  train_bn: bool = True,
                  milestones: tuple = (5, 10),
-                 lr_scheduler_gamma: float = 1e-1):
+                 lr_scheduler_gamma: float = 1e-1,
+                 pretrained: bool = True,
+                 confusion_matrix_log: str = 'scalars',
+                 channels_last: bool = False,
+                 small_input: bool = False,
+                 pruned_channels: dict = None):
         super(Cnn, self).__init__()
         self.save_hyperparameters()
         self.build_model()
-        if courbe_folder is not None:
-            self.train_file = open(courbe_folder + '/train/data_model_train1.txt', 'w')  # fichier texte où sont stockées les données des graph (loss, accuracy etc...)
-            self.val_file = open(courbe_folder + '/val/data_model_val1.txt', 'w')
+        if pruned_channels:  # Widths of the residual blocks of a pruned model (see pruning.py)
+            from raiv_libraries.pruning import apply_pruned_channels
+            apply_pruned_channels(self, pruned_channels)
+        self.metrics = torch.nn.ModuleDict({name: self._build_metrics() for name in ['Train', 'Val', 'Test']})
+        self.metrics_writer = None  # Run of the metrics store (see metrics_store.py) of courbe_folder, created by build_trainer()
 
-    def build_trainer(self, data_module, model_name, ckpt_dir, num_epochs, suffix, dataset_size):
+    def build_trainer(self, data_module, model_name, ckpt_dir, num_epochs, suffix, dataset_size, profile_step=None, precision=32, tune_checkpoint=False):
         """
         Build the Pytorch trainer and a Tensorflow Board
+        A ThroughputProfiler callback measures where the time goes, if profile_step is given a torch.profiler window starts at this step
+        precision : 32 or 'bf16' (bfloat16 autocast, only used if the CPU or the GPU supports it)
+        tune_checkpoint : if True, a checkpoint is reported to Ray Tune with the metrics (needed by the schedulers which pause and resume the trials)
         """
+        if precision == 'bf16' and not Cnn.bf16_supported():
+            print('bfloat16 is not supported by this CPU, training in FP32')
+            precision = 32
         self.MODEL_CKPT_PATH = Path(ckpt_dir)
         now = datetime.datetime.now()
         filename = f'model_{now.year}_{now.month}_{now.day}-{now.hour}_{now.minute}'
@@ -52,6 +70,8 @@ class Cnn(pl.LightningModule):
         if suffix != '':
             filename = filename + '_' + suffix
         self.MODEL_CKPT = self.MODEL_CKPT_PATH / model_name / filename
+        if self.hparams.courbe_folder:  # Curves of this run (loss, accuracy etc...) used by courbes_CNN.py
+            self.metrics_writer = MetricsStore(self.hparams.courbe_folder).create_run(f'{model_name}_{filename}')
         # Tensorboard Logger used
         logger = TensorBoardLogger('runs', name=f'Model_{model_name}')
         # # Samples required by the custom ImagePredictionLogger callback to log image predictions.
@@ -65,72 +85,67 @@ class Cnn(pl.LightningModule):
         checkpoint_callback, early_stop_callback = self._config_callbacks()
         # Trainer  ################################################
         metrics = {"loss": "ptl/val_loss", "acc": "ptl/val_accuracy"}
+        if tune_checkpoint:
+            tune_callback = TuneReportCheckpointCallback(metrics, filename=TUNE_CHECKPOINT_FILE, on="validation_end")
+        else:
+            tune_callback = TuneReportCallback(metrics, on="validation_end")
         return pl.Trainer(max_epochs=num_epochs,
                              devices="auto", accelerator="auto",
                              auto_select_gpus=False,
                              auto_lr_find=True,
                              logger=logger,
                              log_every_n_steps=10,
+                             precision=precision,
                              # callbacks=[early_stop_callback, checkpoint_callback])
-                             callbacks=[checkpoint_callback, TuneReportCallback(metrics, on="validation_end")])
+                             callbacks=[checkpoint_callback, tune_callback,
+                                        ThroughputProfiler(courbe_folder=self.hparams.courbe_folder, profile_step=profile_step)])
+
+    def on_fit_start(self):
+        if self.hparams.get('channels_last', False):
+            self.to(memory_format=torch.channels_last)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        """ With channels_last, the image tensors are converted to the NHWC memory format like the model weights """
+        if self.hparams.get('channels_last', False):
+            batch = [t.contiguous(memory_format=torch.channels_last) if torch.is_tensor(t) and t.dim() == 4 else t for t in batch]
+        return batch
 
     # training loop
     def training_step(self, batch, batch_idx):
         logits, y = self.get_logits_and_outputs(batch)
-        return self._calculate_step_metrics(logits, y)
+        return self._update_step_metrics(logits, y, name='Train')
 
-    def training_epoch_end(self, outputs):
+    def on_train_epoch_end(self):
         """Compute and log training loss and accuracy at the epoch level."""
-        loss_mean, acc_mean = self._calculate_epoch_metrics(outputs, name='Train')
+        self._log_epoch_metrics(name='Train')
 
     # validation loop
     def validation_step(self, batch, batch_idx):
         logits, y = self.get_logits_and_outputs(batch)
-        # Compute loss & metrics:
-        outputs = self._calculate_step_metrics(logits, y)
-        outputs["pred_out"]=logits[1]  # Predicted outputs
-        outputs["true_out"]=y  # Real outputs
-        self.log("val_loss", outputs["loss"])
-        return outputs
-
-    def validation_epoch_end(self, outputs):
+        # Compute loss & update metrics:
+        loss = self._update_step_metrics(logits, y, name='Val')
+        self.log("val_loss", loss)
+
+    def on_validation_epoch_end(self):
         """Compute and log validation loss and accuracy at the epoch level."""
-        loss_mean, acc_mean = self._calculate_epoch_metrics(outputs, name='Val')
+        loss_mean, acc_mean, f1score, computed_confusion = self._log_epoch_metrics(name='Val')
         self.log("ptl/val_loss", loss_mean)
         self.log("ptl/val_accuracy", acc_mean)
-        # Generate a convolution matrix for TensorBoard
-        tb = self.logger.experiment  # noqa
-        pred_out = torch.cat([tmp['pred_out'] for tmp in outputs])
-        true_out = torch.cat([tmp['true_out'] for tmp in outputs])
-        confusion = torchmetrics.ConfusionMatrix(num_classes=2).to(pred_out.get_device())
-        confusion(pred_out, true_out)
-        computed_confusion = confusion.compute().detach().cpu().numpy().astype(int)
-        # confusion matrix
-        df_cm = pd.DataFrame(
-            computed_confusion,
-            ['fail', 'success'],  # Lines
-            ['fail', 'success'],  # Columns
-        )
-        fig, ax = plt.subplots(figsize=(10, 5))
-        fig.subplots_adjust(left=0.05, right=.65)
-        sn.set(font_scale=1.2)
-        sn.heatmap(df_cm, annot=True, annot_kws={"size": 16}, fmt='d', ax=ax)
-        buf = io.BytesIO()
-        plt.savefig(buf, format='jpeg', bbox_inches='tight')
-        buf.seek(0)
-        im = Image.open(buf)
-        im = torchvision.transforms.ToTensor()(im)
-        tb.add_image("val_confusion_matrix", im, global_step=self.current_epoch)
-
+        self.log("ptl/val_f1_score", f1score)
+        self._log_confusion_matrix(computed_confusion, name='Val')
 
     # test loop
     def test_step(self, batch, batch_idx):
         logits, y = self.get_logits_and_outputs(batch)
-        # Compute loss & metrics:
-        return self._calculate_step_metrics(logits, y)
+        # Compute loss & update metrics:
+        self._update_step_metrics(logits, y, name='Test')
 
-    def test_epoch_end(self, outputs):
-        loss_mean, acc_mean = self._calculate_epoch_metrics(outputs, name='Test')
+    def on_test_epoch_end(self):
+        loss_mean, acc_mean, f1score, computed_confusion = self._log_epoch_metrics(name='Test')
+        self.log("ptl/test_loss", loss_mean)
+        self.log("ptl/test_accuracy", acc_mean)
+        self.log("ptl/test_f1_score", f1score)
+        self._log_confusion_matrix(computed_confusion, name='Test')
 
     # define optimizers
     def configure_optimizers(self):
@@ -141,6 +156,28 @@ class Cnn(pl.LightningModule):
             {'optimizer': optimizer, 'lr_scheduler': scheduler}
         )
 
+    def build_feature_extractor(self, model_func):
+        """
+        Return (feature extractor, number of output features) from a torchvision model function (like models.resnet18).
+        The ImageNet weights are only loaded if hparams.pretrained is True (they are useless when a checkpoint is loaded).
+        The number of features is given by the input size of the removed classifier, so no forward pass is needed.
+        """
+        backbone = model_func(weights="DEFAULT" if self.hparams.get('pretrained', True) else None)
+        if self.hparams.get('small_input', False):
+            Cnn.adapt_stem_to_small_input(backbone)
+        _layers = list(backbone.children())
+        classifier = _layers.pop()
+        if not any(isinstance(layer, torch.nn.AdaptiveAvgPool2d) for layer in _layers):  # Like mobilenet_v2 or shufflenet
+            _layers.append(torch.nn.AdaptiveAvgPool2d(1))
+        feature_extractor = torch.nn.Sequential(*_layers)
+        linears = [m for m in classifier.modules() if isinstance(m, torch.nn.Linear)]
+        n_features = linears[0].in_features if linears else self.get_cumulative_output_conv_layers_size([feature_extractor])
+        return feature_extractor, n_features
+
+    def input_shapes(self):
+        """ Return the list of the shapes [C, H, W] of the images given to forward() """
+        return [list(self.hparams.input_shape)]
+
     def get_cumulative_output_conv_layers_size(self, feature_extractors):
         """
         Return the cumulative size of all the output convolution layers which is the input size for the dense part
@@ -154,6 +191,15 @@ class Cnn(pl.LightningModule):
             size += n_size
         return size
 
+    def build_classifier(self, n_sizes, num_target_classes=2):
+        """ Return the dense part of the network (the head), 'n_sizes' is the number of features given by the backbone(s) """
+        layer_1_size = self.hparams.config['layer_1_size']
+        layer_2_size = self.hparams.config['layer_2_size']
+        _fc_layers = [torch.nn.Linear(n_sizes, layer_1_size),
+                      torch.nn.Linear(layer_1_size, layer_2_size),
+                      torch.nn.Linear(layer_2_size, num_target_classes)]
+        return torch.nn.Sequential(*_fc_layers)
+
     # loss function, weights modified to give more importance to class 1
     def _loss_function(self, logits, labels):
         weights = torch.tensor([7.0, 3.0]).to(logits.device)#.cuda()
@@ -181,40 +227,70 @@ class Cnn(pl.LightningModule):
         #                                            "mean_accuracy": "ptl/val_accuracy"}, on="validation_end")
         return checkpoint_callback, early_stop_callback
 
-    # TODO: Refactor internal metrics
-    def _calculate_step_metrics(self, logits, y):
-        # prepare the metrics
+    def _log_confusion_matrix(self, confusion, name):
+        """
+        Log the confusion matrix counts as scalars (Confusion_<name>/<true class>_as_<predicted class>) and as text.
+        If hparams.confusion_matrix_log is 'image', an image of the matrix is also logged (rendered with NumPy/OpenCV).
+        Use confusion_matrix_report.py to draw the figures after the training.
+        """
+        mode = self.hparams.get('confusion_matrix_log', 'scalars')
+        if mode == 'none':
+            return
+        tb = self.logger.experiment  # noqa
+        counts = confusion.detach().cpu().numpy().astype(int)
+        for i, true_class in enumerate(CLASS_NAMES):
+            for j, pred_class in enumerate(CLASS_NAMES):
+                tb.add_scalar(f'Confusion_{name}/{true_class}_as_{pred_class}', counts[i, j], self.current_epoch)
+        text = '| true \\ predicted | ' + ' | '.join(CLASS_NAMES) + ' |\n|---|' + '---|' * len(CLASS_NAMES) + '\n'
+        text += '\n'.join(f'| {true_class} | ' + ' | '.join(str(c) for c in counts[i]) + ' |' for i, true_class in enumerate(CLASS_NAMES))
+        tb.add_text(f'{name.lower()}_confusion_matrix', text, global_step=self.current_epoch)
+        if mode == 'image':
+            tb.add_image(f'{name.lower()}_confusion_matrix', Cnn.render_confusion_matrix(counts), global_step=self.current_epoch, dataformats='HWC')
+
+    @staticmethod
+    def render_confusion_matrix(counts, cell_size=96):
+        """ Return a RGB image (numpy array [H, W, 3]) of the confusion matrix : the more samples in a cell, the darker the cell """
+        nb_classes = len(counts)
+        ratios = counts / max(counts.sum(axis=1, keepdims=True).max(), 1)  # Rows normalized by the biggest class
+        intensities = (255 * (1 - ratios)).astype(np.uint8)
+        image = np.repeat(np.repeat(intensities, cell_size, axis=0), cell_size, axis=1)
+        image = np.stack([image, image, np.full_like(image, 255)], axis=-1)  # Blue scale
+        for i in range(nb_classes):
+            for j in range(nb_classes):
+                color = (255, 255, 255) if intensities[i, j] < 128 else (0, 0, 0)
+                cv2.putText(image, str(counts[i, j]), (j * cell_size + 10, i * cell_size + cell_size // 2 + 8),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
+        return np.ascontiguousarray(image)
+
+    @staticmethod
+    def _build_metrics():
+        """
+        Stateful metrics of one stage (Train, Val or Test) : they are updated at each step and computed once per epoch
+        """
+        return torch.nn.ModuleDict({'loss': torchmetrics.MeanMetric(),
+                                    'acc': torchmetrics.Accuracy(),
+                                    'f1_score': torchmetrics.F1Score(num_classes=2, average='weighted'),
+                                    'confusion': torchmetrics.ConfusionMatrix(num_classes=2)})
+
+    def _update_step_metrics(self, logits, y, name):
+        """ Compute the loss of the step and update the metrics of the 'name' stage, return the loss """
         loss = self._loss_function(logits[1], y)
-        # loss = F.cross_entropy(logits[1], y)
         preds = torch.argmax(logits[1], dim=1)
-        num_correct = torch.eq(preds.view(-1), y.view(-1)).sum()
-        acc = accuracy(preds, y)
-        f1score = f1_score(preds, y, num_classes=2, average='weighted')
-        return {'loss': loss,
-                'acc': acc,
-                'f1_score': f1score,
-                'num_correct': num_correct,
-                'total': len(preds)}
-
-    def _calculate_epoch_metrics(self, outputs, name):
-        # Logging activations
-        loss_mean = torch.stack([output['loss']
-                                 for output in outputs]).mean()
-        correct = sum([x['num_correct'] for x in outputs])
-        total = sum([x['total'] for x in outputs])
-        acc_mean = correct / total
-        f1score = torch.stack([output['f1_score']
-                                for output in outputs]).mean()
-        #Text writing
-        if self.hparams.courbe_folder:
-            txt = '\n' + str(self.current_epoch)
-            txt2 = ';' + str(loss_mean.item()) + ';' + str(acc_mean.item()) + ';' + str(f1score.item())
-            if name == 'Train' :
-                self.train_file.write(txt)
-                self.train_file.write(txt2)
-            if name == 'Val' :
-                self.val_file.write(txt)
-                self.val_file.write(txt2)
+        metrics = self.metrics[name]
+        metrics['loss'].update(loss.detach(), weight=len(preds))
+        metrics['acc'].update(preds, y)
+        metrics['f1_score'].update(preds, y)
+        metrics['confusion'].update(preds, y)
+        return loss
+
+    def _log_epoch_metrics(self, name):
+        """ Compute, log and reset the metrics of the 'name' stage, return (loss, accuracy, F1 score, confusion matrix) """
+        metrics = self.metrics[name]
+        loss_mean, acc_mean, f1score, confusion = [metrics[key].compute() for key in ['loss', 'acc', 'f1_score', 'confusion']]
+        for metric in metrics.values():
+            metric.reset()
+        if self.metrics_writer is not None and not self.trainer.sanity_checking:
+            self.metrics_writer.append(self.current_epoch, name, loss_mean.item(), acc_mean.item(), f1score.item())
         # Logging scalars
         self.logger.experiment.add_scalar(f'Loss/{name}',
                                           loss_mean,
@@ -225,7 +301,7 @@ class Cnn(pl.LightningModule):
         self.logger.experiment.add_scalar(f'F1_Score/{name}',
                                           f1score,
                                           self.current_epoch)
-        return loss_mean, acc_mean
+        return loss_mean, acc_mean, f1score, confusion
 
 
     def _plot_classes_preds(self, images, labels):
@@ -267,8 +343,135 @@ class Cnn(pl.LightningModule):
         preds = preds_tensor.cpu().numpy()
         return preds, [F.softmax(el, dim=0)[i].item() for i, el in zip(preds, output[1])]
 
+    @classmethod
+    def load_ckpt_model_file(cls, ckpt_model_filename):
+        """
+        Load the model named 'ckpt_model_filename' and freeze it.
+        The architecture is built without the ImageNet weights and the checkpoint is memory-mapped (Pytorch >= 2.1),
+        so the model is loaded quickly and without network access.
+        :param name: name of the model
+        :return: the model freezed to be used for inference
+        """
+        try:
+            checkpoint = torch.load(ckpt_model_filename, map_location='cpu', mmap=True, weights_only=False)
+        except (TypeError, RuntimeError):  # Pytorch < 2.1 or old checkpoint format
+            checkpoint = torch.load(ckpt_model_filename, map_location='cpu')
+        hparams = dict(checkpoint['hyper_parameters'])
+        for name, value in cls.LEGACY_HPARAMS.items():
+            hparams.setdefault(name, value)
+        hparams['pretrained'] = False
+        hparams['courbe_folder'] = None  # Don't overwrite the curve files of the training
+        model = cls(**hparams)
+        model.on_load_checkpoint(checkpoint)
+        try:
+            model.load_state_dict(checkpoint['state_dict'], assign=True)
+        except TypeError:  # Pytorch < 2.1
+            model.load_state_dict(checkpoint['state_dict'])
+        model.freeze()
+        return model
+
     # Static methods
 
+    @staticmethod
+    def bf16_supported():
+        """ True if bfloat16 computations are accelerated : GPU with bf16 support or CPU with AVX512-BF16 / AMX instructions """
+        if torch.cuda.is_available():
+            return torch.cuda.is_bf16_supported()
+        try:
+            with open('/proc/cpuinfo') as f:
+                flags = f.read()
+        except OSError:
+            return False
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+    @staticmethod
+    def adapt_stem_to_small_input(backbone):
+        """
+        Adapt a torchvision backbone to small images (ex : 64x64 pixels, see ImageTools.SMALL_IMAGE_SIZE_FOR_NN) :
+        the first convolution has no stride, the max pooling of the stem is kept, so the stem divides the size by 2
+        instead of 4. With 64x64 images the ResNet blocks run on 32x32 maps (56x56 with 224x224 images) :
+        about 0.6 GMAC instead of 1.8 GMAC for a resnet18.
+        """
+        first_conv = next(m for m in backbone.modules() if isinstance(m, torch.nn.Conv2d))
+        first_conv.stride = (1, 1)
+
+    @staticmethod
+    def transforms(model, depth=False):
+        """
+        Return (inference transform, training transform) of the images given to 'model' (a Cnn or any predictor
+        with the same hparams), chosen from the input size of the model.
+        depth : True for the transforms of the depth images of a RgbAndDepthCnn
+        """
+        depth = depth and model.hparams.get('depth_channels', 3) == 1
+        return ImageTools.transforms_for_size(model.hparams.input_shape[-1], depth)
+
+    @staticmethod
+    def split_first_conv(module):
+        """
+        Return (first convolution, trunk) of a Sequential feature extractor : the trunk is a Sequential of the same layers
+        (shared weights) which gives the output of 'module' from the output of its first convolution
+        """
+        if isinstance(module, torch.nn.Conv2d):
+            return module, torch.nn.Sequential()
+        if isinstance(module, torch.nn.Sequential) and len(module) > 0:
+            first_conv, trunk = Cnn.split_first_conv(module[0])
+            return first_conv, torch.nn.Sequential(*trunk, *module[1:])
+        raise ValueError(f'The feature extractor must start with a convolution, not with a {type(module).__name__}')
+
+    @staticmethod
+    def single_channel_conv(conv):
+        """
+        Return a copy of the Conv2d 'conv' for 1 channel images : the filters are the sum of the filters of the 3 RGB channels,
+        so a grayscale image gives the same response than the 3 channels image made by repeating it
+        """
+        single_conv = torch.nn.Conv2d(1, conv.out_channels, kernel_size=conv.kernel_size, stride=conv.stride,
+                                      padding=conv.padding, dilation=conv.dilation, groups=1, bias=conv.bias is not None)
+        with torch.no_grad():
+            single_conv.weight.copy_(conv.weight.sum(dim=1, keepdim=True))
+            if conv.bias is not None:
+                single_conv.bias.copy_(conv.bias)
+        return single_conv
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def tta_index_maps(height, width, nb_variants):
+        """
+        Return the [nb_variants, height * width] tensor of the pixel indices of the test time augmentation variants
+        (see TTA_VARIANTS) : variant k of a flattened image is image[..., maps[k]]. Computed once for each image size.
+        """
+        if nb_variants not in TTA_VARIANTS:
+            raise ValueError(f'Unknown number of TTA variants : {nb_variants}, choose one of {TTA_VARIANTS}')
+        if nb_variants > 2 and height != width:
+            raise ValueError(f'The 90° rotations need square images, not {height}x{width} images')
+        indices = torch.arange(height * width).view(height, width)
+        rotations = [torch.rot90(indices, k, dims=(0, 1)) for k in [0, 2, 1, 3]]
+        variants = rotations + [torch.flip(rotation, dims=(1,)) for rotation in rotations]
+        return torch.stack([variant.flatten() for variant in variants[:nb_variants]])
+
+    @staticmethod
+    def tta_batch(images, nb_variants):
+        """ Return the [nb_variants * N, C, H, W] batch of the variants of 'images' ([N, C, H, W]), variant after variant """
+        if nb_variants == 1:
+            return images
+        n, c, h, w = images.shape
+        maps = Cnn.tta_index_maps(h, w, nb_variants).to(images.device)
+        variants = images.flatten(2).index_select(2, maps.flatten()).view(n, c, nb_variants, h, w)
+        return variants.permute(2, 0, 1, 3, 4).reshape(nb_variants * n, c, h, w)
+
+    @staticmethod
+    def tta_mean(probs, nb_variants):
+        """ Return the [N, nb_classes] mean of the probabilities ([nb_variants * N, nb_classes]) of the variants of each image """
+        if nb_variants == 1:
+            return probs
+        return probs.view(nb_variants, -1, probs.shape[-1]).mean(dim=0)
+
+    @staticmethod
+    def split_batch(batch):
+        """ Return (list of image tensors, labels) from a batch of a RgbSubset or RgbAndDepthSubset """
+        inputs = [t for t in batch if torch.is_tensor(t) and t.dim() == 4]
+        labels = next(t for t in batch if torch.is_tensor(t) and t.dim() == 1)
+        return inputs, labels
+
     @staticmethod
     def compute_prob_and_class(pred):
         """ Retrieve class (success or fail) and its associated percentage [0,1] from pred """
@@ -0,0 +1,190 @@
+import time
+import numpy as np
+import torch
+from PIL import Image
+from torchmetrics.functional import accuracy, f1_score
+from raiv_libraries.cnn import Cnn, TTA_VARIANTS
+from raiv_libraries.image_tools import ImageTools
+
+# Tools used to compare different versions of the grasp CNNs (quantized, pruned, distilled, ...) :
+# accuracy / F1 score on a dataloader and CPU latency for several batch sizes.
+
+LATENCY_BATCH_SIZES = (1, 8, 64)
+# Hyperparameters used to train the models compared by the benchmarks
+DEFAULT_CONFIG = {
+    "layer_1_size": 128,
+    "layer_2_size": 32,
+    "learning_rate": 0.00211123,
+    "batch_size": 8
+}
+
+
+@torch.no_grad()
+def evaluate(predictor, data_loader, tta=1):
+    """
+    Compute the accuracy and the weighted F1 score of 'predictor' on all the images of 'data_loader'.
+    'predictor' is any callable which returns (features, log_probs) like RgbCnn and RgbAndDepthCnn.
+    tta : number of test time augmentation variants of each image (see cnn.TTA_VARIANTS)
+    """
+    all_preds, all_labels = [], []
+    for batch in data_loader:
+        inputs, labels = Cnn.split_batch(batch)
+        _, log_probs = predictor(*[Cnn.tta_batch(t, tta) for t in inputs])
+        all_preds.append(torch.argmax(Cnn.tta_mean(torch.exp(log_probs), tta), dim=1))
+        all_labels.append(labels)
+    preds = torch.cat(all_preds)
+    labels = torch.cat(all_labels)
+    return {'acc': accuracy(preds, labels).item(),
+            'f1_score': f1_score(preds, labels, num_classes=2, average='weighted').item()}
+
+
+@torch.no_grad()
+def measure_latency(predictor, input_shapes, batch_sizes=LATENCY_BATCH_SIZES, nb_runs=20, nb_warmup=3, tta=1):
+    """
+    Return a dict {batch_size: mean latency in ms} of 'predictor' on random inputs.
+    input_shapes : shapes [C, H, W] of the inputs of 'predictor', given by Cnn.input_shapes()
+    tta : number of test time augmentation variants, the time to build them is included
+    """
+    latencies = {}
+    for batch_size in batch_sizes:
+        inputs = [torch.rand(batch_size, *input_shape) for input_shape in input_shapes]
+        for _ in range(nb_warmup):
+            predictor(*[Cnn.tta_batch(t, tta) for t in inputs])
+        start = time.perf_counter()
+        for _ in range(nb_runs):
+            predictor(*[Cnn.tta_batch(t, tta) for t in inputs])
+        latencies[batch_size] = (time.perf_counter() - start) / nb_runs * 1000
+    return latencies
+
+
+def measure_preprocessing(model, nb_images=64, nb_runs=5):
+    """ Return the mean time (ms) to transform 'nb_images' RGB crops (CROP_WIDTH x CROP_HEIGHT PIL images) for 'model' """
+    transform = Cnn.transforms(model)[0]
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (ImageTools.CROP_HEIGHT, ImageTools.CROP_WIDTH, 3), dtype=np.uint8))
+              for _ in range(nb_images)]
+    start = time.perf_counter()
+    for _ in range(nb_runs):
+        ImageTools.images_preprocessing(images, transform)
+    return (time.perf_counter() - start) / nb_runs * 1000
+
+
+@torch.no_grad()
+def count_flops(model):
+    """ Number of multiply-accumulate operations of the convolutions and linear layers of 'model' for one input """
+    flops = []
+
+    def conv_hook(module, inputs, output):
+        flops.append(output.numel() * module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1])
+
+    def linear_hook(module, inputs, output):
+        flops.append(output.numel() * module.in_features)
+
+    handles = [module.register_forward_hook(conv_hook if isinstance(module, torch.nn.Conv2d) else linear_hook)
+               for module in model.modules() if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear))]
+    model(*[torch.rand(1, *input_shape) for input_shape in model.input_shapes()])
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+
+def count_params(model):
+    """ Number of parameters of 'model' """
+    return sum(p.numel() for p in model.parameters())
+
+
+def fit_and_test(model, data_module, ckpt_dir, num_epochs, suffix='benchmark', precision=32):
+    """
+    Train 'model' with the usual Cnn trainer then test the best checkpoint.
+    Return a dict with the mean epoch time (s), the accuracy and the F1 score on the test split
+    """
+    trainer = model.build_trainer(data_module=data_module, model_name=model.hparams.backbone, ckpt_dir=ckpt_dir,
+                                  num_epochs=num_epochs, suffix=suffix, dataset_size=data_module.dataset_size, precision=precision)
+    start = time.time()
+    trainer.fit(model=model, datamodule=data_module)
+    epoch_time = (time.time() - start) / max(trainer.current_epoch, 1)
+    test_results = trainer.test(ckpt_path='best', datamodule=data_module)[0]
+    return {'epoch_time': epoch_time, 'acc': test_results['ptl/test_accuracy'], 'f1_score': test_results['ptl/test_f1_score']}
+
+
+def print_report(results):
+    """ Print a table from a dict {model name: {'acc': .., 'f1_score': .., 'latency': {batch_size: ms}}} """
+    batch_sizes = sorted({bs for result in results.values() for bs in result.get('latency', {})})
+    columns = [key for key in ['nb_params', 'flops', 'epoch_time', 'preprocess_ms'] if any(key in result for result in results.values())]
+    header = f"{'model':<20}{'acc':>8}{'F1':>8}" + ''.join(f'{column:>14}' for column in columns)
+    header += ''.join(f"{'bs=' + str(bs) + ' (ms)':>14}" for bs in batch_sizes)
+    print(header)
+    for name, result in results.items():
+        line = f"{name:<20}{result.get('acc', float('nan')):>8.4f}{result.get('f1_score', float('nan')):>8.4f}"
+        line += ''.join(f"{result.get(column, float('nan')):>14.6g}" for column in columns)
+        line += ''.join(f"{result['latency'][bs]:>14.2f}" for bs in batch_sizes if bs in result.get('latency', {}))
+        print(line)
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import json
+    from raiv_libraries.image_data_module import ImageDataModule
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the grasp CNNs (training time, F1 score, latency) on the same dataset split.')
+    parser.add_argument('benchmark', choices=['precision', 'architecture', 'input_size', 'tta'],
+                        help='precision : FP32 vs bfloat16 + channels-last training, architecture : shared vs dual backbones of RgbAndDepthCnn, '
+                             'input_size : 224 pixels vs small input images, tta : number of test time augmentation variants')
+    parser.add_argument('images_folder', type=str, help='images folder with fail and success sub-folders (or <rgb and depth> / <fail and success> with --rgb_and_depth)')
+    parser.add_argument('ckpt_folder', type=str, help='folder path where to stock the model.CKPT files generated')
+    parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='benchmark RgbAndDepthCnn (default : RgbCnn)')
+    parser.add_argument('--depth_channels', default=1, type=int, choices=[1, 3], help='number of channels of the depth images (RgbAndDepthCnn)')
+    parser.add_argument('-e', '--epochs', default=5, type=int, help='number of epochs of each training')
+    parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    parser.add_argument('-r', '--report', default=None, type=str, help='Optionnal JSON file where the results are written')
+    args = parser.parse_args()
+
+    if args.rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn as CnnClass
+    else:
+        from raiv_libraries.rgb_cnn import RgbCnn as CnnClass
+
+    def build_data_module(image_size=ImageTools.IMAGE_SIZE_FOR_NN):
+        return ImageDataModule.from_images_folder(args.images_folder, rgb_and_depth=args.rgb_and_depth, depth_channels=args.depth_channels,
+                                                  image_size=image_size, dataset_size=args.dataset_size, batch_size=DEFAULT_CONFIG['batch_size'])
+
+    data_module = build_data_module() if args.benchmark != 'input_size' else None
+    model_kwargs = {'depth_channels': args.depth_channels} if args.rgb_and_depth else {}
+    results = {}
+    if args.benchmark == 'precision':
+        for name, precision, channels_last in [('fp32', 32, False), ('bf16_channels_last', 'bf16', True)]:
+            model = CnnClass(DEFAULT_CONFIG, backbone='resnet18', channels_last=channels_last, **model_kwargs)
+            results[name] = fit_and_test(model, data_module, args.ckpt_folder, args.epochs, suffix=name, precision=precision)
+    elif args.benchmark == 'architecture':
+        if not args.rgb_and_depth:
+            parser.error('the architecture benchmark needs --rgb_and_depth')
+        for architecture in ['shared', 'dual']:
+            model = CnnClass(DEFAULT_CONFIG, backbone='resnet18', architecture=architecture, **model_kwargs)
+            results[architecture] = fit_and_test(model, data_module, args.ckpt_folder, args.epochs, suffix=architecture)
+            results[architecture]['nb_params'] = count_params(model)
+            model.eval()
+            results[architecture]['latency'] = measure_latency(model, model.input_shapes())
+            if architecture == 'dual':  # Same weights, the depth backbone runs in another thread
+                model.hparams.concurrent_backbones = True
+                results['dual_concurrent'] = dict(results['dual'], latency=measure_latency(model, model.input_shapes()))
+    elif args.benchmark == 'input_size':
+        small_size = ImageTools.SMALL_IMAGE_SIZE_FOR_NN
+        for name, size_kwargs in [('input_224', {}),
+                                  (f'input_{small_size}', {'small_input': True, 'input_shape': [3, small_size, small_size]})]:
+            model = CnnClass(DEFAULT_CONFIG, backbone='resnet18', **size_kwargs, **model_kwargs)
+            results[name] = fit_and_test(model, build_data_module(model.hparams.input_shape[-1]), args.ckpt_folder, args.epochs, suffix=name)
+            model.eval()
+            results[name]['preprocess_ms'] = measure_preprocessing(model)
+            results[name]['latency'] = measure_latency(model, model.input_shapes())
+    elif args.benchmark == 'tta':  # One model, evaluated with more and more variants of the test images
+        model = CnnClass(DEFAULT_CONFIG, backbone='resnet18', **model_kwargs)
+        fit_and_test(model, data_module, args.ckpt_folder, args.epochs, suffix='tta')
+        model.eval()
+        for tta in TTA_VARIANTS:
+            results[f'tta_{tta}'] = evaluate(model, data_module.test_dataloader(), tta=tta)
+            results[f'tta_{tta}']['latency'] = measure_latency(model, model.input_shapes(), tta=tta)
+    print_report(results)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
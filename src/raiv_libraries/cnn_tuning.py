@@ -0,0 +1,123 @@
+import os
+import torch
+from ray import air, tune
+from ray.air import session
+from ray.tune.schedulers import FIFOScheduler, ASHAScheduler, HyperBandScheduler, PopulationBasedTraining
+from raiv_libraries.cnn import Cnn, TUNE_CHECKPOINT_FILE
+from raiv_libraries.image_data_module import ImageDataModule, RgbSubset, RgbAndDepthSubset
+from raiv_libraries.in_memory_image_dataset import InMemoryImageDataset
+
+# Hyperparameter tuning of RgbCnn / RgbAndDepthCnn with Ray Tune.
+# The images are decoded only once and put in the Ray object store, all the trials share them (no disk access, no copy).
+# Each trial gets a fixed slice of the CPUs (torch intra-op threads + dataloader workers) and the number of
+# concurrent trials is computed from the number of cores, so the trials don't oversubscribe the CPUs.
+# A scheduler stops the bad trials early (ASHA, HyperBand) or replaces them by mutated copies of the good ones (PBT) :
+# each trial reports a checkpoint with its validation loss at every epoch so it can be paused and resumed.
+
+SCHEDULERS = ['fifo', 'asha', 'hyperband', 'pbt']
+
+
+def trial_resources(cpus_per_trial=4, nb_cpus=None):
+    """
+    Split the CPUs between the trials.
+    Return a dict : cpus_per_trial, intra_op_threads, loader_workers, max_concurrent_trials, gpus_per_trial
+    """
+    nb_cpus = nb_cpus or os.cpu_count()
+    cpus_per_trial = max(1, min(cpus_per_trial, nb_cpus))
+    loader_workers = cpus_per_trial // 4  # Images are already decoded, transforms need few workers
+    max_concurrent_trials = max(1, nb_cpus // cpus_per_trial)
+    nb_gpus = torch.cuda.device_count()
+    return {'cpus_per_trial': cpus_per_trial,
+            'intra_op_threads': max(1, cpus_per_trial - loader_workers),
+            'loader_workers': loader_workers,
+            'max_concurrent_trials': max_concurrent_trials,
+            'gpus_per_trial': nb_gpus / max_concurrent_trials if nb_gpus else 0}
+
+
+def build_scheduler(scheduler, num_epochs, config, grace_period=1):
+    """
+    Return the Ray Tune scheduler named 'scheduler' (see SCHEDULERS). The metric and the mode come from the TuneConfig.
+    config : search spaces of the hyperparameters, used for the PBT mutations
+    grace_period : minimum number of epochs of a trial before it can be stopped
+    """
+    if scheduler == 'fifo':
+        return FIFOScheduler()
+    if scheduler == 'asha':
+        return ASHAScheduler(time_attr='training_iteration', max_t=num_epochs, grace_period=grace_period, reduction_factor=2)
+    if scheduler == 'hyperband':
+        return HyperBandScheduler(time_attr='training_iteration', max_t=num_epochs, reduction_factor=3)
+    if scheduler == 'pbt':
+        # Only the hyperparameters which don't change the architecture can be mutated (the weights are copied)
+        return PopulationBasedTraining(time_attr='training_iteration', perturbation_interval=max(1, grace_period),
+                                       hyperparam_mutations={key: config[key] for key in ["learning_rate", "batch_size"] if key in config})
+    raise ValueError(f'Unknown scheduler : {scheduler}, choose one of {SCHEDULERS}')
+
+
+def train_cnn_tune(config, cnn_class, arrays, resources, ckpt_dir, num_epochs=10, dataset_size=None, suffix='', courbe_folder=None,
+                   weights_only=False, model_kwargs=None):
+    """
+    Trainable of a trial : the dataset comes from the shared arrays.
+    model_kwargs : other arguments of the model (not tuned), like depth_channels
+    If the trial is resumed (paused by the scheduler), the training restarts from the last reported checkpoint.
+    weights_only : only load the weights of the checkpoint, not the optimizer state (PBT : the hyperparameters may have changed)
+    """
+    torch.set_num_threads(resources['intra_op_threads'])
+    model_name = 'resnet18'
+    model = cnn_class(config, backbone=model_name, courbe_folder=courbe_folder, **(model_kwargs or {}))
+    ckpt_path = None
+    checkpoint = session.get_checkpoint()
+    if checkpoint:
+        with checkpoint.as_directory() as checkpoint_dir:
+            ckpt = torch.load(os.path.join(checkpoint_dir, TUNE_CHECKPOINT_FILE), map_location='cpu')
+            if weights_only:
+                model.load_state_dict(ckpt['state_dict'])
+                num_epochs = max(1, num_epochs - ckpt['epoch'] - 1)
+            else:
+                ckpt_path = os.path.join(session.get_trial_dir(), TUNE_CHECKPOINT_FILE)
+                torch.save(ckpt, ckpt_path)  # The checkpoint directory is deleted when leaving the 'with' block
+    depth_channels = model.hparams.get('depth_channels', 3)
+    dataset = InMemoryImageDataset(arrays, depth_channels=depth_channels)
+    subset_class = RgbSubset if dataset.depth is None else RgbAndDepthSubset
+    data_module = ImageDataModule(dataset, subset_class, dataset_size=dataset_size, batch_size=config["batch_size"],
+                                  num_workers=resources['loader_workers'], transform=Cnn.transforms(model)[1],
+                                  depth_transform=Cnn.transforms(model, depth=True)[1] if depth_channels == 1 else None)
+    trainer = model.build_trainer(data_module=data_module, model_name=model_name, ckpt_dir=ckpt_dir, num_epochs=num_epochs,
+                                  suffix=suffix, dataset_size=dataset_size, tune_checkpoint=True)
+    trainer.fit(model=model, datamodule=data_module, ckpt_path=ckpt_path)
+
+
+def tune_cnn(cnn_class, images_folder, ckpt_dir, config, rgb_and_depth=False, num_samples=10, num_epochs=10,
+             dataset_size=None, suffix='', cpus_per_trial=4, name='tune_rgb_image_model', scheduler='asha', grace_period=1,
+             model_kwargs=None):
+    """
+    Search the best hyperparameters in 'config' (dict of Ray Tune search spaces), return the Ray Tune results
+    scheduler : one of SCHEDULERS, grace_period : minimum number of epochs of a trial
+    model_kwargs : other arguments of the model (not tuned), like depth_channels
+    """
+    resources = trial_resources(cpus_per_trial)
+    print(f"{resources['max_concurrent_trials']} concurrent trials, {resources['intra_op_threads']} threads and {resources['loader_workers']} loader workers per trial")
+    arrays = InMemoryImageDataset.load_arrays(images_folder, rgb_and_depth=rgb_and_depth)
+    print(f"{len(arrays['targets'])} images loaded in memory")
+    # with_parameters puts the arrays in the Ray object store only once
+    trainable = tune.with_parameters(train_cnn_tune, cnn_class=cnn_class, arrays=arrays, resources=resources,
+                                     ckpt_dir=os.path.abspath(ckpt_dir), num_epochs=num_epochs,
+                                     dataset_size=dataset_size, suffix=suffix, weights_only=scheduler == 'pbt', model_kwargs=model_kwargs)
+    tuner = tune.Tuner(
+        tune.with_resources(trainable, resources={"cpu": resources['cpus_per_trial'], "gpu": resources['gpus_per_trial']}),
+        tune_config=tune.TuneConfig(
+            metric="loss",
+            mode="min",
+            num_samples=num_samples,
+            scheduler=build_scheduler(scheduler, num_epochs, config, grace_period),
+            max_concurrent_trials=resources['max_concurrent_trials'],
+        ),
+        run_config=air.RunConfig(
+            local_dir="./ray_tune_results",
+            name=name,
+            stop={"training_iteration": num_epochs},
+        ),
+        param_space=config,
+    )
+    results = tuner.fit()
+    print("Best hyperparameters found were: ", results.get_best_result().config)
+    return results
@@ -0,0 +1,64 @@
+import matplotlib
+matplotlib.use('Agg')  # No display needed, the figures are saved in files
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import seaborn as sn
+from pathlib import Path
+from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+from raiv_libraries.cnn import CLASS_NAMES
+
+# Post-hoc report of the confusion matrices logged (as scalars) by Cnn during the training.
+# Reads the TensorBoard logs of a run (ex : runs/Model_resnet18/version_0) and draws the heatmap of the
+# confusion matrix of the chosen epochs in PNG files.
+
+
+def load_confusion_matrices(log_dir, stage='Val'):
+    """ Return {epoch: confusion matrix (numpy array [nb_classes, nb_classes])} from the TensorBoard logs of a run """
+    accumulator = EventAccumulator(str(log_dir), size_guidance={'scalars': 0})
+    accumulator.Reload()
+    matrices = {}
+    for i, true_class in enumerate(CLASS_NAMES):
+        for j, pred_class in enumerate(CLASS_NAMES):
+            tag = f'Confusion_{stage}/{true_class}_as_{pred_class}'
+            if tag not in accumulator.Tags()['scalars']:
+                continue
+            for event in accumulator.Scalars(tag):
+                matrix = matrices.setdefault(event.step, np.zeros((len(CLASS_NAMES), len(CLASS_NAMES)), dtype=int))
+                matrix[i, j] = int(event.value)
+    return matrices
+
+
+def plot_confusion_matrix(matrix, title, filename):
+    df_cm = pd.DataFrame(matrix, CLASS_NAMES, CLASS_NAMES)  # Lines : true classes, columns : predicted classes
+    fig, ax = plt.subplots(figsize=(10, 5))
+    fig.subplots_adjust(left=0.05, right=.65)
+    sn.set(font_scale=1.2)
+    sn.heatmap(df_cm, annot=True, annot_kws={"size": 16}, fmt='d', ax=ax)
+    ax.set_title(title)
+    fig.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Draw the confusion matrices logged during a training (TensorBoard logs) in PNG files.')
+    parser.add_argument('log_dir', type=str, help='TensorBoard folder of the run (ex : runs/Model_resnet18/version_0)')
+    parser.add_argument('-o', '--output_folder', default='.', type=str, help='folder where the PNG files are saved')
+    parser.add_argument('--stage', default='Val', choices=['Val', 'Test'], help='which confusion matrices are drawn')
+    parser.add_argument('-e', '--epochs', default=None, type=int, nargs='+', help='epochs to draw (default : the last one)')
+    parser.add_argument('--all', default=False, action='store_true', help='draw all the epochs')
+    args = parser.parse_args()
+
+    matrices = load_confusion_matrices(args.log_dir, args.stage)
+    if not matrices:
+        raise SystemExit(f'No confusion matrix found in {args.log_dir}')
+    epochs = sorted(matrices) if args.all else (args.epochs or [max(matrices)])
+    output_folder = Path(args.output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    for epoch in epochs:
+        filename = output_folder / f'{args.stage.lower()}_confusion_matrix_epoch_{epoch}.png'
+        plot_confusion_matrix(matrices[epoch], f'{args.stage} confusion matrix, epoch {epoch}', filename)
+        print(f'{filename} saved')
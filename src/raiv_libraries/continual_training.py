@@ -0,0 +1,180 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+from raiv_libraries.cnn import Cnn
+from raiv_libraries.cnn_benchmark import evaluate
+from raiv_libraries.image_bank_subset import image_date
+from raiv_libraries.image_data_module import ImageDataModule, RgbSubset, RgbAndDepthSubset
+
+# Continual fine-tuning : instead of training a new model from the ImageNet weights on the whole image bank, the latest
+# checkpoint is fine-tuned (lower learning rate, few epochs) on the images recorded since its training, mixed with a
+# bounded and balanced replay buffer of older images (so the model doesn't forget them).
+# The new model is published only if its F1 score on the test split is not worse than the one of the previous model.
+# Publication is atomic (copy in a temporary file of the same folder, then os.replace) : the inference server
+# (see inference_server.py, --reload_period) always reads a complete checkpoint and reloads it without downtime.
+# When a model is published, its checkpoint and the date of the most recent image used are stored in
+# <ckpt_folder>/STATE_FILE : the next run fine-tunes this published model on the images recorded after this date.
+# A rejected model is deleted, so the next run starts again from the published one with the same new images.
+
+STATE_FILE = 'continual_state.json'
+
+
+def latest_checkpoint(ckpt_folder):
+    """ Return the most recent .ckpt file of 'ckpt_folder' (and of its sub-folders) """
+    ckpt_files = list(Path(ckpt_folder).rglob('*.ckpt'))
+    if not ckpt_files:
+        raise FileNotFoundError(f'No checkpoint in {ckpt_folder}')
+    return str(max(ckpt_files, key=os.path.getmtime))
+
+
+def image_files(dataset):
+    """ Return the RGB file of each image of 'dataset' (RgbAndDepthImageDataset or ImageFolder) """
+    if hasattr(dataset, 'rgb_files'):
+        return [str(f) for f in dataset.rgb_files]
+    return [path for path, _ in dataset.samples]
+
+
+def load_state(ckpt_folder):
+    """
+    Return (checkpoint file, date of the most recent image used) of the last published continual training,
+    (None, None) if there was none
+    """
+    state_file = Path(ckpt_folder) / STATE_FILE
+    if not state_file.exists():
+        return None, None
+    with open(state_file) as f:
+        state = json.load(f)
+    return state['ckpt_file'], datetime.fromisoformat(state['last_image_date'])
+
+
+def save_state(ckpt_folder, last_image_date, ckpt_file):
+    with open(Path(ckpt_folder) / STATE_FILE, 'w') as f:
+        json.dump({'last_image_date': last_image_date.isoformat(), 'ckpt_file': ckpt_file}, f, indent=2)
+
+
+def replay_indices(old_indices, targets, replay_size, seed=None):
+    """ Return a random replay buffer of at most 'replay_size' indices of 'old_indices', with the same number of images of each class """
+    rng = np.random.default_rng(seed)
+    old_targets = np.asarray(targets)[old_indices]
+    classes = np.unique(old_targets)
+    if len(classes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    per_class = replay_size // len(classes)
+    chosen = [old_indices[old_targets == target] for target in classes]
+    return np.concatenate([rng.choice(indices, min(per_class, len(indices)), replace=False) for indices in chosen])
+
+
+def publish(ckpt_file, published_file):
+    """ Copy 'ckpt_file' to 'published_file' atomically : a reader sees the old file or the new one, never a partial one """
+    folder = os.path.dirname(os.path.abspath(published_file))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=folder, suffix='.tmp')  # Same file system, so os.replace is atomic
+    try:
+        # mkstemp creates the file readable by its owner only, the inference node may run as another user
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_file, 0o666 & ~umask)
+        with os.fdopen(fd, 'wb') as dst, open(ckpt_file, 'rb') as src:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_file, published_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def continual_fine_tune(images_folder, ckpt_folder, rgb_and_depth=False, ckpt_file=None, since=None, replay_size=1000,
+                        num_epochs=3, lr_factor=0.1, seed=None):
+    """
+    Fine-tune 'ckpt_file' (default : the last published model, or the latest checkpoint of 'ckpt_folder' for the first run)
+    on the images recorded after 'since' (default : the date saved by the last published continual training, or the date
+    of the checkpoint) + a replay buffer of older images.
+    lr_factor : the learning rate of the first training of the model is multiplied by this factor
+    Return a dict with the F1 scores of the previous and new models on the same test split, the new checkpoint file, ...
+    or None if there is no new image. The state is not saved : call save_state() if the new model is published.
+    """
+    if rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn as CnnClass
+    else:
+        from raiv_libraries.rgb_cnn import RgbCnn as CnnClass
+    published_ckpt_file, published_date = load_state(ckpt_folder)
+    ckpt_file = ckpt_file or published_ckpt_file or latest_checkpoint(ckpt_folder)
+    since = since or published_date or datetime.fromtimestamp(os.path.getmtime(ckpt_file))
+    model = CnnClass.load_ckpt_model_file(ckpt_file)
+    depth_channels = model.hparams.get('depth_channels', 3)
+    if rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_image_dataset import RgbAndDepthImageDataset
+        dataset = RgbAndDepthImageDataset(images_folder + '/rgb', images_folder + '/depth', depth_channels=depth_channels)
+    else:
+        import torchvision
+        dataset = torchvision.datasets.ImageFolder(images_folder)
+    dates = np.array([image_date(f) for f in image_files(dataset)])
+    is_new = dates > since
+    new_indices, old_indices = np.flatnonzero(is_new), np.flatnonzero(~is_new)
+    print(f'{len(new_indices)} new images since {since}')
+    if len(new_indices) == 0:
+        return None
+    replay = replay_indices(old_indices, dataset.targets, replay_size, seed)
+    config = model.hparams.config
+    data_module = ImageDataModule(dataset, RgbAndDepthSubset if rgb_and_depth else RgbSubset, batch_size=config['batch_size'],
+                                  transform=Cnn.transforms(model)[1],
+                                  depth_transform=Cnn.transforms(model, depth=True)[1] if rgb_and_depth and depth_channels == 1 else None,
+                                  indices=np.concatenate([new_indices, replay]))
+    previous_results = evaluate(model, data_module.test_dataloader())
+    # The factor is applied to the learning rate of the first training, not compounded at each continual training
+    base_learning_rate = config.get('base_learning_rate', config['learning_rate'])
+    model.hparams.config = dict(config, base_learning_rate=base_learning_rate, learning_rate=base_learning_rate * lr_factor)
+    model.unfreeze()
+    trainer = model.build_trainer(data_module=data_module, model_name=model.hparams.backbone, ckpt_dir=ckpt_folder,
+                                  num_epochs=num_epochs, suffix='continual', dataset_size=None)
+    trainer.fit(model=model, datamodule=data_module)
+    test_results = trainer.test(ckpt_path='best', datamodule=data_module)[0]
+    return {'previous_ckpt_file': ckpt_file, 'ckpt_file': trainer.checkpoint_callback.best_model_path,
+            'last_image_date': dates[new_indices].max(),
+            'nb_new_images': len(new_indices), 'nb_replay_images': len(replay),
+            'previous_f1_score': previous_results['f1_score'], 'f1_score': test_results['ptl/test_f1_score']}
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Fine-tune the latest model on the images recorded since its training (+ a replay buffer) and publish it atomically.')
+    parser.add_argument('images_folder', type=str, help='images folder with fail and success sub-folders (or <rgb and depth> / <fail and success> with --rgb_and_depth)')
+    parser.add_argument('ckpt_folder', type=str, help='folder of the checkpoints, the fine-tuned model.CKPT file is also stocked there')
+    parser.add_argument('published_file', type=str, help='checkpoint file loaded by the inference node (replaced atomically)')
+    parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='the models are RgbAndDepthCnn (default : RgbCnn)')
+    parser.add_argument('--ckpt_file', default=None, type=str, help='Optionnal checkpoint to fine-tune (default : the last published one, or the latest one of ckpt_folder)')
+    parser.add_argument('--since', default=None, type=datetime.fromisoformat, help='Optionnal date of the first new picks (ex : "2022-11-21 14:00")')
+    parser.add_argument('-r', '--replay_size', default=1000, type=int, help='maximum number of older images mixed with the new ones')
+    parser.add_argument('-e', '--epochs', default=3, type=int, help='number of fine-tuning epochs')
+    parser.add_argument('-l', '--lr_factor', default=0.1, type=float, help='factor applied to the learning rate of the first training of the model')
+    parser.add_argument('-t', '--tolerance', default=0.0, type=float, help='the model is published if its F1 score >= previous F1 score - tolerance')
+    parser.add_argument('-f', '--force', default=False, action='store_true', help='publish the model even if its F1 score is worse')
+    parser.add_argument('--seed', default=None, type=int, help='Optionnal seed of the replay buffer')
+    args = parser.parse_args()
+
+    start = time.time()
+    results = continual_fine_tune(args.images_folder, args.ckpt_folder, rgb_and_depth=args.rgb_and_depth, ckpt_file=args.ckpt_file,
+                                  since=args.since, replay_size=args.replay_size, num_epochs=args.epochs,
+                                  lr_factor=args.lr_factor, seed=args.seed)
+    if results is None:
+        print('No new image, nothing to do')
+    else:
+        print(f"{results['nb_new_images']} new + {results['nb_replay_images']} replay images, fine-tuned in {time.time() - start:.0f} s")
+        print(f"Test F1 score : {results['previous_f1_score']:.4f} -> {results['f1_score']:.4f}")
+        if args.force or results['f1_score'] >= results['previous_f1_score'] - args.tolerance:
+            publish(results['ckpt_file'], args.published_file)
+            save_state(args.ckpt_folder, results['last_image_date'], results['ckpt_file'])
+            print(f"{results['ckpt_file']} published in {args.published_file}")
+        else:
+            # Deleted so it is never the base of a next run (see latest_checkpoint)
+            os.remove(results['ckpt_file'])
+            print(f"The fine-tuned model is worse, it is not published ({results['ckpt_file']} deleted)")
@@ -1,150 +1,64 @@
 import numpy as np
 import matplotlib.pyplot as plt
-
-TYPE_IMAGE = "DEPTH"  # écrire "DEPTH" ou "RGB"
-CHEMIN = '450im_depth'  # nom
-TYPE_COURBE = 'val'  # écrire "val" ou "train"
-#lol = open('/common/work/data_courbes_matplotlib/DEPTH/450im_depth/val/data_model_val1.txt')
-giga_list = []
-
-for number_file in range(1, 6):  # Numéro du fichier
-    road = '/common/work/data_courbes_matplotlib/DEPTH/450im_depth/' + str(TYPE_COURBE) + '/data_model_val' + str(number_file) + '.txt'
-    # road = '/common/work/data_courbes_matplotlib/' + str(TYPE_IMAGE) + "/" + str(CHEMIN) + "/" + str(TYPE_COURBE) + '/data_model_' + str(TYPE_COURBE) + str(number_file) + '.txt '
-    a_file = open(road, "r")
-
-    # Stockage de chaque ligne du document dans une liste
-    list_of_lists = []
-
-    for line in a_file:
-        stripped_line = line.strip()
-        line_list = stripped_line.split(';')
-        list_of_lists.append(line_list)
-    del list_of_lists[0]
-
-    # Convertion des string en float sur la grande liste :
-    for b in range(len(list_of_lists)):
-        for c in range(len(list_of_lists[0])):
-            list_of_lists[b][c] = float(list_of_lists[b][c])
-    a_file.close()
-    giga_list.append(list_of_lists)
-    # print(giga_list)
-
-    # Séparation de la grand liste en plusieurs petites listes epoch, loss, accuracy et f1 score :
-    epoch = []
-    loss = []
-    accuracy = []
-    f1_score = []
-    for i in range(len(list_of_lists)):
-        epoch.append(list_of_lists[i][0])
-        loss.append(list_of_lists[i][1])
-        accuracy.append(list_of_lists[i][2])
-        f1_score.append(list_of_lists[i][3])
-
-    # Affichage des résultats du graphique :
-    fig, (ax0, ax1, ax2) = plt.subplots(nrows=1, ncols=3, sharex=True,
-                                        figsize=(12, 4))
-    ax0.set_title('Loss')
-    ax0.errorbar(epoch, loss)
-    plt.xlabel('epoch')
-
-    ax1.set_title('Accuracy')
-    ax1.errorbar(epoch, accuracy)
-
-    ax2.set_title('F1_Score')
-    ax2.errorbar(epoch, f1_score)
-
-    fig.suptitle('Courbe ' + str(TYPE_COURBE) + ' ' + str(number_file))
-    plt.show()
-
-giga_list2 = np.array(giga_list)
-print(giga_list2)
-
-# Ecriture de la moyenne des loss, accuracy etc.
-mean_list = np.mean(giga_list2, axis=0)
-
-epoch = []
-loss = []
-accuracy = []
-f1_score = []
-
-# Ecriture de l'écart-type :
-std_list = np.std(giga_list2, axis=0)
-
-error_loss = []
-error_accuracy = []
-error_f1score = []
-
-# Ecriture courbe min et max :
-max_list = np.max(giga_list2, axis=0)
-
-min_list = np.min(giga_list2, axis=0)
-
-max_loss = []
-max_accuracy = []
-max_f1score = []
-min_loss = []
-min_accuracy = []
-min_f1score = []
-
-# Ecriture de chaque courbe/itération :
-
-giga_loss = []
-for i in range(len(giga_list2)):
-    mega_loss = []
-    for yolo in range(len(giga_list2[i])):
-        mega_loss.append(giga_list2[i][yolo][1])
-    giga_loss.append(mega_loss)
-
-gigaloss2 = np.array(giga_loss)
-print(gigaloss2)
-
-# Séparation dans toutes les listes respectives :
-for n in range(len(std_list)):
-    # ecart type
-    error_loss.append(std_list[n][1])
-    error_accuracy.append(std_list[n][2])
-    error_f1score.append(std_list[n][3])
-
-    # moyenne
-    epoch.append(mean_list[n][0])
-    loss.append(mean_list[n][1])
-    accuracy.append(mean_list[n][2])
-    f1_score.append(mean_list[n][3])
-
-    # max
-    max_loss.append(max_list[n][1])
-    max_accuracy.append(max_list[n][2])
-    max_f1score.append(max_list[n][3])
-
-    # min
-    min_loss.append(min_list[n][1])
-    min_accuracy.append(min_list[n][2])
-    min_f1score.append(min_list[n][3])
-
-# Affichage des courbes moyenne
-fig, (ax0, ax1, ax2) = plt.subplots(nrows=1, ncols=3, sharex=True,
-                                    figsize=(12, 4))
-ax0.set_title('Loss')
-ax0.errorbar(epoch, loss, yerr=error_loss, label='Moyenne + écart-type')
-ax0.plot(epoch, max_loss, label='Max')
-ax0.plot(epoch, min_loss, label='Min')
-# for a in range(len(giga_loss)):
-#     ax0.plot(epoch, giga_loss[a])
-ax0.set_xlabel('epoch')
-ax0.legend()
-
-ax1.set_title('Accuracy')
-ax1.errorbar(epoch, accuracy, yerr=error_accuracy)
-ax1.plot(epoch, max_accuracy)
-ax1.plot(epoch, min_accuracy)
-ax1.set_xlabel('epoch')
-ax1.legend()
-
-ax2.set_title('F1_Score')
-ax2.errorbar(epoch, f1_score, yerr=error_f1score)
-ax2.plot(epoch, max_f1score)
-ax2.plot(epoch, min_f1score)
-ax2.set_xlabel('epoch')
-
-fig.suptitle('Courbe ' + str(TYPE_COURBE))
-plt.show()
+from raiv_libraries import metrics_store
+from raiv_libraries.metrics_store import MetricsStore
+
+# Courbes (loss, accuracy, F1 score) des entraînements enregistrés dans un dossier de métriques (courbe_folder des
+# entraînements, voir metrics_store.py) : moyenne ± écart-type, min et max de toutes les runs sélectionnées,
+# et optionnellement la courbe de chaque run.
+
+TITLES = {'loss': 'Loss', 'acc': 'Accuracy', 'f1_score': 'F1_Score'}
+
+
+def plot_curves(epochs, curves, title, filename=None, run_curves=None):
+    """
+    Plot the mean ± std, min and max curves given by metrics_store.curves(), saved in 'filename' or displayed
+    run_curves : optional list of (run name, epochs, {metric: values}) curves of each run
+    """
+    fig, axs = plt.subplots(nrows=1, ncols=len(curves), sharex=True, figsize=(12, 4), squeeze=False)
+    for ax, (name, curve) in zip(axs[0], curves.items()):
+        ax.set_title(TITLES.get(name, name))
+        ax.errorbar(epochs, curve['mean'], yerr=curve['std'], label='Moyenne + écart-type')
+        ax.plot(epochs, curve['max'], label='Max')
+        ax.plot(epochs, curve['min'], label='Min')
+        for run_name, run_epochs, values in run_curves or []:
+            ax.plot(run_epochs, values[name], linewidth=0.5, alpha=0.5)
+        ax.set_xlabel('epoch')
+    axs[0, 0].legend()
+    fig.suptitle(title)
+    if filename:
+        fig.savefig(filename)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+def run_curves(records, names, split='Val'):
+    """ Return the list of (run name, epochs, {metric: values}) of the 'split' curves of each run of 'records' """
+    keys, stats = metrics_store.aggregate(metrics_store.select(records, split=split), by=('run', 'epoch'))
+    # keys are sorted by run : the curve of each run is a slice
+    runs, starts = np.unique(keys['run'], return_index=True)
+    ends = np.r_[starts[1:], len(keys)]
+    return [(names[run], keys['epoch'][start:end], {name: stat['mean'][start:end] for name, stat in stats.items()})
+            for run, start, end in zip(runs, starts, ends)]
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Display the mean ± std, min and max training curves of the runs of a metrics folder.')
+    parser.add_argument('metrics_folder', type=str, help='folder of the .metrics run files (--courbe_path of the trainings)')
+    parser.add_argument('-p', '--pattern', default='*', type=str, help='glob pattern of the run names')
+    parser.add_argument('-s', '--split', default='Val', choices=metrics_store.SPLITS, help='curves of the train, validation or test split')
+    parser.add_argument('-r', '--runs', default=False, action='store_true', help='also plot the curve of each run')
+    parser.add_argument('-o', '--output', default=None, type=str, help='Optionnal image file where the curves are saved (default : displayed)')
+    args = parser.parse_args()
+
+    records, names = MetricsStore(args.metrics_folder).load_runs(pattern=args.pattern)
+    if not names:
+        parser.error(f'no run matching {args.pattern} in {args.metrics_folder}')
+    print(f'{len(names)} runs, {len(records)} records')
+    epochs, curves = metrics_store.curves(records, args.split)
+    plot_curves(epochs, curves, f'Courbe {args.split} ({len(names)} runs)', args.output,
+                run_curves(records, names, args.split) if args.runs else None)
@@ -0,0 +1,122 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+import torch
+from raiv_libraries import metrics_store
+from raiv_libraries.cnn_tuning import trial_resources
+from raiv_libraries.courbes_CNN import plot_curves
+from raiv_libraries.image_data_module import ImageDataModule
+from raiv_libraries.metrics_store import MetricsStore, METRIC_NAMES
+
+# k-fold cross-validation of RgbCnn / RgbAndDepthCnn : the images are split in k stratified folds (see
+# ImageDataModule.stratified_folds), each fold is the test split of one training (the next fold is its validation split).
+# The folds are trained concurrently in a pool of processes, the CPUs are split between them like the tuning trials
+# (see cnn_tuning.trial_resources) so the processes don't oversubscribe the cores.
+# The metrics of every epoch of every fold are written in a metrics store (one run per fold, see metrics_store.py),
+# the mean ± std, min and max curves of the folds are computed in one vectorized pass (see metrics_store.curves).
+
+
+def _init_worker(intra_op_threads):
+    torch.set_num_threads(intra_op_threads)
+
+
+def train_fold(fold, nb_folds, images_folder, ckpt_dir, metrics_folder, config, rgb_and_depth=False, num_epochs=10, dataset_size=None,
+               loader_workers=1, model_kwargs=None):
+    """
+    Train and test the model of one fold (run in a worker process), its metrics are written in the 'metrics_folder' store
+    Return (fold, name of its run in the store, test results, best checkpoint file)
+    """
+    if rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn as CnnClass
+    else:
+        from raiv_libraries.rgb_cnn import RgbCnn as CnnClass
+    model_name = 'resnet18'
+    model = CnnClass(config, backbone=model_name, **(model_kwargs or {}))
+    data_module = ImageDataModule.from_images_folder(images_folder, rgb_and_depth=rgb_and_depth,
+                                                     depth_channels=model.hparams.get('depth_channels', 3),
+                                                     image_size=model.hparams.input_shape[-1], dataset_size=dataset_size,
+                                                     batch_size=config['batch_size'], num_workers=loader_workers,
+                                                     nb_folds=nb_folds, fold=fold)
+    trainer = model.build_trainer(data_module=data_module, model_name=model_name, ckpt_dir=ckpt_dir, num_epochs=num_epochs,
+                                  suffix=f'fold{fold}', dataset_size=dataset_size)
+    # Not through courbe_folder : the throughput files of the folds would overwrite each other
+    model.metrics_writer = MetricsStore(metrics_folder).create_run(f'cv_{Path(model.MODEL_CKPT).name}')
+    trainer.fit(model=model, datamodule=data_module)
+    test_results = trainer.test(ckpt_path='best', datamodule=data_module)[0]
+    model.metrics_writer.close()
+    test = {'loss': test_results['ptl/test_loss'], 'acc': test_results['ptl/test_accuracy'], 'f1_score': test_results['ptl/test_f1_score']}
+    return fold, model.metrics_writer.name, test, trainer.checkpoint_callback.best_model_path
+
+
+def cross_validate(images_folder, ckpt_dir, metrics_folder, config, rgb_and_depth=False, nb_folds=5, num_epochs=10, dataset_size=None,
+                   cpus_per_fold=4, model_kwargs=None):
+    """
+    Train the 'nb_folds' folds concurrently
+    Return (records of all the folds (metrics store records, the 'run' field is the fold), list of the test results of the folds,
+    list of their checkpoint files)
+    """
+    resources = trial_resources(cpus_per_fold)
+    nb_workers = min(nb_folds, resources['max_concurrent_trials'])
+    print(f"{nb_workers} concurrent folds, {resources['intra_op_threads']} threads and {resources['loader_workers']} loader workers per fold")
+    results = {}
+    # 'spawn' : the torch thread pools (and CUDA) of the parent process are not fork safe
+    with ProcessPoolExecutor(max_workers=nb_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(resources['intra_op_threads'],)) as executor:
+        futures = [executor.submit(train_fold, fold, nb_folds, images_folder, ckpt_dir, metrics_folder, config, rgb_and_depth, num_epochs,
+                                   dataset_size, resources['loader_workers'], model_kwargs) for fold in range(nb_folds)]
+        for future in as_completed(futures):
+            fold, run_name, test, ckpt_file = future.result()
+            print(f"Fold {fold} : test F1 score = {test['f1_score']:.4f} ({ckpt_file})")
+            results[fold] = (run_name, test, ckpt_file)
+    folds = sorted(results)
+    records, _ = MetricsStore(metrics_folder).load_runs([results[fold][0] for fold in folds])
+    return records, [results[fold][1] for fold in folds], [results[fold][2] for fold in folds]
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+    from raiv_libraries.image_tools import ImageTools
+
+    parser = argparse.ArgumentParser(description='k-fold cross-validation of a RgbCnn or RgbAndDepthCnn, the folds are trained concurrently.')
+    parser.add_argument('images_folder', type=str, help='images folder with fail and success sub-folders (or <rgb and depth> / <fail and success> with --rgb_and_depth)')
+    parser.add_argument('ckpt_folder', type=str, help='folder path where to stock the model.CKPT files of the folds')
+    parser.add_argument('output_folder', type=str, help='folder where the metrics of the folds (metrics store in <output_folder>/metrics), the report and the curves are written')
+    parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='cross-validate a RgbAndDepthCnn (default : RgbCnn)')
+    parser.add_argument('--depth_channels', default=1, type=int, choices=[1, 3], help='number of channels of the depth images (RgbAndDepthCnn)')
+    parser.add_argument('--small_input', default=False, action='store_true', help='model for small images (ImageTools.SMALL_IMAGE_SIZE_FOR_NN pixels)')
+    parser.add_argument('-k', '--nb_folds', default=5, type=int, help='number of folds')
+    parser.add_argument('-e', '--epochs', default=15, type=int, help='Optionnal number of epochs')
+    parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    parser.add_argument('--cpus_per_fold', default=4, type=int, help='number of CPUs of each fold (torch threads + dataloader workers)')
+    parser.add_argument('--show', default=False, action='store_true', help='display the curves instead of saving them')
+    args = parser.parse_args()
+
+    config = {
+        "layer_1_size": 256,
+        "layer_2_size": 16,
+        "learning_rate": 0.001,
+        "batch_size": 8
+    }
+    model_kwargs = {'depth_channels': args.depth_channels} if args.rgb_and_depth else {}
+    if args.small_input:
+        model_kwargs.update(small_input=True, input_shape=[3, ImageTools.SMALL_IMAGE_SIZE_FOR_NN, ImageTools.SMALL_IMAGE_SIZE_FOR_NN])
+    os.makedirs(args.output_folder, exist_ok=True)
+    records, tests, ckpt_files = cross_validate(args.images_folder, args.ckpt_folder, os.path.join(args.output_folder, 'metrics'), config,
+                                                rgb_and_depth=args.rgb_and_depth, nb_folds=args.nb_folds, num_epochs=args.epochs, dataset_size=args.dataset_size,
+                                                cpus_per_fold=args.cpus_per_fold, model_kwargs=model_kwargs)
+    test_values = np.array([[test[name] for name in METRIC_NAMES] for test in tests])
+    report = {'folds': [dict(test, fold=fold, ckpt_file=ckpt_file) for fold, (test, ckpt_file) in enumerate(zip(tests, ckpt_files))],
+              'mean': dict(zip(METRIC_NAMES, test_values.mean(axis=0).tolist())),
+              'std': dict(zip(METRIC_NAMES, test_values.std(axis=0).tolist()))}
+    with open(os.path.join(args.output_folder, 'cv_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Test F1 score : {report['mean']['f1_score']:.4f} ± {report['std']['f1_score']:.4f}")
+    print(f"Curves of each fold : python courbes_CNN.py {os.path.join(args.output_folder, 'metrics')} -p 'cv_*' -r")
+    for split in ['Train', 'Val']:
+        epochs, curves = metrics_store.curves(records, split)
+        plot_curves(epochs, curves, f'{args.nb_folds}-fold cross-validation : {split}',
+                    None if args.show else os.path.join(args.output_folder, f'cv_curves_{split.lower()}.png'))
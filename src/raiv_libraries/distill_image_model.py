@@ -0,0 +1,131 @@
+import torch
+import torch.nn.functional as F
+from raiv_libraries.cnn import Cnn
+from raiv_libraries.rgb_cnn import RgbCnn
+from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn
+
+
+# Knowledge distillation of a trained RgbCnn / RgbAndDepthCnn (the teacher, ex : resnet18) in a lightweight student
+# (ex : mobilenet_v3_small) which can run at camera rate on CPU.
+# The student is trained on the same ImageDataModule splits with a loss mixing the usual cross entropy on the labels
+# and the KL divergence KL(teacher || student) of the student outputs from the soft targets of the teacher (softened by a temperature).
+# The teacher is not a sub-module of the student : the student checkpoint is a normal RgbCnn / RgbAndDepthCnn checkpoint,
+# loaded with load_ckpt_model_file() and used with the same predict methods.
+# To view the logs : tensorboard --logdir=runs
+
+STUDENT_BACKBONES = ['mobilenet_v3_small', 'mobilenet_v3_large', 'mobilenet_v2', 'shufflenet_v2_x0_5', 'shufflenet_v2_x1_0']
+# Hparams of the teacher which define its inputs, the student must have the same ones to use the same images
+INPUT_HPARAMS = ['input_shape', 'small_input', 'depth_channels']
+
+
+class DistillationMixin:
+    """ Training step of a student Cnn : cross entropy on the labels + KL divergence with the teacher outputs """
+
+    _teacher = None
+
+    def set_teacher(self, teacher, alpha=0.7, temperature=4.0):
+        """
+        teacher : trained model with the same inputs, freezed
+        alpha : weight of the distillation loss (1 - alpha for the cross entropy on the labels)
+        temperature : temperature of the softmax of the teacher and student outputs
+        """
+        object.__setattr__(self, '_teacher', teacher.eval())  # Not registered : the teacher weights are not saved with the student
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def on_fit_start(self):
+        super().on_fit_start()
+        if self._teacher is not None:
+            self._teacher.to(self.device)
+
+    def training_step(self, batch, batch_idx):
+        logits, y = self.get_logits_and_outputs(batch)
+        loss = self._update_step_metrics(logits, y, name='Train')
+        if self._teacher is None:
+            return loss
+        inputs, _ = Cnn.split_batch(batch)
+        with torch.no_grad():
+            _, teacher_log_probs = self._teacher(*inputs)
+        # The outputs are log probabilities : log_softmax(log_probs / T) = log_softmax(logits / T)
+        # kl_div(student, teacher) is KL(teacher || student) : the usual distillation loss (Hinton et al.)
+        distillation_loss = F.kl_div(F.log_softmax(logits[1] / self.temperature, dim=1),
+                                     F.log_softmax(teacher_log_probs / self.temperature, dim=1),
+                                     reduction='batchmean', log_target=True) * self.temperature ** 2
+        self.log('train_distillation_loss', distillation_loss)
+        return (1 - self.alpha) * loss + self.alpha * distillation_loss
+
+
+class DistilledRgbCnn(DistillationMixin, RgbCnn):
+    pass
+
+
+class DistilledRgbAndDepthCnn(DistillationMixin, RgbAndDepthCnn):
+    pass
+
+
+def build_student(teacher, config, backbone='mobilenet_v3_small', **kwargs):
+    """ Return a student (DistilledRgbCnn or DistilledRgbAndDepthCnn) with the same inputs as 'teacher' """
+    student_class = DistilledRgbAndDepthCnn if isinstance(teacher, RgbAndDepthCnn) else DistilledRgbCnn
+    input_kwargs = {key: teacher.hparams[key] for key in INPUT_HPARAMS if key in teacher.hparams}
+    if student_class is DistilledRgbAndDepthCnn:
+        input_kwargs.setdefault('depth_channels', 3)  # Old teachers
+    return student_class(config, backbone=backbone, **input_kwargs, **kwargs)
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import json
+    import time
+    from raiv_libraries.image_data_module import ImageDataModule
+    from raiv_libraries.cnn_benchmark import evaluate, measure_latency, count_params, print_report
+
+    parser = argparse.ArgumentParser(description='Distill a trained RgbCnn or RgbAndDepthCnn (teacher) in a lightweight student and compare them. View results with : tensorboard --logdir=runs')
+    parser.add_argument('teacher_ckpt', type=str, help='checkpoint file (.ckpt) of the teacher')
+    parser.add_argument('images_folder', type=str, help='images folder with fail and success sub-folders (or <rgb and depth> / <fail and success> with --rgb_and_depth)')
+    parser.add_argument('ckpt_folder', type=str, help='folder path where to stock the model.CKPT file generated')
+    parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='the teacher is a RgbAndDepthCnn (default : RgbCnn)')
+    parser.add_argument('-b', '--backbone', default='mobilenet_v3_small', choices=STUDENT_BACKBONES, help='backbone of the student')
+    parser.add_argument('-a', '--alpha', default=0.7, type=float, help='weight of the distillation loss')
+    parser.add_argument('-t', '--temperature', default=4.0, type=float, help='temperature of the soft targets')
+    parser.add_argument('-c', '--courbe_path', default=None, type=str, help='Optionnal metrics folder where the curves of the training (loss, accuracy, F1 score) are stored for courbes_CNN.py')
+    parser.add_argument('-s', '--suffix_name', default='', type=str, help='Optionnal suffix to add to the model name')
+    parser.add_argument('-e', '--epochs', default=15, type=int, help='Optionnal number of epochs')
+    parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    parser.add_argument('-r', '--report', default=None, type=str, help='Optionnal JSON file where the comparison is written')
+    args = parser.parse_args()
+
+    teacher_class = RgbAndDepthCnn if args.rgb_and_depth else RgbCnn
+    teacher = teacher_class.load_ckpt_model_file(args.teacher_ckpt)
+    config = {
+        "layer_1_size": 128,
+        "layer_2_size": 32,
+        "learning_rate": 0.00211123,
+        "batch_size": 8
+    }
+    student = build_student(teacher, config, backbone=args.backbone, courbe_folder=args.courbe_path)
+    student.set_teacher(teacher, alpha=args.alpha, temperature=args.temperature)
+    # Same splits as the training of the teacher (the split is seeded)
+    data_module = ImageDataModule.from_images_folder(args.images_folder, rgb_and_depth=args.rgb_and_depth,
+                                                     depth_channels=teacher.hparams.get('depth_channels', 3),
+                                                     image_size=teacher.hparams.input_shape[-1],
+                                                     dataset_size=args.dataset_size, batch_size=config["batch_size"])
+    suffix = '_'.join(filter(None, ['distilled', args.suffix_name]))
+    trainer = student.build_trainer(data_module=data_module, model_name=args.backbone, ckpt_dir=args.ckpt_folder,
+                                    num_epochs=args.epochs, suffix=suffix, dataset_size=args.dataset_size)
+    start_fit = time.time()
+    trainer.fit(model=student, datamodule=data_module)
+    print(f"Training duration = {time.time() - start_fit:.2f} seconds")
+    trainer.test(ckpt_path='best', datamodule=data_module)
+    # Comparison on the test split : F1 score, number of parameters and CPU latency
+    student.eval()
+    results = {}
+    for name, model in [('teacher', teacher), ('student', student)]:
+        results[name] = evaluate(model, data_module.test_dataloader())
+        results[name]['nb_params'] = count_params(model)
+        results[name]['latency'] = measure_latency(model, model.input_shapes())
+    print_report(results)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+    print('End of distillation')
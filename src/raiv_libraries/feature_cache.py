@@ -0,0 +1,189 @@
+import json
+from pathlib import Path
+import numpy as np
+import torch
+import torch.nn.functional as F
+import pytorch_lightning as pl
+from torch.utils.data import Dataset, DataLoader
+from raiv_libraries.cnn import Cnn
+
+# Linear-probe mode : the backbone (feature extractor) of a RgbCnn or RgbAndDepthCnn is frozen, so its output
+# for each image of the dataset can be computed only once and stored in memory-mapped files :
+#   <cache_dir>/<split>_features.npy, <cache_dir>/<split>_labels.npy  (split = train, val or test)
+# Then only the head (the fc layers) is trained on these features, which is a small MLP fit on CPU.
+# The splits are the ones of the ImageDataModule (same seed), so a head trained here can be put back in the full model.
+
+SPLITS = ['train', 'val', 'test']
+META_FILE = 'meta.json'
+
+
+def _rotate_batch(batch, k):
+    """ Rotate all the image tensors ([batch_size, C, H, W]) of a batch by k * 90 degrees """
+    if k == 0:
+        return batch
+    return [torch.rot90(t, k, dims=(2, 3)) if torch.is_tensor(t) and t.dim() == 4 else t for t in batch]
+
+
+@torch.no_grad()
+def build_feature_cache(model, data_module, cache_dir, rotations=(0,), num_workers=None):
+    """
+    Compute the backbone features of all the images of the data_module splits and store them in 'cache_dir'.
+    rotations : angles (multiples of 90 degrees) of the rotated copies of each image to add to the cache
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    model.eval()
+    n_features = model.fc[0].in_features
+    for split in SPLITS:
+        loader = getattr(data_module, f'{split}_dataloader')(num_workers)
+        nb_rows = len(loader.dataset) * len(rotations)
+        features = np.lib.format.open_memmap(cache_dir / f'{split}_features.npy', mode='w+', dtype=np.float32, shape=(nb_rows, n_features))
+        labels = np.lib.format.open_memmap(cache_dir / f'{split}_labels.npy', mode='w+', dtype=np.int64, shape=(nb_rows,))
+        row = 0
+        for batch in loader:
+            for angle in rotations:
+                (batch_features, _), y = model.get_logits_and_outputs(_rotate_batch(batch, angle // 90))
+                features[row:row + len(y)] = batch_features.cpu().numpy()
+                labels[row:row + len(y)] = y.cpu().numpy()
+                row += len(y)
+        features.flush()
+        labels.flush()
+        print(f'{split} : {nb_rows} features cached')
+    meta = {'model': type(model).__name__, 'backbone': model.hparams.backbone, 'n_features': n_features, 'rotations': list(rotations)}
+    with open(cache_dir / META_FILE, 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+class CachedFeatures(Dataset):
+    """ Dataset of the (features, label) of a split, read from the memory-mapped cache files """
+    def __init__(self, cache_dir, split):
+        self.features = np.load(Path(cache_dir) / f'{split}_features.npy', mmap_mode='r')
+        self.labels = np.load(Path(cache_dir) / f'{split}_labels.npy', mmap_mode='r')
+
+    def __getitem__(self, index):
+        return torch.from_numpy(np.array(self.features[index])), int(self.labels[index])
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class FeatureDataModule(pl.LightningDataModule):
+    """ DataModule which provides the cached features instead of the images """
+    def __init__(self, cache_dir, batch_size=8, num_workers=0):
+        super().__init__()
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        with open(Path(cache_dir) / META_FILE) as f:
+            self.meta = json.load(f)
+        self.train_data, self.val_data, self.test_data = [CachedFeatures(cache_dir, split) for split in SPLITS]
+
+    def train_dataloader(self):
+        return DataLoader(self.train_data, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+
+    def val_dataloader(self):
+        return DataLoader(self.val_data, batch_size=self.batch_size, num_workers=self.num_workers)
+
+    def test_dataloader(self):
+        return DataLoader(self.test_data, batch_size=self.batch_size, num_workers=self.num_workers)
+
+
+class FeatureHeadCnn(Cnn):
+    """ Only the head (fc layers) of a RgbCnn or RgbAndDepthCnn, trained on cached features """
+    def __init__(self, config, n_features=512, **kwargs):
+        super(FeatureHeadCnn, self).__init__(config, **kwargs)
+
+    def build_model(self):
+        self.fc = self.build_classifier(self.hparams.n_features)
+
+    def forward(self, features):
+        t = self.fc(features)
+        t = F.log_softmax(t, dim=1)
+        return features, t
+
+    def get_logits_and_outputs(self, batch):
+        features, y = batch
+        logits = self(features)
+        return logits, y
+
+    def load_head_into(self, model):
+        """ Copy the trained head in the full model (RgbCnn or RgbAndDepthCnn with the same backbone) """
+        model.fc.load_state_dict(self.fc.state_dict())
+        return model
+
+
+def train_head(config, cache_dir, ckpt_dir, num_epochs=10, suffix='linear_probe'):
+    data_module = FeatureDataModule(cache_dir, batch_size=config['batch_size'])
+    model = FeatureHeadCnn(config, n_features=data_module.meta['n_features'], backbone=data_module.meta['backbone'])
+    trainer = model.build_trainer(data_module=data_module, model_name=data_module.meta['backbone'], ckpt_dir=ckpt_dir,
+                                  num_epochs=num_epochs, suffix=suffix, dataset_size=None)
+    trainer.fit(model=model, datamodule=data_module)
+    return model, trainer
+
+
+def tune_head(cache_dir, ckpt_dir, num_samples=40, num_epochs=10):
+    """ Ray Tune search of the head hyperparameters, each trial only uses 1 CPU """
+    from ray import air, tune
+    config = {
+        "layer_1_size": tune.choice([128, 256, 512]),
+        "layer_2_size": tune.choice([16, 32, 64]),
+        "learning_rate": tune.loguniform(1e-4, 1e-1),
+        "batch_size": tune.choice([4, 8, 16, 32]),
+    }
+    trainable = tune.with_parameters(train_head, cache_dir=str(Path(cache_dir).resolve()),
+                                     ckpt_dir=str(Path(ckpt_dir).resolve()), num_epochs=num_epochs)
+    tuner = tune.Tuner(
+        tune.with_resources(trainable, resources={"cpu": 1}),
+        tune_config=tune.TuneConfig(metric="loss", mode="min", num_samples=num_samples),
+        run_config=air.RunConfig(local_dir="./ray_tune_results", name="tune_linear_probe"),
+        param_space=config,
+    )
+    results = tuner.fit()
+    print("Best hyperparameters found were: ", results.get_best_result().config)
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    from raiv_libraries.image_data_module import ImageDataModule
+
+    parser = argparse.ArgumentParser(description='Linear-probe mode : cache the backbone features of a dataset, then train or tune only the head on them.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='compute the features of all the images and store them in the cache folder')
+    build_parser.add_argument('images_folder', type=str, help='images folder with fail and success sub-folders (or <rgb and depth> / <fail and success> with --rgb_and_depth)')
+    build_parser.add_argument('cache_dir', type=str, help='folder where the features are stored')
+    build_parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='use a RgbAndDepthCnn instead of a RgbCnn')
+    build_parser.add_argument('--ckpt', default=None, type=str, help='Optionnal model checkpoint to get the backbone from (default : ImageNet weights)')
+    build_parser.add_argument('-r', '--rotations', default=[0], type=int, nargs='+', help='rotations (multiples of 90 degrees) added to the cache')
+    build_parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    for name in ['train', 'tune']:
+        sub_parser = subparsers.add_parser(name, help=f'{name} the head on the cached features')
+        sub_parser.add_argument('cache_dir', type=str, help='folder where the features are stored')
+        sub_parser.add_argument('ckpt_folder', type=str, help='folder path where to stock the model.CKPT file generated')
+        sub_parser.add_argument('-e', '--epochs', default=15, type=int, help='Optionnal number of epochs')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.rgb_and_depth:
+            from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn as CnnClass
+        else:
+            from raiv_libraries.rgb_cnn import RgbCnn as CnnClass
+        if args.ckpt:
+            model = CnnClass.load_ckpt_model_file(args.ckpt)
+        else:
+            model = CnnClass({"layer_1_size": 128, "layer_2_size": 32, "learning_rate": 0.001, "batch_size": 32}, backbone='resnet18')
+        data_module = ImageDataModule.from_images_folder(args.images_folder, rgb_and_depth=args.rgb_and_depth,
+                                                         depth_channels=model.hparams.get('depth_channels', 3), image_size=model.hparams.input_shape[-1],
+                                                         dataset_size=args.dataset_size, batch_size=64)
+        build_feature_cache(model, data_module, args.cache_dir, rotations=args.rotations)
+    elif args.command == 'train':
+        config = {
+            "layer_1_size": 128,
+            "layer_2_size": 32,
+            "learning_rate": 0.00211123,
+            "batch_size": 4
+        }
+        model, trainer = train_head(config, args.cache_dir, args.ckpt_folder, num_epochs=args.epochs)
+        trainer.test(ckpt_path='best', datamodule=FeatureDataModule(args.cache_dir, batch_size=config['batch_size']))
+    else:
+        tune_head(args.cache_dir, args.ckpt_folder, num_epochs=args.epochs)
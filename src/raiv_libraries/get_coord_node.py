@@ -36,9 +36,17 @@ class InBoxCoord:
     IN_THE_BOX = False
 
 
-    def __init__(self, perspective_calibration):
-
+    def __init__(self, perspective_calibration, grasp_heatmap=None, nb_best_points=10, active_sampler=None):
+        """
+        grasp_heatmap : optional GraspHeatmap used by the 'best' mode to score the pixels of the pick box
+        nb_best_points : in 'best' and 'active' modes, the point is randomly chosen among these best pixels
+        active_sampler : optional ActiveSampler (see active_sampling.py) used by the 'active' mode
+        """
         self.perspective_calibration = perspective_calibration
+        self.grasp_heatmap = grasp_heatmap
+        self.active_sampler = active_sampler
+        self.nb_best_points = nb_best_points
+        self.last_heatmap = None  # (prob_map, best_points, best_probs) computed by the last 'best' request
         self.bgr_cv = None
         self.depth_cv = None
         self.distance_camera_to_table = 0
@@ -217,6 +225,8 @@ class InBoxCoord:
         * Fixed : This mode is the same as the random mode but the pixel is defined in the call of the service
         * random_no_refresh : This mode launch the service with the same rgb and deepth image, no refresh is processed
         * random_no_swap : This mode launch the service with just a rgb and deepth refresh but no swap
+        * best : Like random but the pixel is chosen among the best ones of the grasp-success heatmap (needs a grasp_heatmap)
+        * active : Like random but the pixel is chosen among the ones where the model is the most uncertain, to collect more useful images (needs an active_sampler)
 
         """
         if req.mode == 'random':
@@ -228,6 +238,10 @@ class InBoxCoord:
             x_pixel, y_pixel = self.generate_random_pick_or_place_points(req.type_of_point, req.on_object, refresh=False, swap=False, color=False)
         elif req.mode == 'random_no_swap':
             x_pixel, y_pixel = self.generate_random_pick_or_place_points(req.type_of_point, req.on_object, swap=False, color=False)
+        elif req.mode == 'best':
+            x_pixel, y_pixel = self.generate_best_pick_point()
+        elif req.mode == 'active':
+            x_pixel, y_pixel = self.generate_active_pick_point()
         elif req.mode == 'color':
             x_pixel, y_pixel = self.generate_random_pick_or_place_points(req.type_of_point, req.on_object, color=True)
 
@@ -303,6 +317,57 @@ class InBoxCoord:
             print("generate_random_pick_or_place_points : color==True and point_type == InBoxCoord.PICK")
             return self.generate_random_point_in_box_color(self.pick_box, self.pick_box_angle, point_type, on_object)
 
+    def pick_box_mask(self):
+        """ Return a mask of the pick box (255 inside the box, 0 elsewhere) """
+        mask = np.zeros((self.image_height, self.image_width), np.uint8)
+        cv2.drawContours(mask, [self.pick_box], 0, 255, -1)
+        return mask
+
+    def best_pick_points(self, n, refresh=True, swap=True):
+        """ Return the n pixels (and their success probabilities) of the pick box with the best grasp-success probabilities """
+        if self.grasp_heatmap is None:
+            raise ValueError('No grasp_heatmap was given to InBoxCoord')
+        if refresh:
+            self.refresh_rgb_and_depth_images()
+        if swap:
+            self.swap_pick_and_place_boxes_if_needed(self.depth_cv)
+        rgb = cv2.cvtColor(self.bgr_cv, cv2.COLOR_BGR2RGB)
+        prob_map, points, probs = self.grasp_heatmap.compute(rgb, self.depth_cv, self.pick_box_mask())
+        best_points, best_probs = self.grasp_heatmap.best_points(points, probs, n)
+        self.last_heatmap = (prob_map, best_points, best_probs)
+        return best_points, best_probs
+
+    def generate_best_pick_point(self):
+        """ Randomly choose one of the best pixels (not always the best one, in case it can't be picked) """
+        best_points, best_probs = self.best_pick_points(self.nb_best_points)
+        if len(best_points) == 0:
+            rospy.loginfo('No pixel scored in the pick box, random point generated')
+            return self.generate_random_pick_or_place_points(InBoxCoord.PICK, InBoxCoord.ON_OBJECT, refresh=False, swap=False)
+        ind = random.randrange(len(best_points))
+        rospy.loginfo(f'Best point chosen with a success probability of {best_probs[ind]:.2f}')
+        return int(best_points[ind][0]), int(best_points[ind][1])
+
+    def active_pick_points(self, n, refresh=True, swap=True):
+        """ Return the n pixels of the pick box with the highest uncertainties of the model, their uncertainties and success probabilities """
+        if self.active_sampler is None:
+            raise ValueError('No active_sampler was given to InBoxCoord')
+        if refresh:
+            self.refresh_rgb_and_depth_images()
+        if swap:
+            self.swap_pick_and_place_boxes_if_needed(self.depth_cv)
+        rgb = cv2.cvtColor(self.bgr_cv, cv2.COLOR_BGR2RGB)
+        return self.active_sampler.most_uncertain_points(rgb, self.depth_cv, self.pick_box_mask(), n)
+
+    def generate_active_pick_point(self):
+        """ Randomly choose one of the most uncertain pixels (not always the same one, in case it can't be picked) """
+        points, uncertainties, probs = self.active_pick_points(self.nb_best_points)
+        if len(points) == 0:
+            rospy.loginfo('No pixel scored in the pick box, random point generated')
+            return self.generate_random_pick_or_place_points(InBoxCoord.PICK, InBoxCoord.ON_OBJECT, refresh=False, swap=False)
+        ind = random.randrange(len(points))
+        rospy.loginfo(f'Active point chosen with an uncertainty of {uncertainties[ind]:.4f} (success probability of {probs[ind]:.2f})')
+        return int(points[ind][0]), int(points[ind][1])
+
     def generate_random_point_in_box_color(self, box, angle, point_type, on_object):
         # This part of the code allows us to know what is the angle we are given by OpenCV
         o_i = int(math.sqrt((box[-1][0] - box[2][0]) ** 2 + (box[-1][1] - box[2][1]) ** 2))
@@ -377,7 +442,21 @@ class InBoxCoord:
 if __name__ == '__main__':
     rospy.init_node('In_box_coord')
     pc = PerspectiveCalibration('/common/save/calibration/camera/camera_data')
-    IBC = InBoxCoord(pc)
+    grasp_heatmap = active_sampler = None
+    ckpt_file = rospy.get_param('~grasp_model', None)  # Optional model used by the 'best' and 'active' modes
+    if ckpt_file:
+        from raiv_libraries.grasp_heatmap import GraspHeatmap
+        if rospy.get_param('~rgb_and_depth', True):
+            from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn
+            model = RgbAndDepthCnn.load_ckpt_model_file(ckpt_file)
+        else:
+            from raiv_libraries.rgb_cnn import RgbCnn
+            model = RgbCnn.load_ckpt_model_file(ckpt_file)
+        grasp_heatmap = GraspHeatmap(model, stride=rospy.get_param('~heatmap_stride', 8))
+        from raiv_libraries.active_sampling import ActiveSampler
+        active_sampler = ActiveSampler(grasp_heatmap, method=rospy.get_param('~active_method', 'entropy'),
+                                       nb_mc_samples=rospy.get_param('~nb_mc_samples', 20))
+    IBC = InBoxCoord(pc, grasp_heatmap=grasp_heatmap, nb_best_points=rospy.get_param('~nb_best_points', 10), active_sampler=active_sampler)
     IBC.init_pick_and_place_boxes()
     rospy.spin()
 
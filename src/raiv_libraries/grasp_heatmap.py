@@ -0,0 +1,192 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from raiv_libraries.image_tools import ImageTools
+from raiv_libraries.cnn import Cnn
+from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn
+
+# Dense grasp-success map over the pick box.
+# Instead of asking the CNN about one crop around a random pixel, a grid of pixels (one every 'stride' pixels)
+# inside the pick box mask is scored :
+# * 'grid' mode (RgbCnn and RgbAndDepthCnn) : all the crops of the grid are scored in batches.
+# * 'dense' mode (RgbCnn only) : the model is converted to a fully-convolutional network (the fc layers become
+#   1x1 convolutions) which slides over the whole (upscaled) RGB image in one forward pass.
+# The result is a per-pixel success-probability map (NaN outside of the mask) and the list of the best pixels.
+
+THRESHOLD_ABOVE_TABLE = 10  # Same value as in tools.py, used to normalize the depth crops
+BIG_CROP_FACTOR = 2  # Depth crops are normalized on a crop twice bigger (like the BIG_CROP of tools.py), then center cropped
+
+
+class FullyConvRgbCnn(torch.nn.Module):
+    """ Fully-convolutional version of a RgbCnn with a ResNet backbone """
+    def __init__(self, model):
+        super().__init__()
+        layers = list(model.feature_extractor.children())
+        assert isinstance(layers[-1], torch.nn.AdaptiveAvgPool2d), 'dense mode needs a ResNet backbone'
+        self.trunk = torch.nn.Sequential(*layers[:-1])
+        image_size = model.hparams.input_shape[-1]
+        with torch.no_grad():
+            feature_map_size = self.trunk(torch.zeros(1, *model.hparams.input_shape)).shape[-1]
+        self.output_stride = image_size / feature_map_size  # in pixels of the upscaled image
+        self.pool = torch.nn.AvgPool2d(kernel_size=feature_map_size, stride=1)  # Same as the global pooling for one crop
+        convs = []
+        for linear in model.fc:
+            conv = torch.nn.Conv2d(linear.in_features, linear.out_features, kernel_size=1)
+            conv.weight.data.copy_(linear.weight.data.view(linear.out_features, linear.in_features, 1, 1))
+            conv.bias.data.copy_(linear.bias.data)
+            convs.append(conv)
+        self.fc = torch.nn.Sequential(*convs)
+
+    def forward(self, t):
+        """ Return the log probabilities map [batch_size, 2, h, w] """
+        t = self.pool(self.trunk(t))
+        return F.log_softmax(self.fc(t), dim=1)
+
+
+class GraspHeatmap:
+
+    def __init__(self, model, mode='grid', stride=8, batch_size=256, crop_width=ImageTools.CROP_WIDTH, crop_height=ImageTools.CROP_HEIGHT, rgb_and_depth=None):
+        """
+        model : a RgbCnn or RgbAndDepthCnn (or any predictor with the same outputs, then specify 'rgb_and_depth')
+        stride : distance in pixels between 2 scored pixels
+        """
+        self.model = model
+        self.rgb_and_depth = isinstance(model, RgbAndDepthCnn) if rgb_and_depth is None else rgb_and_depth
+        if mode == 'dense' and self.rgb_and_depth:
+            raise ValueError("'dense' mode is only available for RgbCnn (depth crops are normalized one by one)")
+        self.mode = mode
+        self.stride = stride
+        self.batch_size = batch_size
+        self.crop_width = crop_width
+        self.crop_height = crop_height
+        self.fully_conv_model = FullyConvRgbCnn(model).eval() if mode == 'dense' else None
+
+    def grid_points(self, mask):
+        """ Return the (x, y) pixels of the grid which are in the mask (and far enough from the image border) """
+        height, width = mask.shape[:2]
+        margin_x = self.crop_width * BIG_CROP_FACTOR // 2
+        margin_y = self.crop_height * BIG_CROP_FACTOR // 2
+        ys, xs = np.mgrid[margin_y:height - margin_y:self.stride, margin_x:width - margin_x:self.stride]
+        points = np.stack([xs.ravel(), ys.ravel()], axis=1)
+        return points[mask[points[:, 1], points[:, 0]] > 0]
+
+    def _crops(self, image, points, crop_width, crop_height):
+        """ Return a [nb_points, crop_height, crop_width, ...] array of crops centered on the points """
+        x0 = points[:, 0] - crop_width // 2
+        y0 = points[:, 1] - crop_height // 2
+        return np.stack([image[y:y + crop_height, x:x + crop_width] for x, y in zip(x0, y0)])
+
+    @torch.no_grad()
+    def score_points(self, rgb, depth, points, with_features=False):
+        """
+        Return the success probability of the crops centered on 'points' (array of (x, y) pixels), scored in batches
+        rgb : RGB image (numpy array [H, W, 3]), depth : raw 16 bits depth image (numpy array [H, W], in mm)
+        with_features : also return the [len(points), nb_features] tensor of the features given to the classifier (see active_sampling.py)
+        """
+        probs, features = [], []
+        for start in range(0, len(points), self.batch_size):
+            batch_points = points[start:start + self.batch_size]
+            rgb_crops = [ImageTools.numpy_to_pil(crop) for crop in self._crops(rgb, batch_points, self.crop_width, self.crop_height)]
+            inputs = [ImageTools.images_preprocessing(rgb_crops, Cnn.transforms(self.model)[0])]
+            if self.rgb_and_depth:
+                big_crops = self._crops(depth, batch_points, self.crop_width * BIG_CROP_FACTOR, self.crop_height * BIG_CROP_FACTOR)
+                depth_crops = [ImageTools.center_crop(ImageTools.numpy_to_pil(ImageTools.normalize_depth_crop(crop, THRESHOLD_ABOVE_TABLE)),
+                                                      self.crop_width, self.crop_height) for crop in big_crops]
+                inputs.append(RgbAndDepthCnn.depth_images_preprocessing(self.model, depth_crops))
+            batch_features, log_probs = self.model(*inputs)
+            probs.append(torch.exp(log_probs[:, 1]).cpu().numpy())
+            if with_features:
+                features.append(batch_features.cpu())
+        probs = np.concatenate(probs) if probs else np.zeros(0, dtype=np.float32)
+        if with_features:
+            return probs, torch.cat(features) if features else torch.zeros(0, 0)
+        return probs
+
+    @torch.no_grad()
+    def _dense_map(self, rgb, mask):
+        """ Success probability map computed by the fully-convolutional model over the bounding box of the mask """
+        ys, xs = np.nonzero(mask)
+        x_min, x_max, y_min, y_max = xs.min(), xs.max() + 1, ys.min(), ys.max() + 1
+        # Add half a crop around the box, like the crops of the grid mode
+        x_min, y_min = max(0, x_min - self.crop_width // 2), max(0, y_min - self.crop_height // 2)
+        x_max, y_max = min(rgb.shape[1], x_max + self.crop_width // 2), min(rgb.shape[0], y_max + self.crop_height // 2)
+        region = torch.from_numpy(np.ascontiguousarray(rgb[y_min:y_max, x_min:x_max])).permute(2, 0, 1).float().div(255)
+        scale = self.model.hparams.input_shape[-1] / self.crop_width  # crops are upscaled to the CNN input size
+        region = F.interpolate(region.unsqueeze(0), scale_factor=scale, mode='bilinear', align_corners=False)
+        region = ImageTools.tranform_normalize(region[0]).unsqueeze(0)
+        log_probs = self.fully_conv_model(region)
+        # Each output cell is the score of a crop, the first one is centered on (crop_width/2, crop_height/2) of the region
+        probs = torch.exp(log_probs[:, 1:2])
+        out_h = round(probs.shape[-2] * self.fully_conv_model.output_stride / scale)
+        out_w = round(probs.shape[-1] * self.fully_conv_model.output_stride / scale)
+        probs = F.interpolate(probs, size=(out_h, out_w), mode='bilinear', align_corners=False)[0, 0].numpy()
+        prob_map = np.full(mask.shape[:2], np.nan, dtype=np.float32)
+        top, left = y_min + self.crop_height // 2, x_min + self.crop_width // 2
+        h = min(out_h, prob_map.shape[0] - top)
+        w = min(out_w, prob_map.shape[1] - left)
+        prob_map[top:top + h, left:left + w] = probs[:h, :w]
+        prob_map[mask == 0] = np.nan
+        return prob_map
+
+    def compute(self, rgb, depth, mask):
+        """
+        Compute the success probability map of the pixels of the mask.
+        Return (prob_map, points, probs) : the [H, W] map (NaN outside of the mask), the scored (x, y) pixels and their probabilities
+        """
+        points = self.grid_points(mask)
+        if self.mode == 'dense':
+            prob_map = self._dense_map(rgb, mask)
+            probs = prob_map[points[:, 1], points[:, 0]]
+            return prob_map, points, probs
+        probs = self.score_points(rgb, depth, points)
+        prob_map = np.full(mask.shape[:2], np.nan, dtype=np.float32)
+        half = self.stride // 2
+        for (x, y), prob in zip(points, probs):  # Each scored pixel gives its probability to its grid cell
+            prob_map[y - half:y - half + self.stride, x - half:x - half + self.stride] = prob
+        prob_map[mask == 0] = np.nan
+        return prob_map, points, probs
+
+    @staticmethod
+    def best_points(points, probs, n):
+        """ Return the n (x, y) pixels with the highest success probabilities, best first """
+        valid = ~np.isnan(probs)
+        points, probs = points[valid], probs[valid]
+        best = np.argsort(-probs)[:n]
+        return points[best], probs[best]
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import time
+    import cv2
+    import matplotlib.pyplot as plt
+
+    parser = argparse.ArgumentParser(description='Compute the grasp-success heatmap of a RGB (and depth) image.')
+    parser.add_argument('ckpt_file', type=str, help='model checkpoint file (.ckpt)')
+    parser.add_argument('rgb_file', type=str, help='RGB image file')
+    parser.add_argument('--depth_file', default=None, type=str, help='16 bits depth image file (needed for a RgbAndDepthCnn)')
+    parser.add_argument('--mode', default='grid', choices=['grid', 'dense'], help='grid of crops or fully-convolutional model')
+    parser.add_argument('-s', '--stride', default=8, type=int, help='distance in pixels between 2 scored pixels')
+    parser.add_argument('-n', '--nb_best', default=10, type=int, help='number of best pixels to display')
+    args = parser.parse_args()
+
+    if args.depth_file:
+        model = RgbAndDepthCnn.load_ckpt_model_file(args.ckpt_file)
+        depth = cv2.imread(args.depth_file, cv2.IMREAD_ANYDEPTH)
+    else:
+        from raiv_libraries.rgb_cnn import RgbCnn
+        model = RgbCnn.load_ckpt_model_file(args.ckpt_file)
+        depth = None
+    rgb = cv2.cvtColor(cv2.imread(args.rgb_file), cv2.COLOR_BGR2RGB)
+    mask = np.ones(rgb.shape[:2], dtype=np.uint8)
+    heatmap = GraspHeatmap(model, mode=args.mode, stride=args.stride)
+    start = time.time()
+    prob_map, points, probs = heatmap.compute(rgb, depth, mask)
+    print(f'{len(points)} pixels scored in {time.time() - start:.2f} seconds')
+    best_points, best_probs = GraspHeatmap.best_points(points, probs, args.nb_best)
+    plt.imshow(rgb)
+    plt.imshow(prob_map, alpha=0.5, cmap='jet', vmin=0, vmax=1)
+    plt.scatter(best_points[:, 0], best_points[:, 1], marker='x', color='white')
+    plt.colorbar()
+    plt.show()
@@ -0,0 +1,152 @@
+import os
+import csv
+import random
+from pathlib import Path
+from datetime import datetime
+
+# Build a balanced subset of an image bank (<bank>/<rgb and depth>/<success and fail>/*.png) with N images per class.
+# Only the images which have both a RGB and a depth file (same name) are used, so the subset only contains pairs.
+# The subset is a folder tree of hard links or symbolic links (no data is copied) or just a manifest file
+# which can be loaded with RgbAndDepthImageDataset.from_manifest().
+
+CLASSES = ['fail', 'success']
+MANIFEST_FILE = 'manifest.csv'
+LINK_MODES = ['hardlink', 'symlink', 'manifest']
+SELECTION_MODES = ['first', 'random']
+
+
+def image_date(image_path):
+    """
+    Return the date of the pick which has produced this image.
+    Image names look like '<str(datetime.now())>_<rotation index>.png' (see tools.save_pil_images),
+    if the name can't be parsed, the modification time of the file is used
+    """
+    prefix = Path(image_path).stem.rsplit('_', 1)[0]
+    for date_format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(prefix, date_format)
+        except ValueError:
+            pass
+    return datetime.fromtimestamp(os.path.getmtime(image_path))
+
+
+def list_pairs(bank_folder, class_name):
+    """ Return the sorted list of image names present in both rgb/<class_name> and depth/<class_name> folders """
+    bank_folder = Path(bank_folder)
+    rgb_names = {p.name for p in (bank_folder / 'rgb' / class_name).glob('*.png')}
+    depth_names = {p.name for p in (bank_folder / 'depth' / class_name).glob('*.png')}
+    nb_unpaired = len(rgb_names ^ depth_names)
+    if nb_unpaired:
+        print(f'{class_name} : {nb_unpaired} images without their rgb or depth pair are ignored')
+    return sorted(rgb_names & depth_names)
+
+
+def select_images(bank_folder, class_name, nb, selection='first', seed=None, date_min=None, date_max=None):
+    """
+    Select 'nb' image names of the 'class_name' class.
+    selection : 'first' (the first names in alphabetical i.e. chronological order) or 'random' (reproducible if 'seed' is given)
+    date_min, date_max : optional datetime bounds of the pick date
+    """
+    names = list_pairs(bank_folder, class_name)
+    if date_min is not None or date_max is not None:
+        rgb_folder = Path(bank_folder) / 'rgb' / class_name
+        dates = [(name, image_date(rgb_folder / name)) for name in names]
+        names = [name for name, date in dates
+                 if (date_min is None or date >= date_min) and (date_max is None or date <= date_max)]
+    if selection == 'random':
+        names = random.Random(seed).sample(names, min(nb, len(names)))
+    if len(names) < nb:
+        print(f'{class_name} : only {len(names)} images available ({nb} asked)')
+    return names[:nb]
+
+
+def remove_subset(dst_folder):
+    """
+    Remove a subset built by build_subset() : only the links listed in its manifest, the manifest and the folders
+    which are then empty are removed. Raise FileExistsError if 'dst_folder' has no manifest or other files.
+    """
+    dst_folder = Path(dst_folder).absolute()
+    manifest_file = dst_folder / MANIFEST_FILE
+    if not manifest_file.is_file():
+        raise FileExistsError(f'{dst_folder} is not empty and is not a subset (no {MANIFEST_FILE}), it is not removed')
+    with open(manifest_file, newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for image_type in ['rgb', 'depth']:
+            link = Path(row[image_type])
+            if link.parent.parent.parent == dst_folder:  # In 'manifest' mode, the paths are the images of the bank
+                link.unlink(missing_ok=True)
+    manifest_file.unlink()
+    for image_type in ['rgb', 'depth']:
+        for folder in [dst_folder / image_type / class_name for class_name in CLASSES] + [dst_folder / image_type]:
+            if folder.is_dir() and not any(folder.iterdir()):
+                folder.rmdir()
+    if any(dst_folder.iterdir()):
+        raise FileExistsError(f'{dst_folder} contains files which are not in its manifest, they are not removed')
+
+
+def build_subset(bank_folder, dst_folder, nb_per_class, link_mode='hardlink', selection='first', seed=None,
+                 date_min=None, date_max=None, force=False):
+    """
+    Build a balanced subset of 'bank_folder' in 'dst_folder' with 'nb_per_class' rgb/depth pairs per class.
+    link_mode : 'hardlink', 'symlink' or 'manifest' (only the manifest file is written)
+    force : replace a previous subset of 'dst_folder' (see remove_subset), a folder which is not a subset is never removed
+    Return the path of the manifest file
+    """
+    bank_folder = Path(bank_folder).resolve()
+    dst_folder = Path(dst_folder)
+    if dst_folder.exists() and any(dst_folder.iterdir()):
+        if not force:
+            raise FileExistsError(f'{dst_folder} is not empty, use force=True to replace it')
+        remove_subset(dst_folder)
+    dst_folder.mkdir(parents=True, exist_ok=True)
+    selected = {class_name: select_images(bank_folder, class_name, nb_per_class, selection, seed, date_min, date_max)
+                for class_name in CLASSES}
+    nb_images = min(len(names) for names in selected.values())  # Same number of images for each class
+    rows = []
+    for class_name in CLASSES:
+        for name in sorted(selected[class_name][:nb_images]):
+            row = {'class': class_name}
+            for image_type in ['rgb', 'depth']:
+                src = bank_folder / image_type / class_name / name
+                if link_mode == 'manifest':
+                    row[image_type] = str(src)
+                    continue
+                dst = dst_folder / image_type / class_name / name
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                if link_mode == 'hardlink':
+                    os.link(src, dst)
+                else:
+                    os.symlink(src, dst)
+                row[image_type] = str(dst.absolute())
+            rows.append(row)
+    manifest_file = dst_folder / MANIFEST_FILE
+    with open(manifest_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['class', 'rgb', 'depth'])
+        writer.writeheader()
+        writer.writerows(rows)
+    return manifest_file
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Build a balanced subset (N rgb/depth pairs per class) of an image bank with links or a manifest file.')
+    parser.add_argument('bank_folder', type=str, help='image bank folder with <rgb and depth> / <fail and success> sub-folders')
+    parser.add_argument('dst_folder', type=str, help='folder of the subset')
+    parser.add_argument('-n', '--nb_per_class', default=250, type=int, help='number of pairs per class')
+    parser.add_argument('-l', '--link_mode', default='hardlink', choices=LINK_MODES, help='how the subset is built')
+    parser.add_argument('--selection', default='first', choices=SELECTION_MODES, help='the first images (chronological order) or random ones')
+    parser.add_argument('--seed', default=None, type=int, help='Optionnal seed for the random selection')
+    parser.add_argument('--date_min', default=None, type=datetime.fromisoformat, help='Optionnal minimal date of the picks (ex : 2022-11-21 or "2022-11-21 14:00")')
+    parser.add_argument('--date_max', default=None, type=datetime.fromisoformat, help='Optionnal maximal date of the picks')
+    parser.add_argument('-f', '--force', default=False, action='store_true', help='replace the previous subset of the destination folder (only the links of its manifest are removed)')
+    args = parser.parse_args()
+
+    start = time.time()
+    manifest = build_subset(args.bank_folder, args.dst_folder, args.nb_per_class, link_mode=args.link_mode,
+                            selection=args.selection, seed=args.seed, date_min=args.date_min,
+                            date_max=args.date_max, force=args.force)
+    print(f'Subset built in {(time.time() - start) * 1000:.0f} ms, manifest : {manifest}')
@@ -11,13 +11,45 @@ from raiv_libraries.image_tools import ImageTools
 
 class ImageDataModule(pl.LightningDataModule):
 
-    def __init__(self, dataset, class_subset, batch_size=8, dataset_size=None, num_workers=8):
+    def __init__(self, dataset, class_subset, batch_size=8, dataset_size=None, num_workers=8,
+                 transform=ImageTools.transform_image, depth_transform=None, nb_folds=None, fold=0, indices=None):
+        """
+        depth_transform : transform of the depth images of a RgbAndDepthSubset (default : 'transform')
+        indices : if given, only these images of the dataset are used (ex : new images + replay buffer, see continual_training.py)
+        nb_folds : if given, k-fold cross-validation split (see stratified_folds) : 'fold' is the test split,
+                   the next fold is the validation split and the other ones are the train split
+        """
         super().__init__()
         self.trains_dims = None
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.dataset_size = dataset_size
         #self.classes = dataset.classes
+        samples = self._select_samples(dataset) if indices is None else [int(i) for i in indices]
+        if nb_folds is None:
+            subset = Subset(dataset, indices=samples)
+            train_size = int(0.7 * len(subset))
+            val_size = int(0.5 * (len(subset) - train_size))
+            test_size = int(len(subset) - train_size - val_size)
+            train_data, val_data, test_data = random_split(subset,
+                                                           [train_size, val_size, test_size],
+                                                           generator=torch.Generator().manual_seed(42))
+        else:
+            samples = np.sort(samples)  # The folds don't depend on the (not seeded) order of the samples
+            folds = [samples[positions] for positions in ImageDataModule.stratified_folds(np.asarray(dataset.targets)[samples], nb_folds)]
+            val_fold = (fold + 1) % nb_folds
+            train_indices = np.concatenate([indices for i, indices in enumerate(folds) if i not in (fold, val_fold)])
+            train_data, val_data, test_data = [Subset(dataset, indices=indices.tolist()) for indices in [train_indices, folds[val_fold], folds[fold]]]
+        print("Len Train Data", len(train_data))
+        print("Len Val Data", len(val_data))
+        print("Len Test Data", len(test_data))
+        subset_kwargs = {} if depth_transform is None else {'depth_transform': depth_transform}
+        self.train_data = class_subset(train_data, transform=transform, **subset_kwargs)
+        self.val_data = class_subset(val_data, transform=transform, **subset_kwargs)
+        self.test_data = class_subset(test_data, transform=transform, **subset_kwargs)
+
+    def _select_samples(self, dataset):
+        """ Return the list of the indices of the images of 'dataset' used by the data module """
         if self.dataset_size is None:
             weight_samples = self._calculate_weights(dataset)
             # Select a subset of the images
@@ -33,19 +65,39 @@ class ImageDataModule(pl.LightningDataModule):
             success_indices = total_indices[class_count[0]:class_count[0]+dataset_size]
             samples = fail_indices + success_indices
             np.random.shuffle(samples)
-        subset = Subset(dataset, indices=samples)
-        train_size = int(0.7 * len(subset))
-        val_size = int(0.5 * (len(subset) - train_size))
-        test_size = int(len(subset) - train_size - val_size)
-        train_data, val_data, test_data = random_split(subset,
-                                                       [train_size, val_size, test_size],
-                                                       generator=torch.Generator().manual_seed(42))
-        print("Len Train Data", len(train_data))
-        print("Len Val Data", len(val_data))
-        print("Len Test Data", len(test_data))
-        self.train_data = class_subset(train_data, transform=ImageTools.transform_image)
-        self.val_data = class_subset(val_data, transform=ImageTools.transform_image)
-        self.test_data = class_subset(test_data, transform=ImageTools.transform_image)
+        return samples
+
+    @staticmethod
+    def stratified_folds(targets, nb_folds, seed=42):
+        """
+        Split the positions of 'targets' (array of the classes) in 'nb_folds' folds with the same ratio of each class.
+        Return the list of the position arrays of the folds.
+        """
+        rng = np.random.default_rng(seed)
+        folds = [[] for _ in range(nb_folds)]
+        for target in np.unique(targets):
+            positions = rng.permutation(np.flatnonzero(targets == target))
+            for fold, chunk in zip(folds, np.array_split(positions, nb_folds)):
+                fold.append(chunk)
+        return [np.sort(np.concatenate(fold)) for fold in folds]
+
+    @staticmethod
+    def from_images_folder(images_folder, rgb_and_depth=False, depth_channels=3, image_size=ImageTools.IMAGE_SIZE_FOR_NN, **kwargs):
+        """
+        Build the ImageDataModule from an images folder : <fail and success> sub-folders for RGB images or
+        <rgb and depth> / <fail and success> sub-folders if rgb_and_depth is True
+        depth_channels : 1 to keep the depth images in grayscale (RgbAndDepthCnn with depth_channels=1)
+        image_size : size of the images given to the CNN (hparams.input_shape[-1])
+        """
+        kwargs.setdefault('transform', ImageTools.transforms_for_size(image_size)[1])
+        if rgb_and_depth:
+            from raiv_libraries.rgb_and_depth_image_dataset import RgbAndDepthImageDataset
+            dataset = RgbAndDepthImageDataset(images_folder + '/rgb', images_folder + '/depth', depth_channels=depth_channels)
+            if depth_channels == 1:
+                kwargs.setdefault('depth_transform', ImageTools.transforms_for_size(image_size, depth=True)[1])
+            return ImageDataModule(dataset, RgbAndDepthSubset, **kwargs)
+        dataset = torchvision.datasets.ImageFolder(images_folder)
+        return ImageDataModule(dataset, RgbSubset, **kwargs)
 
     def train_dataloader(self, num_workers=None):
         return self._generate_dataloader(self.train_data, num_workers)
@@ -109,15 +161,18 @@ class RgbSubset(Dataset):
 
 
 class RgbAndDepthSubset(Dataset):
-    def __init__(self, subset, transform=None):
+    def __init__(self, subset, transform=None, depth_transform=None):
+        """ depth_transform : transform of the depth images, 'transform' is used if None """
         self.subset = subset
         self.transform = transform
+        self.depth_transform = depth_transform or transform
 
     def __getitem__(self, index):
         rgb, depth, y , lst_files = self.subset[index]
         if self.transform:
             rgb = self.transform(rgb)
-            depth = self.transform(depth)
+        if self.depth_transform:
+            depth = self.depth_transform(depth)
         return rgb, depth, y, lst_files
 
     def __len__(self):
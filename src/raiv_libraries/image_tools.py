@@ -1,3 +1,4 @@
+import functools
 import torchvision.transforms as transforms
 from torchvision.transforms.functional import crop
 import cv2
@@ -16,6 +17,7 @@ class ImageTools:
     CROP_HEIGHT = 50
     IMAGE_SIZE_FOR_NN = 224
     IMAGE_SIZE_BEFORE_CROP = 256
+    SMALL_IMAGE_SIZE_FOR_NN = 64  # Size of the images given to the small input CNNs (close to the crop size)
     INITIAL_WIDTH = 640
     INITIAL_HEIGHT = 480
 
@@ -47,6 +49,22 @@ class ImageTools:
         tranform_normalize
     ])
 
+    # Same transforms for the 1 channel depth images (grayscale 'L' PIL images), normalized with the mean of the RGB statistics
+    transform_normalize_depth = transforms.Normalize(mean=[0.449], std=[0.226])
+
+    transform_depth = transforms.Compose([
+        transforms.Resize(size=IMAGE_SIZE_BEFORE_CROP),
+        transforms.CenterCrop(size=IMAGE_SIZE_FOR_NN),
+        transforms.ToTensor(),
+        transform_normalize_depth
+    ])
+
+    transform_depth_image = transforms.Compose([
+        transforms.Resize(size=IMAGE_SIZE_FOR_NN),
+        transforms.ToTensor(),
+        transform_normalize_depth
+    ])
+
 
     # Used to correctly display images
     inv_trans = transforms.Compose([transforms.Normalize(mean=[0., 0., 0.],
@@ -56,11 +74,61 @@ class ImageTools:
                                     ])
 
     @staticmethod
-    def image_preprocessing(image):
-        image_tensor = ImageTools.transform(image).float()
+    @functools.lru_cache(maxsize=None)
+    def transforms_for_size(image_size, depth=False):
+        """
+        Return (inference transform, training transform) for images of 'image_size' pixels given to the CNN :
+        (transform, transform_image) or (transform_depth, transform_depth_image) if depth is True, for 224 pixels
+        depth : True for the 1 channel depth images
+        """
+        if image_size == ImageTools.IMAGE_SIZE_FOR_NN:
+            if depth:
+                return ImageTools.transform_depth, ImageTools.transform_depth_image
+            return ImageTools.transform, ImageTools.transform_image
+        normalize = ImageTools.transform_normalize_depth if depth else ImageTools.tranform_normalize
+        size_before_crop = round(image_size * ImageTools.IMAGE_SIZE_BEFORE_CROP / ImageTools.IMAGE_SIZE_FOR_NN)
+        inference_transform = transforms.Compose([
+            transforms.Resize(size=size_before_crop),
+            transforms.CenterCrop(size=image_size),
+            transforms.ToTensor(),
+            normalize
+        ])
+        training_transform = transforms.Compose([
+            transforms.Resize(size=image_size),
+            transforms.ToTensor(),
+            normalize
+        ])
+        return inference_transform, training_transform
+
+    @staticmethod
+    def image_preprocessing(image, transform=None):
+        image_tensor = (transform or ImageTools.transform)(image).float()
         image = image_tensor.unsqueeze(0)
         return image
 
+    @staticmethod
+    def images_preprocessing(images, transform=None):
+        """ Same as image_preprocessing() for a list of images, return a [len(images), C, H, W] tensor """
+        transform = transform or ImageTools.transform
+        return torch.stack([transform(image).float() for image in images])
+
+    @staticmethod
+    def normalize_depth_crop(depth_crop_cv, threshold_above_table=10):
+        """
+        Convert a 16 bits depth crop (numpy array, in mm) to the 8 bits depth image used by the CNNs :
+        the table (and the pixels less than 'threshold_above_table' mm above it) becomes white, the objects are stretched in [0, 255]
+        """
+        # Calculate the histogram of the depth image
+        histogram = cv2.calcHist([depth_crop_cv], [0], None, [1000], [1, 1000])
+        # Take the index with the maximum values (i.e. the value of the table's distance to the camera) e
+        # Every pixel with a value under the table value +BOX_ELEVATION milimeters is set to zero.
+        distance_camera_to_table = histogram.argmax()
+        image_depth_without_table = np.where(depth_crop_cv == 0, distance_camera_to_table, depth_crop_cv)
+        image_depth_without_table = np.where(image_depth_without_table >= distance_camera_to_table - threshold_above_table, distance_camera_to_table,
+                                             image_depth_without_table)
+        cv2.normalize(image_depth_without_table, image_depth_without_table, 0, 255, cv2.NORM_MINMAX)
+        return np.round(image_depth_without_table).astype(np.uint8)
+
     @staticmethod
     def crop_xy(image, x_center, y_center, crop_width, crop_height):
         """ Crop image PIL at position (x_center, y_center) and with size (WIDTH,HEIGHT) """
@@ -81,6 +149,8 @@ class ImageTools:
         size = (msg.width, msg.height)  # Image size
         if msg.encoding == '8UC3' or msg.encoding == 'rgb8':
             img = Image.frombytes('RGB', size, msg.data)  # sensor_msg Image to PILImage
+        elif msg.encoding == '8UC1' or msg.encoding == 'mono8':  # Typically : normalized depth crop
+            img = Image.frombytes('L', size, msg.data)
         elif msg.encoding == '16UC1':  # Typically : depth image
             img = Image.frombytes('I;16', size, msg.data)
         return img
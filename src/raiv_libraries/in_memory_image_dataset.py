@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+
+class InMemoryImageDataset(Dataset):
+    """
+    Dataset of images decoded only once and kept in numpy arrays (uint8), with the same items as
+    datasets.ImageFolder (rgb, class_id) or RgbAndDepthImageDataset (rgb, depth, class_id, files).
+    The arrays can be shared between processes (ex : Ray object store) without copying them.
+    All the images must have the same size (use resize_image.py).
+    """
+
+    def __init__(self, arrays, depth_channels=3):
+        """
+        arrays : dict returned by InMemoryImageDataset.load_arrays()
+        depth_channels : 3 to have RGB depth images (like the RGB images), 1 to have grayscale depth images
+        """
+        self.arrays = arrays
+        self.depth_channels = depth_channels
+        self.rgb = arrays['rgb']
+        self.depth = arrays.get('depth')
+        self.files = arrays['files']
+        self.targets = arrays['targets'].tolist()  # To have the same attribut that ImageFolder have
+
+    @staticmethod
+    def load_arrays(images_folder, rgb_and_depth=False, nb_threads=8):
+        """
+        Decode all the images of 'images_folder' (<fail and success> sub-folders, or <rgb and depth> / <fail and success>
+        if rgb_and_depth is True) and return them in a dict of numpy arrays
+        """
+        images_folder = Path(images_folder)
+        rgb_folder = images_folder / 'rgb' if rgb_and_depth else images_folder
+        rgb_files, targets = [], []
+        for class_id, class_name in enumerate(['fail', 'success']):
+            class_files = sorted(p for p in (rgb_folder / class_name).iterdir() if p.is_file())
+            rgb_files += class_files
+            targets += [class_id] * len(class_files)
+        with ThreadPoolExecutor(nb_threads) as executor:
+            rgb_images = list(executor.map(lambda f: np.asarray(Image.open(f).convert('RGB')), rgb_files))
+            arrays = {'rgb': InMemoryImageDataset._stack(rgb_images), 'targets': np.array(targets, dtype=np.int64)}
+            if rgb_and_depth:
+                depth_files = [images_folder / 'depth' / f.parent.name / f.name for f in rgb_files]
+                depth_images = list(executor.map(lambda f: np.asarray(Image.open(f).convert('L')), depth_files))
+                arrays['depth'] = InMemoryImageDataset._stack(depth_images)
+                arrays['files'] = [[str(r), str(d)] for r, d in zip(rgb_files, depth_files)]
+            else:
+                arrays['files'] = [str(f) for f in rgb_files]
+        return arrays
+
+    @staticmethod
+    def _stack(images):
+        shapes = {image.shape for image in images}
+        if len(shapes) > 1:
+            raise ValueError(f'All the images must have the same size to be kept in memory, found : {shapes}')
+        return np.stack(images)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+        image_rgb = Image.fromarray(self.rgb[idx])
+        class_id = self.targets[idx]
+        if self.depth is None:
+            return image_rgb, class_id
+        image_depth = Image.fromarray(self.depth[idx])
+        if self.depth_channels == 3:
+            image_depth = image_depth.convert("RGB")  # To have a 3 channels image from a grayscale one
+        return image_rgb, image_depth, class_id, self.files[idx]
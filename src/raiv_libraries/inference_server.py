@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+import io
+import json
+import os
+import queue
+import socketserver
+import struct
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+import numpy as np
+import torch
+from raiv_libraries.image_tools import ImageTools
+
+# Grasp inference server : the model is loaded once and the crop-scoring requests of all the consumers are coalesced
+# in micro-batches (a batch is run when it has max_batch_size crops or when its first request has waited max_wait_ms).
+# Two front-ends :
+# * ROS node : '/predict_grasp' service (PredictGrasp.srv), diagnostics published on '/diagnostics'
+# * local socket (no ROS) : messages are 8 bytes length + np.savez payload (no pickle), see InferenceClient
+# Diagnostics : queue depth, batch size histogram and latency percentiles (time between the request and its result).
+# Hot reload : the checkpoint file is watched, when it is replaced (see continual_training.publish) the new model is
+# loaded in the background and used from the next batch, the requests are never interrupted.
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def make_predict_function(model, rgb_and_depth=True, tta=1):
+    """
+    Return a function (pil_rgb_imgs, pil_depth_imgs) -> success probabilities (numpy array) using the predict methods of 'model'
+    tta : number of test time augmentation variants of each crop (see cnn.TTA_VARIANTS)
+    """
+    if rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn
+        return lambda rgbs, depths: RgbAndDepthCnn.predict_from_pil_rgb_and_depth_images_batch(model, rgbs, depths, tta)[:, 1].numpy()
+    from raiv_libraries.rgb_cnn import RgbCnn
+    return lambda rgbs, depths: RgbCnn.predict_from_pil_rgb_images(model, rgbs, tta)[:, 1].numpy()
+
+
+class InferenceStats:
+    """ Diagnostics of the MicroBatcher """
+
+    def __init__(self, nb_latencies=1000):
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=nb_latencies)  # in ms, the last ones
+        self.nb_requests = 0
+        self.nb_crops = 0
+
+    def add_batch(self, batch_size, latencies):
+        with self.lock:
+            self.batch_sizes[batch_size] += 1
+            self.latencies.extend(latencies)
+            self.nb_requests += len(latencies)
+            self.nb_crops += batch_size
+
+    def snapshot(self, queue_depth=0):
+        """ Return a dict with the diagnostics """
+        with self.lock:
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            return {'queue_depth': queue_depth,
+                    'nb_requests': self.nb_requests,
+                    'nb_crops': self.nb_crops,
+                    'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                    'latency_ms': {f'p{p}': float(np.percentile(latencies, p)) for p in LATENCY_PERCENTILES}}
+
+
+class MicroBatcher:
+    """ Coalesce the concurrent requests in micro-batches run by one worker thread """
+
+    def __init__(self, predict_function, max_batch_size=64, max_wait_ms=5.0, needs_depth=False):
+        """ needs_depth : the model needs the depth crops (RgbAndDepthCnn), requests without them are rejected """
+        self.predict_function = predict_function
+        self.needs_depth = needs_depth
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.stats = InferenceStats()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, pil_rgb_imgs, pil_depth_imgs=None):
+        """
+        Return a Future whose result is the numpy array of the success probabilities of the crops.
+        An invalid request fails alone (ValueError) before being batched : the crops of a batch are paired by position,
+        so a request with missing depth crops would give the results of wrong crops to the other requests of its batch.
+        """
+        future = Future()
+        if pil_depth_imgs and len(pil_depth_imgs) != len(pil_rgb_imgs):
+            future.set_exception(ValueError(f'{len(pil_rgb_imgs)} RGB crops but {len(pil_depth_imgs)} depth crops'))
+        elif self.needs_depth and len(pil_rgb_imgs) and not pil_depth_imgs:
+            future.set_exception(ValueError('The model needs the depth crops'))
+        else:
+            self.requests.put((pil_rgb_imgs, pil_depth_imgs or [None] * len(pil_rgb_imgs), future, time.perf_counter()))
+        return future
+
+    def predict(self, pil_rgb_imgs, pil_depth_imgs=None):
+        return self.submit(pil_rgb_imgs, pil_depth_imgs).result()
+
+    def set_predict_function(self, predict_function):
+        """ The worker uses the new function from its next batch (the running batch ends with the old one) """
+        self.predict_function = predict_function
+
+    def queue_depth(self):
+        """ Number of requests waiting for a batch """
+        return self.requests.qsize()
+
+    def diagnostics(self):
+        return self.stats.snapshot(self.queue_depth())
+
+    def _next_batch(self):
+        """ Wait for a request, then take the next ones until the batch is full or the first request has waited max_wait """
+        batch = [self.requests.get()]
+        nb_crops = len(batch[0][0])
+        deadline = batch[0][3] + self.max_wait
+        while nb_crops < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            batch.append(request)
+            nb_crops += len(request[0])
+        return batch
+
+    def _run(self):
+        torch.set_grad_enabled(False)
+        while True:
+            batch = self._next_batch()
+            rgbs = [img for request in batch for img in request[0]]
+            depths = [img for request in batch for img in request[1]]
+            try:
+                probs = self.predict_function(rgbs, depths) if rgbs else np.zeros(0, dtype=np.float32)
+            except Exception as e:
+                for request in batch:
+                    request[2].set_exception(e)
+                continue
+            now = time.perf_counter()
+            start = 0
+            for request in batch:
+                request[2].set_result(probs[start:start + len(request[0])])
+                start += len(request[0])
+            self.stats.add_batch(len(rgbs), [(now - request[3]) * 1000 for request in batch])
+
+
+class CheckpointWatcher:
+    """ Reload the model of a MicroBatcher when its checkpoint file is replaced """
+
+    def __init__(self, batcher, ckpt_file, rgb_and_depth=True, tta=1, period=5.0):
+        self.batcher = batcher
+        self.ckpt_file = ckpt_file
+        self.rgb_and_depth = rgb_and_depth
+        self.tta = tta
+        self.period = period
+        self.signature = self._signature()
+        self.nb_reloads = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _signature(self):
+        """ (inode, modification time) : os.replace gives a new inode, a copy over the file a new modification time """
+        try:
+            stat = os.stat(self.ckpt_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _run(self):
+        while True:
+            time.sleep(self.period)
+            signature = self._signature()
+            if signature is None or signature == self.signature:
+                continue
+            self.signature = signature
+            try:
+                model = load_model(self.ckpt_file, self.rgb_and_depth)
+            except Exception as e:  # Keep the current model
+                print(f'Reload of {self.ckpt_file} failed : {e}')
+                continue
+            self.batcher.set_predict_function(make_predict_function(model, self.rgb_and_depth, self.tta))
+            self.nb_reloads += 1
+            print(f'{self.ckpt_file} reloaded')
+
+
+###################################################################################################################
+# Local socket front-end
+###################################################################################################################
+
+def _send_arrays(sock, **arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    payload = buffer.getvalue()
+    sock.sendall(struct.pack('!Q', len(payload)) + payload)
+
+
+def _receive_arrays(sock):
+    """ Return the dict of arrays of the next message, None if the connection is closed """
+    header = _receive_exactly(sock, 8)
+    if header is None:
+        return None
+    payload = _receive_exactly(sock, struct.unpack('!Q', header)[0])
+    with np.load(io.BytesIO(payload), allow_pickle=False) as arrays:
+        return {key: arrays[key] for key in arrays.files}
+
+
+def _receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        batcher = self.server.batcher
+        while True:
+            arrays = _receive_arrays(self.request)
+            if arrays is None:
+                break
+            if 'stats' in arrays:
+                _send_arrays(self.request, stats=np.array(json.dumps(batcher.diagnostics())))
+                continue
+            rgbs = [ImageTools.numpy_to_pil(rgb) for rgb in arrays['rgb']]
+            depths = [ImageTools.numpy_to_pil(depth) for depth in arrays['depth']] if 'depth' in arrays else None
+            try:
+                _send_arrays(self.request, probs=batcher.predict(rgbs, depths).astype(np.float32))
+            except Exception as e:
+                _send_arrays(self.request, error=np.array(str(e)))
+
+
+class SocketInferenceServer(socketserver.ThreadingTCPServer):
+    """ One thread per connection, all the connections share the MicroBatcher """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, batcher, host='127.0.0.1', port=5555):
+        self.batcher = batcher
+        super().__init__((host, port), _RequestHandler)
+
+
+class InferenceClient:
+    """ Client of the SocketInferenceServer """
+
+    def __init__(self, host='127.0.0.1', port=5555):
+        import socket
+        self.sock = socket.create_connection((host, port))
+
+    def predict(self, rgb_crops, depth_crops=None):
+        """
+        rgb_crops : uint8 array [N, H, W, 3], depth_crops : optional uint8 array [N, H, W] (normalized depth crops)
+        Return the success probabilities (array [N])
+        """
+        arrays = {'rgb': np.asarray(rgb_crops, dtype=np.uint8)}
+        if depth_crops is not None:
+            arrays['depth'] = np.asarray(depth_crops, dtype=np.uint8)
+        _send_arrays(self.sock, **arrays)
+        response = _receive_arrays(self.sock)
+        if 'error' in response:
+            raise RuntimeError(str(response['error']))
+        return response['probs']
+
+    def stats(self):
+        _send_arrays(self.sock, stats=np.zeros(0))
+        return json.loads(str(_receive_arrays(self.sock)['stats']))
+
+    def close(self):
+        self.sock.close()
+
+
+###################################################################################################################
+# ROS front-end
+###################################################################################################################
+
+class GraspInferenceNode:
+    """ '/predict_grasp' service : rospy runs each request in its own thread, so the concurrent requests are coalesced """
+
+    def __init__(self, batcher, diagnostics_period=1.0):
+        import rospy
+        from diagnostic_msgs.msg import DiagnosticArray
+        from raiv_libraries.srv import PredictGrasp
+        self.batcher = batcher
+        rospy.Service('/predict_grasp', PredictGrasp, self.process_service)
+        self.diagnostics_publisher = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=1)
+        rospy.Timer(rospy.Duration(diagnostics_period), self.publish_diagnostics)
+
+    def process_service(self, req):
+        from raiv_libraries.srv import PredictGraspResponse
+        rgbs = [ImageTools.ros_msg_to_pil(msg) for msg in req.rgb_crops]
+        depths = [ImageTools.ros_msg_to_pil(msg) for msg in req.depth_crops] or None
+        return PredictGraspResponse(success_probs=self.batcher.predict(rgbs, depths).tolist())
+
+    def publish_diagnostics(self, event=None):
+        import rospy
+        from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+        diagnostics = self.batcher.diagnostics()
+        values = [KeyValue('queue_depth', str(diagnostics['queue_depth'])),
+                  KeyValue('nb_requests', str(diagnostics['nb_requests'])),
+                  KeyValue('nb_crops', str(diagnostics['nb_crops'])),
+                  KeyValue('batch_sizes', json.dumps(diagnostics['batch_sizes']))]
+        values += [KeyValue(f'latency_{key}_ms', f'{value:.2f}') for key, value in diagnostics['latency_ms'].items()]
+        status = DiagnosticStatus(level=DiagnosticStatus.OK, name='grasp_inference_server', message='running', values=values)
+        array = DiagnosticArray(status=[status])
+        array.header.stamp = rospy.Time.now()
+        self.diagnostics_publisher.publish(array)
+
+
+def load_model(ckpt_file, rgb_and_depth=True):
+    if rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn
+        return RgbAndDepthCnn.load_ckpt_model_file(ckpt_file)
+    from raiv_libraries.rgb_cnn import RgbCnn
+    return RgbCnn.load_ckpt_model_file(ckpt_file)
+
+
+###################################################################################################################
+# Main program
+###################################################################################################################
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Grasp inference server : micro-batches of the crop-scoring requests (ROS service or local socket).')
+    parser.add_argument('ckpt_file', type=str, help='model checkpoint file (.ckpt)')
+    parser.add_argument('--rgb', dest='rgb_and_depth', default=True, action='store_false', help='the model is a RgbCnn (default : RgbAndDepthCnn)')
+    parser.add_argument('--socket', default=False, action='store_true', help='local socket server instead of a ROS node')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='host of the socket server')
+    parser.add_argument('--port', default=5555, type=int, help='port of the socket server')
+    parser.add_argument('-b', '--max_batch_size', default=64, type=int, help='maximum number of crops in a micro-batch')
+    parser.add_argument('-w', '--max_wait_ms', default=5.0, type=float, help='maximum waiting time of a request before its batch is run')
+    parser.add_argument('--reload_period', default=5.0, type=float, help='period (s) of the checks of the checkpoint file, reloaded when it is replaced (0 : no reload)')
+    parser.add_argument('--tta', default=1, type=int, choices=[1, 2, 4, 8], help='number of test time augmentation variants (rotations / flips) of each crop')
+    args, _ = parser.parse_known_args()  # roslaunch adds its own arguments
+
+    model = load_model(args.ckpt_file, args.rgb_and_depth)
+    batcher = MicroBatcher(make_predict_function(model, args.rgb_and_depth, args.tta), max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                           needs_depth=args.rgb_and_depth)
+    if args.reload_period > 0:
+        CheckpointWatcher(batcher, args.ckpt_file, args.rgb_and_depth, args.tta, args.reload_period)
+    if args.socket:
+        server = SocketInferenceServer(batcher, args.host, args.port)
+        print(f'Grasp inference server listening on {args.host}:{args.port}')
+        server.serve_forever()
+    else:
+        import rospy
+        rospy.init_node('grasp_inference_server')
+        GraspInferenceNode(batcher)
+        rospy.spin()
@@ -0,0 +1,153 @@
+import os
+import time
+from pathlib import Path
+import numpy as np
+from numpy.lib import recfunctions
+
+# Store of the training curves : one append-only binary file per run (<folder>/<run name>.metrics).
+# The file is a small header followed by fixed size records (RECORD_DTYPE) : epoch, split, loss, accuracy, F1 score
+# and wall time (seconds since the start of the run). A record is written and flushed at the end of each epoch, so the
+# curves of a running training can be read, and a record truncated by a crash is ignored.
+# Query API : load_runs() reads hundreds of runs in one structured array (one np.fromfile per run) and aggregate()
+# computes the grouped mean / std / min / max (ex : by split and epoch over all the runs) without Python loops.
+
+MAGIC = b'RAIVMET1'
+EXTENSION = '.metrics'
+SPLITS = ['Train', 'Val', 'Test']
+METRIC_NAMES = ['loss', 'acc', 'f1_score']
+RECORD_DTYPE = np.dtype([('epoch', '<i4'), ('split', 'u1'), ('loss', '<f4'), ('acc', '<f4'), ('f1_score', '<f4'), ('wall_time', '<f8')])
+AGGREGATIONS = ['mean', 'std', 'min', 'max', 'count']
+
+
+class RunWriter:
+    """ Append the records of one run to its file """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.name = Path(filename).name[:-len(EXTENSION)]
+        self.start = time.time()
+        self.file = open(filename, 'xb')  # A run file is never overwritten
+        self.file.write(MAGIC)
+        self.file.flush()
+
+    def append(self, epoch, split, loss, acc, f1_score):
+        """ split : one of SPLITS """
+        record = np.array((epoch, SPLITS.index(split), loss, acc, f1_score, time.time() - self.start), dtype=RECORD_DTYPE)
+        self.file.write(record.tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MetricsStore:
+    """ Folder of run files """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def create_run(self, name):
+        """ Return a RunWriter for a new run, a counter is added to 'name' if a run with the same name exists """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        candidate, counter = name, 0
+        while True:
+            try:
+                return RunWriter(str(self.folder / (candidate + EXTENSION)))
+            except FileExistsError:
+                counter += 1
+                candidate = f'{name}_{counter}'
+
+    def run_names(self, pattern='*'):
+        """ Sorted names of the runs matching the glob 'pattern' """
+        return sorted(path.name[:-len(EXTENSION)] for path in self.folder.glob(pattern + EXTENSION))
+
+    def load_runs(self, names=None, pattern='*'):
+        """
+        Return (records, run names) : records is the structured array of all the records of the runs 'names'
+        (default : the runs matching 'pattern') with a 'run' field, the index of the run in 'run names'
+        """
+        names = self.run_names(pattern) if names is None else list(names)
+        runs = [read_run(str(self.folder / (name + EXTENSION))) for name in names]
+        records = np.concatenate(runs) if runs else np.zeros(0, dtype=RECORD_DTYPE)
+        run_indices = np.repeat(np.arange(len(runs), dtype=np.int32), [len(run) for run in runs])
+        return with_run_field(records, run_indices), names
+
+
+def read_run(filename):
+    """ Return the RECORD_DTYPE array of the records of a run file (without a truncated last record) """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{filename} is not a metrics file')
+        return np.fromfile(f, dtype=RECORD_DTYPE, count=(size - len(MAGIC)) // RECORD_DTYPE.itemsize)
+
+
+def with_run_field(records, run_indices):
+    """ Return a copy of 'records' with a 'run' field """
+    result = np.empty(len(records), dtype=[('run', '<i4')] + RECORD_DTYPE.descr)
+    result['run'] = run_indices
+    for name in RECORD_DTYPE.names:
+        result[name] = records[name]
+    return result
+
+
+def select(records, split=None, runs=None):
+    """ Records of the 'split' split (one of SPLITS) and/or of the run indices 'runs' """
+    mask = np.ones(len(records), dtype=bool)
+    if split is not None:
+        mask &= records['split'] == SPLITS.index(split)
+    if runs is not None:
+        mask &= np.isin(records['run'], runs)
+    return records[mask]
+
+
+def aggregate(records, by=('split', 'epoch'), metrics=METRIC_NAMES):
+    """
+    Grouped aggregation of 'records' : return (keys, {metric: {aggregation: array [nb groups]}}).
+    keys is the structured array of the unique values of the 'by' fields (sorted), the aggregations are AGGREGATIONS.
+    The records are sorted by group once, then every aggregation is a numpy reduceat (no loop on the groups).
+    """
+    by = list(by)
+    keys, inverse = np.unique(recfunctions.repack_fields(records[by]), return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0]) if len(order) else np.zeros(0, dtype=np.intp)
+    values = np.stack([records[name] for name in metrics], axis=1).astype(np.float64)[order]
+    counts = np.diff(np.r_[starts, len(order)])[:, None]
+    if len(starts):
+        sums = np.add.reduceat(values, starts, axis=0)
+        squares = np.add.reduceat(values ** 2, starts, axis=0)
+        mins = np.minimum.reduceat(values, starts, axis=0)
+        maxs = np.maximum.reduceat(values, starts, axis=0)
+    else:
+        sums = squares = mins = maxs = np.zeros((0, len(metrics)))
+    mean = sums / np.maximum(counts, 1)
+    std = np.sqrt(np.maximum(squares / np.maximum(counts, 1) - mean ** 2, 0))
+    return keys, {name: {'mean': mean[:, i], 'std': std[:, i], 'min': mins[:, i], 'max': maxs[:, i], 'count': counts[:, 0]}
+                  for i, name in enumerate(metrics)}
+
+
+def curves(records, split='Val', metrics=METRIC_NAMES):
+    """ Return (epochs, {metric: {aggregation: array [len(epochs)]}}) of the 'split' curves of all the runs of 'records' """
+    keys, stats = aggregate(select(records, split=split), by=('epoch',), metrics=metrics)
+    return keys['epoch'], stats
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print the runs of a metrics folder with their number of epochs, best loss and best F1 score.')
+    parser.add_argument('metrics_folder', type=str, help='folder of the .metrics run files (courbe_folder of the trainings)')
+    parser.add_argument('-p', '--pattern', default='*', type=str, help='glob pattern of the run names')
+    args = parser.parse_args()
+
+    store = MetricsStore(args.metrics_folder)
+    start = time.perf_counter()
+    records, names = store.load_runs(pattern=args.pattern)
+    print(f'{len(names)} runs, {len(records)} records loaded in {(time.perf_counter() - start) * 1000:.1f} ms')
+    keys, stats = aggregate(records, by=('run', 'split'))
+    print(f"{'run':<50}{'split':>6}{'epochs':>8}{'best loss':>11}{'best F1':>9}")
+    for i, key in enumerate(keys):
+        print(f"{names[key['run']]:<50}{SPLITS[key['split']]:>6}{stats['loss']['count'][i]:>8}"
+              f"{stats['loss']['min'][i]:>11.4f}{stats['f1_score']['max'][i]:>9.4f}")
@@ -0,0 +1,120 @@
+import json
+import numpy as np
+import torch
+from pytorch_lightning.utilities.parsing import AttributeDict
+from raiv_libraries.rgb_cnn import RgbCnn
+from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn
+
+# Inference of the grasp CNNs (RgbCnn or RgbAndDepthCnn) with ONNX Runtime on CPU.
+# 'export_onnx' converts a trained model into an ONNX file with a dynamic batch axis, the hyperparameters of
+# the model are stored in the ONNX metadata. 'OnnxCnn' loads this file and provides the same predict API than
+# the Pytorch models (it can also be given to the RgbCnn / RgbAndDepthCnn static predict methods).
+
+INPUT_NAMES = {RgbCnn: ['rgb'], RgbAndDepthCnn: ['rgb', 'depth']}
+OUTPUT_NAMES = ['features', 'log_probs']
+
+
+def _example_inputs(model, batch_size=2):
+    return tuple(torch.rand(batch_size, *input_shape) for input_shape in model.input_shapes())
+
+
+def export_onnx(model, onnx_file, opset_version=13):
+    """ Export a RgbCnn or RgbAndDepthCnn model in 'onnx_file' """
+    import onnx
+    model.eval()
+    input_names = INPUT_NAMES[type(model)]
+    torch.onnx.export(model, _example_inputs(model), str(onnx_file),
+                      input_names=input_names,
+                      output_names=OUTPUT_NAMES,
+                      dynamic_axes={name: {0: 'batch_size'} for name in input_names + OUTPUT_NAMES},
+                      opset_version=opset_version)
+    # Store the hyperparameters in the ONNX file
+    onnx_model = onnx.load(str(onnx_file))
+    for key, value in [('model', type(model).__name__), ('hparams', json.dumps(dict(model.hparams), default=str))]:
+        prop = onnx_model.metadata_props.add()
+        prop.key, prop.value = key, value
+    onnx.save(onnx_model, str(onnx_file))
+
+
+class OnnxCnn:
+    """ ONNX Runtime version of a RgbCnn or RgbAndDepthCnn model """
+
+    def __init__(self, onnx_file, intra_op_threads=0, inter_op_threads=0):
+        """
+        intra_op_threads : number of threads used inside an operator (0 : ONNX Runtime default, i.e. number of cores)
+        inter_op_threads : number of threads used to run independent operators in parallel (0 : sequential execution)
+        """
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+            options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(onnx_file), options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.model_name = metadata.get('model', RgbCnn.__name__)
+        self.hparams = AttributeDict(json.loads(metadata.get('hparams', '{}')))
+
+    def __call__(self, *tensors):
+        """ Same outputs as the Pytorch models : (features, log_probs) """
+        inputs = {name: tensor.detach().cpu().numpy().astype(np.float32) for name, tensor in zip(self.input_names, tensors)}
+        features, log_probs = self.session.run(OUTPUT_NAMES, inputs)
+        return torch.from_numpy(features), torch.from_numpy(log_probs)
+
+    def predict_from_pil_rgb_image(self, pil_rgb_img, tta=1):
+        return RgbCnn.predict_from_pil_rgb_image(self, pil_rgb_img, tta)
+
+    def predict_from_pil_rgb_images(self, pil_rgb_imgs, tta=1):
+        return RgbCnn.predict_from_pil_rgb_images(self, pil_rgb_imgs, tta)
+
+    def predict_from_pil_rgb_and_depth_images(self, pil_rgb_img, pil_depth_img, tta=1):
+        return RgbAndDepthCnn.predict_from_pil_rgb_and_depth_images(self, pil_rgb_img, pil_depth_img, tta)
+
+    def predict_from_pil_rgb_and_depth_images_batch(self, pil_rgb_imgs, pil_depth_imgs, tta=1):
+        return RgbAndDepthCnn.predict_from_pil_rgb_and_depth_images_batch(self, pil_rgb_imgs, pil_depth_imgs, tta)
+
+
+@torch.no_grad()
+def check_parity(model, onnx_model, batch_size=8, atol=1e-4):
+    """
+    Compare the probabilities computed by the Pytorch model and its ONNX version on random inputs.
+    Return the maximum absolute difference, raise an AssertionError if it is above 'atol'
+    """
+    model.eval()
+    inputs = _example_inputs(model, batch_size)
+    _, torch_log_probs = model(*inputs)
+    _, onnx_log_probs = onnx_model(*inputs)
+    max_diff = (torch.exp(torch_log_probs) - torch.exp(onnx_log_probs)).abs().max().item()
+    assert max_diff <= atol, f'ONNX and Pytorch outputs differ : max difference = {max_diff}'
+    return max_diff
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Export a RgbCnn or RgbAndDepthCnn checkpoint to ONNX, check the parity and measure the ONNX Runtime inference time.')
+    parser.add_argument('ckpt_file', type=str, help='model checkpoint file (.ckpt)')
+    parser.add_argument('onnx_file', type=str, help='ONNX file to generate')
+    parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='the checkpoint is a RgbAndDepthCnn (default : RgbCnn)')
+    parser.add_argument('--intra_op_threads', default=0, type=int, help='ONNX Runtime intra-op threads (0 : default)')
+    parser.add_argument('--inter_op_threads', default=0, type=int, help='ONNX Runtime inter-op threads (0 : sequential)')
+    parser.add_argument('-b', '--batch_size', default=32, type=int, help='batch size used to measure the inference time')
+    args = parser.parse_args()
+
+    cnn_class = RgbAndDepthCnn if args.rgb_and_depth else RgbCnn
+    model = cnn_class.load_ckpt_model_file(args.ckpt_file)
+    export_onnx(model, args.onnx_file)
+    onnx_model = OnnxCnn(args.onnx_file, intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
+    print(f'Parity check OK : max difference = {check_parity(model, onnx_model):.2e}')
+    inputs = _example_inputs(model, args.batch_size)
+    for name, predictor in [('Pytorch', model), ('ONNX Runtime', onnx_model)]:
+        predictor(*inputs)  # Warm up
+        start = time.perf_counter()
+        for _ in range(10):
+            predictor(*inputs)
+        duration = (time.perf_counter() - start) / 10
+        print(f'{name} : {duration * 1000:.1f} ms per batch of {args.batch_size}, {args.batch_size / duration:.0f} images/s')
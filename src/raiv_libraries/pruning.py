@@ -0,0 +1,146 @@
+import torch
+from torchvision.models.resnet import BasicBlock, Bottleneck
+
+# Structured (channel level) pruning of the ResNet feature extractors of RgbCnn and RgbAndDepthCnn.
+# Only the channels inside the residual blocks are pruned (output of conv1 for a BasicBlock, outputs of conv1 and conv2
+# for a Bottleneck), so the shapes of the residual connections don't change. The least important channels (smallest
+# L1 norm of their filters) are physically removed : the pruned model is a smaller dense model, not a masked one.
+# The kept widths are stored in hparams.pruned_channels ({block name: [widths]}), Cnn applies them when the model
+# is built, so a pruned checkpoint is loaded with the usual load_ckpt_model_file().
+
+
+def prunable_blocks(model):
+    """ Return the list of (name, block) of the residual blocks of 'model' """
+    return [(name, module) for name, module in model.named_modules() if isinstance(module, (BasicBlock, Bottleneck))]
+
+
+def _block_layers(block):
+    """ Return the list of (conv, bn, next conv) whose channels can be pruned in 'block' """
+    if isinstance(block, Bottleneck):
+        return [('conv1', 'bn1', 'conv2'), ('conv2', 'bn2', 'conv3')]
+    return [('conv1', 'bn1', 'conv2')]
+
+
+def block_widths(block):
+    """ Return the current widths of the prunable layers of 'block' """
+    return [getattr(block, conv).out_channels for conv, _, _ in _block_layers(block)]
+
+
+def _select_conv(conv, out_indices=None, in_indices=None):
+    """ Return a copy of the Conv2d 'conv' with only the 'out_indices' filters and the 'in_indices' input channels """
+    weight = conv.weight.data
+    if out_indices is not None:
+        weight = weight[out_indices]
+    if in_indices is not None:
+        weight = weight[:, in_indices]
+    new_conv = torch.nn.Conv2d(weight.shape[1], weight.shape[0], kernel_size=conv.kernel_size, stride=conv.stride,
+                               padding=conv.padding, dilation=conv.dilation, bias=conv.bias is not None)
+    new_conv.weight.data.copy_(weight)
+    if conv.bias is not None:
+        new_conv.bias.data.copy_(conv.bias.data if out_indices is None else conv.bias.data[out_indices])
+    return new_conv
+
+
+def _select_bn(bn, indices):
+    new_bn = torch.nn.BatchNorm2d(len(indices), eps=bn.eps, momentum=bn.momentum)
+    for name in ['weight', 'bias']:
+        getattr(new_bn, name).data.copy_(getattr(bn, name).data[indices])
+    for name in ['running_mean', 'running_var']:
+        getattr(new_bn, name).copy_(getattr(bn, name)[indices])
+    new_bn.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return new_bn
+
+
+def prune_block(block, widths, by_importance=True):
+    """
+    Keep 'widths' channels in the prunable layers of 'block' (see _block_layers).
+    by_importance : keep the channels whose filters have the biggest L1 norm, else keep the first ones
+                    (used to build the shapes of a pruned model before loading its weights)
+    """
+    for (conv_name, bn_name, next_conv_name), width in zip(_block_layers(block), widths):
+        conv = getattr(block, conv_name)
+        if width >= conv.out_channels:
+            continue
+        if by_importance:
+            importance = conv.weight.data.abs().sum(dim=(1, 2, 3))
+            indices = torch.sort(torch.topk(importance, width).indices).values
+        else:
+            indices = torch.arange(width)
+        setattr(block, conv_name, _select_conv(conv, out_indices=indices))
+        setattr(block, bn_name, _select_bn(getattr(block, bn_name), indices))
+        setattr(block, next_conv_name, _select_conv(getattr(block, next_conv_name), in_indices=indices))
+
+
+def apply_pruned_channels(model, pruned_channels):
+    """ Give the widths of 'pruned_channels' ({block name: [widths]}) to the blocks of 'model', before loading its weights """
+    blocks = dict(prunable_blocks(model))
+    for name, widths in pruned_channels.items():
+        prune_block(blocks[name], widths, by_importance=False)
+
+
+def prune_model(model, ratio, original_widths=None):
+    """
+    Remove the least important channels of all the residual blocks of 'model' (in place) : each block keeps
+    (1 - ratio) of its original width. Update model.hparams.pruned_channels and return it.
+    original_widths : {block name: [widths]} before any pruning (default : the current widths)
+    """
+    pruned_channels = {}
+    for name, block in prunable_blocks(model):
+        widths = original_widths[name] if original_widths else block_widths(block)
+        new_widths = [max(1, round(width * (1 - ratio))) for width in widths]
+        prune_block(block, new_widths)
+        pruned_channels[name] = block_widths(block)
+    model.hparams.pruned_channels = pruned_channels
+    return pruned_channels
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    import json
+    from raiv_libraries.image_data_module import ImageDataModule
+    from raiv_libraries.cnn_benchmark import evaluate, measure_latency, count_params, count_flops, print_report
+
+    parser = argparse.ArgumentParser(description='Iterative structured pruning of a RgbCnn or RgbAndDepthCnn checkpoint, with fine-tuning rounds and a FLOPs / parameters / latency / F1 report.')
+    parser.add_argument('ckpt_file', type=str, help='model checkpoint file (.ckpt)')
+    parser.add_argument('images_folder', type=str, help='images folder with fail and success sub-folders (or <rgb and depth> / <fail and success> with --rgb_and_depth)')
+    parser.add_argument('ckpt_folder', type=str, help='folder path where to stock the pruned model.CKPT files')
+    parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='the checkpoint is a RgbAndDepthCnn (default : RgbCnn)')
+    parser.add_argument('--ratios', default=[0.25, 0.5, 0.625, 0.75], type=float, nargs='+', help='increasing pruning ratios of the channels of the blocks')
+    parser.add_argument('-e', '--epochs', default=2, type=int, help='number of fine-tuning epochs after each pruning step')
+    parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    parser.add_argument('-r', '--report', default=None, type=str, help='Optionnal JSON file where the results are written')
+    args = parser.parse_args()
+
+    if args.rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn as CnnClass
+    else:
+        from raiv_libraries.rgb_cnn import RgbCnn as CnnClass
+    model = CnnClass.load_ckpt_model_file(args.ckpt_file)
+    data_module = ImageDataModule.from_images_folder(args.images_folder, rgb_and_depth=args.rgb_and_depth,
+                                                     depth_channels=model.hparams.get('depth_channels', 3), image_size=model.hparams.input_shape[-1],
+                                                     dataset_size=args.dataset_size, batch_size=model.hparams.config['batch_size'])
+
+    def report(name):
+        model.eval()
+        results[name] = evaluate(model, data_module.test_dataloader())
+        results[name].update(nb_params=count_params(model), flops=count_flops(model), latency=measure_latency(model, model.input_shapes()))
+
+    results = {}
+    report('original')
+    model.unfreeze()
+    original_widths = {name: block_widths(block) for name, block in prunable_blocks(model)}
+    for ratio in sorted(args.ratios):
+        prune_model(model, ratio, original_widths)
+        name = f'pruned_{ratio:g}'
+        trainer = model.build_trainer(data_module=data_module, model_name=model.hparams.backbone, ckpt_dir=args.ckpt_folder,
+                                      num_epochs=args.epochs, suffix=name, dataset_size=args.dataset_size)
+        trainer.fit(model=model, datamodule=data_module)
+        trainer.test(ckpt_path='best', datamodule=data_module)
+        report(name)
+        results[name]['ckpt_file'] = trainer.checkpoint_callback.best_model_path
+        print(f'{name} : {results[name]["ckpt_file"]}')
+    print_report(results)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,105 @@
+import copy
+import json
+import torch
+from pytorch_lightning.utilities.parsing import AttributeDict
+from raiv_libraries.cnn import Cnn
+
+# Post-training static quantization (int8) of the grasp CNNs (RgbCnn or RgbAndDepthCnn) with FX graph mode.
+# The observers are calibrated with a few hundred images of the dataset, then the int8 model is saved as a
+# TorchScript file (with the hyperparameters of the model) which is loaded by 'load_quantized_model_file'.
+
+HPARAMS_FILE = 'hparams.json'
+
+
+def _quantization_backend():
+    """ 'x86' backend if available (Pytorch >= 2.0), else 'fbgemm' """
+    return 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+
+
+@torch.no_grad()
+def quantize_model(model, data_loader, nb_calibration_images=300):
+    """ Return the int8 version of 'model', calibrated with 'nb_calibration_images' images of 'data_loader' """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    backend = _quantization_backend()
+    torch.backends.quantized.engine = backend
+    model_fp32 = copy.deepcopy(model).eval()
+    example_inputs = tuple(torch.rand(1, *input_shape) for input_shape in model.input_shapes())
+    prepared_model = prepare_fx(model_fp32, get_default_qconfig_mapping(backend), example_inputs)
+    nb_images = 0
+    for batch in data_loader:  # Calibration
+        inputs, _ = Cnn.split_batch(batch)
+        prepared_model(*inputs)
+        nb_images += len(inputs[0])
+        if nb_images >= nb_calibration_images:
+            break
+    return convert_fx(prepared_model), example_inputs
+
+
+def save_quantized_model(quantized_model, example_inputs, hparams, filename):
+    """ Save the int8 model as a TorchScript file, with the hyperparameters of the original model """
+    scripted_model = torch.jit.trace(quantized_model, example_inputs)
+    torch.jit.save(scripted_model, str(filename),
+                   _extra_files={HPARAMS_FILE: json.dumps(dict(hparams), default=str)})
+
+
+class QuantizedCnn(torch.nn.Module):
+    """ int8 model loaded from a TorchScript file, with the same outputs and hparams than RgbCnn or RgbAndDepthCnn """
+    def __init__(self, scripted_model, hparams):
+        super().__init__()
+        self.model = scripted_model
+        self.hparams = AttributeDict(hparams)
+
+    def forward(self, *inputs):
+        return self.model(*inputs)
+
+
+def load_quantized_model_file(filename):
+    """
+    Load the int8 model named 'filename' (generated by save_quantized_model)
+    :return: the model to be used for inference, it can be given to the RgbCnn / RgbAndDepthCnn predict methods
+    """
+    torch.backends.quantized.engine = _quantization_backend()
+    extra_files = {HPARAMS_FILE: ''}
+    scripted_model = torch.jit.load(str(filename), map_location='cpu', _extra_files=extra_files)
+    model = QuantizedCnn(scripted_model, json.loads(extra_files[HPARAMS_FILE] or '{}'))
+    model.eval()
+    return model
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+    from raiv_libraries.image_data_module import ImageDataModule
+    from raiv_libraries.cnn_benchmark import evaluate, measure_latency, print_report
+
+    parser = argparse.ArgumentParser(description='int8 post-training static quantization of a RgbCnn or RgbAndDepthCnn checkpoint, with an accuracy and latency report.')
+    parser.add_argument('ckpt_file', type=str, help='model checkpoint file (.ckpt)')
+    parser.add_argument('images_folder', type=str, help='images folder used for calibration and test (same as for training)')
+    parser.add_argument('quantized_file', type=str, help='TorchScript file of the int8 model to generate')
+    parser.add_argument('--rgb_and_depth', default=False, action='store_true', help='the checkpoint is a RgbAndDepthCnn (default : RgbCnn)')
+    parser.add_argument('-n', '--nb_calibration_images', default=300, type=int, help='number of images used for calibration')
+    parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    parser.add_argument('-r', '--report', default=None, type=str, help='Optionnal JSON file where the report is written')
+    args = parser.parse_args()
+
+    if args.rgb_and_depth:
+        from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn as CnnClass
+    else:
+        from raiv_libraries.rgb_cnn import RgbCnn as CnnClass
+    model = CnnClass.load_ckpt_model_file(args.ckpt_file)
+    data_module = ImageDataModule.from_images_folder(args.images_folder, rgb_and_depth=args.rgb_and_depth,
+                                                     depth_channels=model.hparams.get('depth_channels', 3), image_size=model.hparams.input_shape[-1],
+                                                     dataset_size=args.dataset_size, batch_size=32)
+    quantized_model, example_inputs = quantize_model(model, data_module.train_dataloader(), args.nb_calibration_images)
+    save_quantized_model(quantized_model, example_inputs, model.hparams, args.quantized_file)
+    quantized_model = load_quantized_model_file(args.quantized_file)
+    # Report : accuracy / F1 score on the test split and latency for both models
+    results = {}
+    for name, predictor in [('fp32', model), ('int8', quantized_model)]:
+        results[name] = evaluate(predictor, data_module.test_dataloader())
+        results[name]['latency'] = measure_latency(predictor, model.input_shapes())
+    print_report(results)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,29 +1,160 @@
-import torchvision.transforms as transforms
+import os
+import json
+import shutil
+import time
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import numpy as np
+import cv2
 from PIL import Image
-import os as os
 
-i = ''
-PATH = '/common/stockage_banque_image/Ventouse_3_souflet/Pression_2_bars/1/fail'  #Write the path folder of resizing
-IMAGE_LIST = []
-IMAGE_LIST = os.listdir(PATH)
+# Resize all the images of an image bank (typically <bank>/<rgb and depth>/<success and fail>/*.png) so that
+# their smallest side is SIZE pixels (same behavior as transforms.Resize(size=SIZE)).
+# Already processed files are tracked in a STATE_FILE (mtime and size of each file after resizing) so a new run
+# only processes the new images. Each image is written in a temporary file then renamed, so an interrupted run
+# never leaves a half-written image.
 
-def transform(img):
-    transf = transforms.Compose([
-        transforms.Resize(size=50),
-    ])
-    return transf(img)
+STATE_FILE = '.resize_state.json'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
 
 
+def target_size(width, height, size):
+    """ Return the (width, height) of an image which smallest side is 'size', keeping the aspect ratio """
+    if width <= height:
+        return size, int(size * height / width)
+    return int(size * width / height), size
 
-for i in IMAGE_LIST:
-    img = Image.open(PATH + '/' + i)
-    image = transform(img)
-    image.save(PATH + '/' + i)
 
+def resize_pil_image(img, size):
+    """
+    Resize a PIL image without changing its mode.
+    8 bits images (RGB or L) are resized with PIL, 16 bits depth images (I;16) with OpenCV (PIL can't filter them)
+    """
+    new_size = target_size(img.width, img.height, size)
+    if img.mode.startswith('I;16'):
+        array = np.array(img)
+        array = cv2.resize(array, new_size, interpolation=cv2.INTER_AREA)
+        return Image.fromarray(array.astype(np.uint16))
+    return img.resize(new_size, Image.BILINEAR)
 
 
+def atomic_save(img, path):
+    """ Save 'img' in a temporary file of the same folder then rename it to 'path' """
+    path = Path(path)
+    fd, tmp_name = tempfile.mkstemp(prefix='.' + path.stem, suffix=path.suffix, dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, format=Image.registered_extensions()[path.suffix.lower()])
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    try:
+        path.chmod(0o777)  # Write permission for everybody (like the images saved by tools.save_pil_images)
+    except PermissionError:
+        pass
 
 
+def resize_file(src, dst, size):
+    """
+    Resize the 'src' file into 'dst' (can be the same file).
+    Return (dst, mtime_ns, file_size, nb_bytes_read, resized) ; resized is False if the image already had the target size
+    """
+    nb_bytes = os.path.getsize(src)
+    with Image.open(src) as img:  # Only the header is read if the image already has the right size
+        already_ok = min(img.size) == size
+        if not already_ok:
+            resized_img = resize_pil_image(img, size)
+    Path(dst).parent.mkdir(parents=True, exist_ok=True)
+    if not already_ok:
+        atomic_save(resized_img, dst)
+    elif src != dst:  # Nothing to resize, just copy the file
+        tmp_dst = Path(dst).with_name('.' + Path(dst).name)
+        shutil.copy2(src, tmp_dst)
+        os.replace(tmp_dst, dst)
+    st = os.stat(dst)
+    return str(dst), st.st_mtime_ns, st.st_size, nb_bytes, not already_ok
 
 
+def load_state(folder):
+    try:
+        with open(Path(folder) / STATE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
 
+
+def save_state(folder, state):
+    fd, tmp_name = tempfile.mkstemp(prefix='.resize_state', dir=str(folder))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_name, Path(folder) / STATE_FILE)
+
+
+def list_images(folder):
+    """ Return all the image files of the 'folder' tree, sorted """
+    return sorted(p for p in Path(folder).rglob('*') if p.suffix.lower() in IMAGE_EXTENSIONS and not p.name.startswith('.'))
+
+
+def resize_tree(src_folder, size, dst_folder=None, nb_workers=None, chunksize=32):
+    """
+    Resize all the images of 'src_folder' (recursively) with a pool of processes.
+    If 'dst_folder' is None, images are replaced in place, otherwise the tree is reproduced in 'dst_folder'.
+    Files already processed (same mtime and size than recorded in the state file) are skipped.
+    Return a dict with statistics about this run.
+    """
+    src_folder = Path(src_folder)
+    dst_folder = src_folder if dst_folder is None else Path(dst_folder)
+    dst_folder.mkdir(parents=True, exist_ok=True)
+    state = load_state(dst_folder)
+    if state.get('size') != size:  # A new target size invalidates everything
+        state = {'size': size, 'files': {}}
+    files = state['files']
+    todo = []
+    nb_skipped = 0
+    for src in list_images(src_folder):
+        rel = str(src.relative_to(src_folder))
+        dst = dst_folder / rel
+        known = files.get(rel)
+        if known is not None and dst.exists():
+            st = dst.stat()
+            if [st.st_mtime_ns, st.st_size] == known:
+                nb_skipped += 1
+                continue
+        todo.append((str(src), str(dst)))
+    start = time.time()
+    nb_resized = nb_bytes = 0
+    if todo:
+        nb_workers = nb_workers or mp.cpu_count()
+        srcs, dsts = zip(*todo)
+        try:
+            with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+                for dst, mtime_ns, file_size, nb_read, resized in executor.map(resize_file, srcs, dsts, [size] * len(todo), chunksize=chunksize):
+                    files[str(Path(dst).relative_to(dst_folder))] = [mtime_ns, file_size]
+                    nb_bytes += nb_read
+                    nb_resized += resized
+        finally:  # Even if interrupted, remember the files already done
+            save_state(dst_folder, state)
+    duration = time.time() - start
+    return {'nb_processed': len(todo), 'nb_resized': nb_resized, 'nb_skipped': nb_skipped,
+            'duration': duration, 'nb_bytes': nb_bytes}
+
+
+# --- MAIN ----
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Resize (in parallel) all the images of an image bank folder tree (rgb/depth, success/fail). Only new images are processed.')
+    parser.add_argument('images_folder', type=str, help='root folder of the images to resize (all sub-folders are processed)')
+    parser.add_argument('-o', '--output_folder', default=None, type=str, help='Optionnal folder where to write the resized tree (default : resize in place)')
+    parser.add_argument('-s', '--size', default=50, type=int, help='size of the smallest side of the resized images')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='number of processes (default : number of CPUs)')
+    args = parser.parse_args()
+
+    stats = resize_tree(args.images_folder, args.size, dst_folder=args.output_folder, nb_workers=args.workers)
+    duration = max(stats['duration'], 1e-9)
+    print(f"{stats['nb_processed']} images processed ({stats['nb_resized']} resized, {stats['nb_skipped']} skipped) in {stats['duration']:.2f} seconds")
+    if stats['nb_processed']:
+        print(f"Throughput : {stats['nb_processed'] / duration:.1f} images/s, {stats['nb_bytes'] / duration / 1e6:.2f} MB/s")
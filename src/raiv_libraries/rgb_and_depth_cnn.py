@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn.functional as F
 import torchvision.models as models
@@ -5,48 +6,102 @@ from raiv_libraries.cnn import Cnn
 
 from raiv_libraries.image_tools import ImageTools
 
+ARCHITECTURES = ['shared', 'dual']
+_backbone_executor = None  # Thread used to run the depth backbone concurrently in 'dual' mode
+
 
 class RgbAndDepthCnn(Cnn):
-    def __init__(self, config, **kwargs):
+    LEGACY_HPARAMS = {'depth_channels': 3}  # The depth images of the old models were converted in RGB images
+
+    def __init__(self, config, architecture: str = 'shared', concurrent_backbones: bool = False, depth_channels: int = 1, **kwargs):
+        """
+        architecture : 'shared' : one backbone for the RGB and the depth images, both run in one pass (batch concatenation)
+                       'dual' : one backbone for the RGB images and another one for the depth images
+        concurrent_backbones : in 'dual' mode, run the depth backbone in another thread while the RGB one runs
+        depth_channels : 1 : the depth images are grayscale images given to a 1 channel first convolution
+                         3 : the depth images are converted in RGB images (old models)
+        """
         super(RgbAndDepthCnn, self).__init__(config, **kwargs)
 
     def build_model(self):
         """Define model layers """
+        architecture = self.hparams.get('architecture', 'shared')  # Old models used the RGB backbone for both images
+        if architecture not in ARCHITECTURES:
+            raise ValueError(f'Unknown architecture : {architecture}, choose one of {ARCHITECTURES}')
         # Load pre-trained network: choose the model for the pretrained network
         model_func = getattr(models, self.hparams.backbone)
         # Feature extractors
-        self.feature_extractor_rgb = self._build_features_layers(model_func)
-        self.feature_extractor_depth = self._build_features_layers(model_func)
-        # classes are two: success or failure
-        num_target_classes = 2
-        n_sizes = self.get_cumulative_output_conv_layers_size([self.feature_extractor_rgb, self.feature_extractor_depth])
-        # Classifier
-        layer_1_size = self.hparams.config['layer_1_size']
-        layer_2_size = self.hparams.config['layer_2_size']
-        _fc_layers = [torch.nn.Linear(n_sizes, layer_1_size),
-                      torch.nn.Linear(layer_1_size, layer_2_size),
-                      torch.nn.Linear(layer_2_size, num_target_classes)]
+        self.feature_extractor_rgb, n_sizes_rgb = self.build_feature_extractor(model_func)
+        depth_channels = self.hparams.depth_channels
+        if architecture == 'dual':
+            self.feature_extractor_depth, n_sizes_depth = self.build_feature_extractor(model_func)
+            if depth_channels == 1:
+                first_conv, _ = Cnn.split_first_conv(self.feature_extractor_depth)
+                name = next(name for name, module in self.feature_extractor_depth.named_modules() if module is first_conv)
+                parent_name, _, attribute = name.rpartition('.')
+                setattr(self.feature_extractor_depth.get_submodule(parent_name), attribute, Cnn.single_channel_conv(first_conv))
+        else:
+            n_sizes_depth = n_sizes_rgb
+            if depth_channels == 1:  # Only the first convolution is specific to the depth images
+                # rgb_conv1 and rgb_trunk are the layers of feature_extractor_rgb (shared weights), registered as
+                # sub-modules so they are traced by the FX quantization and seen by named_modules()
+                self.rgb_conv1, self.rgb_trunk = Cnn.split_first_conv(self.feature_extractor_rgb)
+                self.depth_conv1 = Cnn.single_channel_conv(self.rgb_conv1)
+        n_sizes = n_sizes_rgb + n_sizes_depth
+        # Classifier (classes are two: success or failure)
+        self.fc = self.build_classifier(n_sizes)
+
+    def on_load_checkpoint(self, checkpoint):
+        super().on_load_checkpoint(checkpoint)
+        state_dict = checkpoint['state_dict']
+        if self.hparams.get('architecture', 'shared') == 'shared':  # Old checkpoints have an unused depth backbone
+            for key in [key for key in state_dict if key.startswith('feature_extractor_depth.')]:
+                del state_dict[key]
+        # The checkpoints saved before rgb_conv1 and rgb_trunk were registered only have the keys of feature_extractor_rgb
+        shared_keys = {id(t): key for key, t in self.feature_extractor_rgb.state_dict(prefix='feature_extractor_rgb.', keep_vars=True).items()}
+        for module_name in ['rgb_conv1', 'rgb_trunk']:
+            if hasattr(self, module_name):
+                for key, t in getattr(self, module_name).state_dict(prefix=module_name + '.', keep_vars=True).items():
+                    if key not in state_dict and shared_keys.get(id(t)) in state_dict:
+                        state_dict[key] = state_dict[shared_keys[id(t)]]
+
+    def input_shapes(self):
+        _, height, width = self.hparams.input_shape
+        return [list(self.hparams.input_shape), [self.hparams.depth_channels, height, width]]
 
-        self.fc = torch.nn.Sequential(*_fc_layers)
+    def extract_features(self, rgb, depth):
+        """ Return the features of the RGB and of the depth images """
+        if self.hparams.get('architecture', 'shared') == 'shared':
+            if self.hparams.depth_channels == 1:  # The first convolutions are different, then one pass
+                features = self.rgb_trunk(torch.cat((self.rgb_conv1(rgb), self.depth_conv1(depth)), dim=0))
+            else:
+                features = self.feature_extractor_rgb(torch.cat((rgb, depth), dim=0))
+            return torch.split(features, [rgb.shape[0], depth.shape[0]], dim=0)
+        if self.hparams.get('concurrent_backbones', False):
+            global _backbone_executor
+            if _backbone_executor is None:
+                _backbone_executor = ThreadPoolExecutor(max_workers=1)
+            # Pytorch ops release the GIL. The grad and autocast modes are thread local, they are given to the thread
+            future_depth = _backbone_executor.submit(self._run_backbone, self.feature_extractor_depth, depth,
+                                                     torch.is_grad_enabled(), torch.is_autocast_cpu_enabled())
+            features_rgb = self.feature_extractor_rgb(rgb)
+            return features_rgb, future_depth.result()
+        return self.feature_extractor_rgb(rgb), self.feature_extractor_depth(depth)
 
-    def _build_features_layers(self, model_func):
-        """ Return the feature extractor from a pretrained Cnn """
-        backbone = model_func(weights="DEFAULT")
-        # Feature extractor
-        _layers = list(backbone.children())[:-1]
-        return torch.nn.Sequential(*_layers)
+    @staticmethod
+    def _run_backbone(backbone, images, grad_enabled, autocast_enabled):
+        with torch.set_grad_enabled(grad_enabled), torch.autocast('cpu', dtype=torch.bfloat16, enabled=autocast_enabled):
+            return backbone(images)
 
     def forward(self, rgb, depth):
         """Forward pass. Returns logits."""
-        # 1. Feature extraction for RGB Cnn
-        features_rgb = self.feature_extractor_rgb(rgb)
+        # 1. Feature extraction for RGB and Depth Cnn
+        features_rgb, features_depth = self.extract_features(rgb, depth)
         features_rgb = features_rgb.squeeze(-1).squeeze(-1)
-        # 2. Feature extraction for Depth Cnn
-        features_depth = self.feature_extractor_rgb(depth)
         features_depth = features_depth.squeeze(-1).squeeze(-1)
-        # 3. Concatenate both features
+        # 2. Concatenate both features
         features = torch.cat((features_rgb, features_depth), dim=1)
-        # 4. Classifier (returns logits):
+        # 3. Classifier (returns logits):
         t = self.fc(features)
         t = F.log_softmax(t, dim=1)
         return features, t
@@ -56,22 +111,29 @@ class RgbAndDepthCnn(Cnn):
         logits = self(rgb, depth)
         return logits, y
 
+    @staticmethod
+    def depth_images_preprocessing(model, pil_depth_imgs):
+        """ Return the tensor of the depth images, with the number of channels expected by 'model' """
+        transform = Cnn.transforms(model, depth=True)[0]
+        if model.hparams.get('depth_channels', 3) == 1:  # Also ONNX and quantized predictors
+            return ImageTools.images_preprocessing([img.convert('L') for img in pil_depth_imgs], transform)
+        return ImageTools.images_preprocessing([img.convert('RGB') for img in pil_depth_imgs], transform)
+
     @staticmethod
     @torch.no_grad()
-    def predict_from_pil_rgb_and_depth_images(model, pil_rgb_img, pil_depth_img):
-        rgb_tensor = ImageTools.image_preprocessing(pil_rgb_img)
-        depth_tensor = ImageTools.image_preprocessing(pil_depth_img)
-        features, prediction = model(rgb_tensor, depth_tensor)
+    def predict_from_pil_rgb_and_depth_images(model, pil_rgb_img, pil_depth_img, tta=1):
+        """ tta : number of test time augmentation variants (see cnn.TTA_VARIANTS), the RGB and depth images get the same ones """
+        rgb_tensor = ImageTools.image_preprocessing(pil_rgb_img, Cnn.transforms(model)[0])
+        depth_tensor = RgbAndDepthCnn.depth_images_preprocessing(model, [pil_depth_img])
+        features, prediction = model(Cnn.tta_batch(rgb_tensor, tta), Cnn.tta_batch(depth_tensor, tta))
         prediction = prediction.detach()
-        return torch.exp(prediction)
+        return Cnn.tta_mean(torch.exp(prediction), tta)
 
     @staticmethod
-    def load_ckpt_model_file(ckpt_model_filename):
-        """
-        Load the model named 'ckpt_model_filename' and freeze it
-        :param name: name of the model
-        :return: the model freezed to be used for inference
-        """
-        model = RgbAndDepthCnn.load_from_checkpoint(ckpt_model_filename)
-        model.freeze()
-        return model
\ No newline at end of file
+    @torch.no_grad()
+    def predict_from_pil_rgb_and_depth_images_batch(model, pil_rgb_imgs, pil_depth_imgs, tta=1):
+        """ Same as predict_from_pil_rgb_and_depth_images() for lists of images, processed in one batch (with all their TTA variants) """
+        rgb_tensor = ImageTools.images_preprocessing(pil_rgb_imgs, Cnn.transforms(model)[0])
+        depth_tensor = RgbAndDepthCnn.depth_images_preprocessing(model, pil_depth_imgs)
+        features, prediction = model(Cnn.tta_batch(rgb_tensor, tta), Cnn.tta_batch(depth_tensor, tta))
+        return Cnn.tta_mean(torch.exp(prediction.detach()), tta)
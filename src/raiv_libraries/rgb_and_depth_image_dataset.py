@@ -2,21 +2,40 @@ from PIL import Image
 import torch
 from torch.utils.data import Dataset
 import pathlib
+import csv
 
 
 class RgbAndDepthImageDataset(Dataset):
 
-    def __init__(self, rgb_dir, depth_dir):
+    def __init__(self, rgb_dir, depth_dir, depth_channels=3):
+        """ depth_channels : 3 to have RGB depth images (like the RGB images), 1 to have grayscale depth images """
+        self.depth_channels = depth_channels
         rgb_dir = pathlib.Path(rgb_dir)
-        rgb_fail = sorted(list((rgb_dir / 'fail').iterdir()))
+        depth_dir = pathlib.Path(depth_dir)
+        self._set_files(sorted(list((rgb_dir / 'fail').iterdir())), sorted(list((rgb_dir / 'success').iterdir())),
+                        sorted(list((depth_dir / 'fail').iterdir())), sorted(list((depth_dir / 'success').iterdir())))
+
+    @classmethod
+    def from_manifest(cls, manifest_file, depth_channels=3):
+        """
+        Build the dataset from a manifest file (CSV with 'class', 'rgb' and 'depth' columns, see image_bank_subset.py)
+        instead of the rgb and depth folders
+        """
+        files = {'fail': ([], []), 'success': ([], [])}
+        with open(manifest_file, newline='') as f:
+            for row in csv.DictReader(f):
+                files[row['class']][0].append(pathlib.Path(row['rgb']))
+                files[row['class']][1].append(pathlib.Path(row['depth']))
+        dataset = cls.__new__(cls)
+        dataset.depth_channels = depth_channels
+        dataset._set_files(files['fail'][0], files['success'][0], files['fail'][1], files['success'][1])
+        return dataset
+
+    def _set_files(self, rgb_fail, rgb_success, depth_fail, depth_success):
         self.nb_of_fail = len(rgb_fail)
-        rgb_success = sorted(list((rgb_dir / 'success').iterdir()))
         nb_of_success = len(rgb_success)
         self.targets = [0]*self.nb_of_fail + [1]*nb_of_success # To have the same attribut that ImageFolder have
         self.rgb_files = [*rgb_fail , *rgb_success]
-        depth_dir = pathlib.Path(depth_dir)
-        depth_fail = sorted(list((depth_dir / 'fail').iterdir()))
-        depth_success = sorted(list((depth_dir / 'success').iterdir()))
         self.depth_files = [*depth_fail, *depth_success]
 
     def __len__(self):
@@ -28,7 +47,7 @@ class RgbAndDepthImageDataset(Dataset):
             idx = idx.tolist()
         image_rgb = Image.open(self.rgb_files[idx])
         image_depth = Image.open(self.depth_files[idx])
-        image_depth = image_depth.convert("RGB")  # To have a 3 channels image from a grayscale one
+        image_depth = image_depth.convert("RGB" if self.depth_channels == 3 else "L")  # 3 channels image from a grayscale one, or a 1 channel one
         class_id = 0 if idx < self.nb_of_fail else 1  # [0 : fail, 1 : success]
         return image_rgb, image_depth, class_id, [str(self.rgb_files[idx]), str(self.depth_files[idx])]
 
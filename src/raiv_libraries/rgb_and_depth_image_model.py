@@ -4,22 +4,7 @@
 # and which is located in '<ckpt_folder>/model/<model name>' like 'model/resnet50'
 # To view the logs : tensorboard --logdir=runs
 
-def train_cnn_tune(config, num_epochs=10):
-    print('train_mnist_tune')
-    # Build the model
-    # Build the model
-    model_name = 'resnet18'
-    model = RgbAndDepthCnn(config, backbone=model_name, courbe_folder=args.courbe_path)
-    # Build the dataset and the DataModule
-    dataset = RgbAndDepthImageDataset(args.images_rgb_and_depth_folder+'/rgb', args.images_rgb_and_depth_folder+'/depth')
-    data_module = ImageDataModule(dataset, RgbAndDepthSubset, dataset_size=args.dataset_size, batch_size=config["batch_size"])
-    # Build the trainer
-    trainer = model.build_trainer(data_module=data_module, model_name=model_name, ckpt_dir=args.ckpt_folder, num_epochs=num_epochs, suffix=args.suffix_name,
-                                  dataset_size=args.dataset_size)
-    # Now, we can train the model ################################################
-    trainer.fit(model=model, datamodule=data_module)
-
-def tune_cnn(num_samples=10, num_epochs=10, gpus_per_trial=0):
+def tune_cnn(num_samples=10, num_epochs=10, cpus_per_trial=4, scheduler='asha', model_kwargs=None):
     # config = {
     #     "layer_1_size": tune.grid_search([ 128, 256, 512]),
     #     "layer_2_size": tune.grid_search([16, 32, 64]),
@@ -33,50 +18,51 @@ def tune_cnn(num_samples=10, num_epochs=10, gpus_per_trial=0):
         "learning_rate": tune.choice([1e-3, 1e-2, 1e-1]),
         "batch_size": tune.choice([8, 16]),
     }
-    trainable = tune.with_parameters(
-        train_cnn_tune, num_epochs=num_epochs
-    )
-    tuner = tune.Tuner(
-        tune.with_resources(trainable, resources={"cpu": 4, "gpu": gpus_per_trial}),
-        tune_config=tune.TuneConfig(
-            metric="loss",
-            mode="min",
-            num_samples=num_samples,
-        ),
-        run_config=air.RunConfig(
-            #log_to_file="std_combined.log",
-            local_dir="./ray_tune_results",
-            name="tune_rgb_image_model",
-        ),
-        param_space=config,
-    )
-    results = tuner.fit()
-
-    print("Best hyperparameters found were: ", results.get_best_result().config)
+    cnn_tuning.tune_cnn(RgbAndDepthCnn, args.images_rgb_and_depth_folder, args.ckpt_folder, config, rgb_and_depth=True,
+                        num_samples=num_samples, num_epochs=num_epochs, dataset_size=args.dataset_size,
+                        suffix=args.suffix_name, cpus_per_trial=cpus_per_trial, scheduler=scheduler, name="tune_rgb_image_model",
+                        model_kwargs=model_kwargs)
 
 # --- MAIN ----
 if __name__ == '__main__':
-    from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn
+    from raiv_libraries.cnn import Cnn
+    from raiv_libraries.rgb_and_depth_cnn import RgbAndDepthCnn, ARCHITECTURES
     from raiv_libraries.image_data_module import ImageDataModule, RgbAndDepthSubset
     from raiv_libraries.rgb_and_depth_image_dataset import RgbAndDepthImageDataset
-    from ray import air, tune
+    from raiv_libraries import cnn_tuning
+    from raiv_libraries.image_tools import ImageTools
+    from ray import tune
     import argparse
     import time
 
     parser = argparse.ArgumentParser(description='Train a Cnn with RGB and depth images from specified images folder. View results with : tensorboard --logdir=runs')
     parser.add_argument('images_rgb_and_depth_folder', type=str, help='RGB and DEPTH images folder with <rgb and depth> / <fail and success> sub-folders')
     parser.add_argument('ckpt_folder', type=str, help='folder path where to stock the model.CKPT file generated')
-    parser.add_argument('-c', '--courbe_path', default=None, type=str, help='Optionnal path folder .txt where the informations of the model will be stocked for courbes_CNN.py')
+    parser.add_argument('-c', '--courbe_path', default=None, type=str, help='Optionnal metrics folder where the curves of the training (loss, accuracy, F1 score) are stored for courbes_CNN.py')
     parser.add_argument('-s', '--suffix_name', default='', type=str, help='Optionnal suffix to add to the model name')
     parser.add_argument('-e', '--epochs', default=15, type=int, help='Optionnal number of epochs')
     parser.add_argument('-d', '--dataset_size', default=None, type=int, help='Optionnal number of images for the dataset size')
+    parser.add_argument('-p', '--profile_step', default=None, type=int, help='Optionnal training step where a torch.profiler window is recorded')
+    parser.add_argument('--precision', default='32', choices=['32', 'bf16'], help='FP32 or bfloat16 autocast training')
+    parser.add_argument('--channels_last', default=False, action='store_true', help='use the channels-last memory format for the images and the backbone(s)')
+    parser.add_argument('--depth_channels', default=1, type=int, choices=[1, 3], help='1 : grayscale depth images and 1 channel first convolution, 3 : depth images converted in RGB')
+    parser.add_argument('--architecture', default='shared', choices=ARCHITECTURES, help='shared : one backbone for the RGB and the depth images, dual : one backbone for each')
+    parser.add_argument('--concurrent_backbones', default=False, action='store_true', help='dual architecture : run the depth backbone in another thread while the RGB one runs')
+    parser.add_argument('--small_input', default=False, action='store_true', help='train a model for small images (ImageTools.SMALL_IMAGE_SIZE_FOR_NN pixels) with no stride in the first convolution')
     parser.add_argument('--tune', default=False, action='store_true', help='Tune the hyperparameters')
     parser.add_argument('--no-tune', dest='tune', action='store_false')
+    parser.add_argument('--cpus_per_trial', default=4, type=int, help='number of CPUs of each tuning trial (torch threads + dataloader workers)')
+    parser.add_argument('--scheduler', default='asha', choices=cnn_tuning.SCHEDULERS, help='Ray Tune trial scheduler (asha and hyperband stop the bad trials early)')
     args = parser.parse_args()
+    if args.concurrent_backbones and args.architecture != 'dual':
+        parser.error('--concurrent_backbones needs --architecture dual')
+    model_kwargs = {'depth_channels': args.depth_channels, 'architecture': args.architecture, 'concurrent_backbones': args.concurrent_backbones}
+    if args.small_input:
+        model_kwargs.update(small_input=True, input_shape=[3, ImageTools.SMALL_IMAGE_SIZE_FOR_NN, ImageTools.SMALL_IMAGE_SIZE_FOR_NN])
 
     if args.tune:
         print('Hyperparameter tuning.')
-        tune_cnn(num_samples=20, num_epochs=args.epochs, gpus_per_trial=0.25)
+        tune_cnn(num_samples=20, num_epochs=args.epochs, cpus_per_trial=args.cpus_per_trial, scheduler=args.scheduler, model_kwargs=model_kwargs)
     else:
         config = {
             "layer_1_size": 256,
@@ -86,12 +72,15 @@ if __name__ == '__main__':
         }
         # Build the model
         model_name = 'resnet18'
-        model = RgbAndDepthCnn(config, backbone=model_name, courbe_folder=args.courbe_path)
+        model = RgbAndDepthCnn(config, backbone=model_name, courbe_folder=args.courbe_path, channels_last=args.channels_last, **model_kwargs)
         # Build the dataset and the DataModule
-        dataset = RgbAndDepthImageDataset(args.images_rgb_and_depth_folder+'/rgb', args.images_rgb_and_depth_folder+'/depth')
-        data_module = ImageDataModule(dataset, RgbAndDepthSubset, dataset_size=args.dataset_size, batch_size=config["batch_size"])
+        dataset = RgbAndDepthImageDataset(args.images_rgb_and_depth_folder+'/rgb', args.images_rgb_and_depth_folder+'/depth', depth_channels=args.depth_channels)
+        data_module = ImageDataModule(dataset, RgbAndDepthSubset, dataset_size=args.dataset_size, batch_size=config["batch_size"],
+                                      transform=Cnn.transforms(model)[1],
+                                      depth_transform=Cnn.transforms(model, depth=True)[1] if args.depth_channels == 1 else None)
         # Build the trainer
-        trainer = model.build_trainer(data_module=data_module, model_name=model_name, ckpt_dir=args.ckpt_folder, num_epochs=args.epochs, suffix=args.suffix_name, dataset_size=args.dataset_size)
+        trainer = model.build_trainer(data_module=data_module, model_name=model_name, ckpt_dir=args.ckpt_folder, num_epochs=args.epochs, suffix=args.suffix_name, dataset_size=args.dataset_size, profile_step=args.profile_step,
+                                      precision=args.precision if args.precision == 'bf16' else 32)
         # Now, we can train the model ################################################
         start_fit = time.time()
         trainer.fit(model=model, datamodule=data_module)
@@ -15,20 +15,10 @@ class RgbCnn(Cnn):
         """ Define model layers """
         # Load pre-trained network: choose the model for the pretrained network
         model_func = getattr(models, self.hparams.backbone)
-        backbone = model_func(weights="DEFAULT")
         # Feature extractor
-        _layers = list(backbone.children())[:-1]
-        self.feature_extractor = torch.nn.Sequential(*_layers)
-        # classes are two: success or failure
-        num_target_classes = 2
-        n_sizes = self.get_cumulative_output_conv_layers_size([self.feature_extractor])
-        # Classifier
-        layer_1_size = self.hparams.config['layer_1_size']
-        layer_2_size = self.hparams.config['layer_2_size']
-        _fc_layers = [torch.nn.Linear(n_sizes, layer_1_size),
-                      torch.nn.Linear(layer_1_size, layer_2_size),
-                      torch.nn.Linear(layer_2_size, num_target_classes)]
-        self.fc = torch.nn.Sequential(*_fc_layers)
+        self.feature_extractor, n_sizes = self.build_feature_extractor(model_func)
+        # Classifier (classes are two: success or failure)
+        self.fc = self.build_classifier(n_sizes)
 
     def forward(self, t):
         """Forward pass. Returns logits."""
@@ -48,19 +38,17 @@ class RgbCnn(Cnn):
 
     @staticmethod
     @torch.no_grad()
-    def predict_from_pil_rgb_image(model, pil_rgb_img):
-        image_tensor = ImageTools.image_preprocessing(pil_rgb_img)
-        features, prediction = model(image_tensor)
+    def predict_from_pil_rgb_image(model, pil_rgb_img, tta=1):
+        """ tta : number of test time augmentation variants (see cnn.TTA_VARIANTS), their probabilities are averaged """
+        image_tensor = ImageTools.image_preprocessing(pil_rgb_img, Cnn.transforms(model)[0])
+        features, prediction = model(Cnn.tta_batch(image_tensor, tta))
         prediction = prediction.detach()
-        return torch.exp(prediction)
+        return Cnn.tta_mean(torch.exp(prediction), tta)
 
     @staticmethod
-    def load_ckpt_model_file(ckpt_model_filename):
-        """
-        Load the model named 'ckpt_model_filename' and freeze it
-        :param name: name of the model
-        :return: the model freezed to be used for inference
-        """
-        model = RgbCnn.load_from_checkpoint(ckpt_model_filename)
-        model.freeze()
-        return model
+    @torch.no_grad()
+    def predict_from_pil_rgb_images(model, pil_rgb_imgs, tta=1):
+        """ Same as predict_from_pil_rgb_image() for a list of images, processed in one batch (with all their TTA variants) """
+        images_tensor = ImageTools.images_preprocessing(pil_rgb_imgs, Cnn.transforms(model)[0])
+        features, prediction = model(Cnn.tta_batch(images_tensor, tta))
+        return Cnn.tta_mean(torch.exp(prediction.detach()), tta)
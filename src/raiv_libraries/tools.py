@@ -1,7 +1,5 @@
 from pathlib import Path
 from datetime import datetime
-import cv2
-import numpy as np
 from cv_bridge import CvBridge
 from raiv_libraries.image_tools import ImageTools
 from raiv_libraries.robotUR import RobotUR
@@ -49,18 +47,7 @@ def generate_and_save_rgb_depth_images(resp_pick, parent_image_folder, is_object
 
     depth_crop_cv = bridge.imgmsg_to_cv2(resp_pick.depth_crop, desired_encoding='passthrough')
 
-    # Calculate the histogram of the depth image
-    histogram = cv2.calcHist([depth_crop_cv], [0], None, [1000], [1, 1000])
-    # Take the index with the maximum values (i.e. the value of the table's distance to the camera) e
-    # Every pixel with a value under the table value +BOX_ELEVATION milimeters is set to zero.
-    distance_camera_to_table = histogram.argmax()
-    image_depth_without_table = np.where(depth_crop_cv == 0, distance_camera_to_table, depth_crop_cv)
-    alt_pt_plus_haut = np.min(image_depth_without_table)
-    image_depth_without_table = np.where(image_depth_without_table >= distance_camera_to_table - THRESHOLD_ABOVE_TABLE, distance_camera_to_table,
-                                         image_depth_without_table)
-
-    cv2.normalize(image_depth_without_table, image_depth_without_table, 0, 255, cv2.NORM_MINMAX)
-    image_depth_without_table = np.round(image_depth_without_table).astype(np.uint8)
+    image_depth_without_table = ImageTools.normalize_depth_crop(depth_crop_cv, THRESHOLD_ABOVE_TABLE)
     pil_depth = ImageTools.numpy_to_pil(image_depth_without_table)
 
     # Generate a set of images with rotation transform
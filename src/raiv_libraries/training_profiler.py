@@ -0,0 +1,105 @@
+import time
+import resource
+from pathlib import Path
+import torch
+import pytorch_lightning as pl
+
+# Callback used by Cnn.build_trainer to know where the time of a training goes :
+# * data wait time : time spent waiting for the next batch (PNG decoding, transforms, collate)
+# * compute time : forward, backward and optimizer step
+# * samples/s and peak RSS (resident memory) of the training process
+# Results are logged in TensorBoard (Throughput/...) and, if courbe_folder is given, in <courbe_folder>/train/throughput.txt
+# A torch.profiler window of a few steps can be recorded from a chosen step, the trace is saved in the logger folder.
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process in MB (ru_maxrss is in KB on Linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ThroughputProfiler(pl.Callback):
+
+    def __init__(self, courbe_folder=None, profile_step=None, profile_nb_steps=5, log_every_n_steps=10):
+        """
+        profile_step : optional global step where a torch.profiler window starts
+        profile_nb_steps : number of steps recorded by the profiler
+        """
+        super().__init__()
+        self.courbe_folder = courbe_folder
+        self.profile_step = profile_step
+        self.profile_nb_steps = profile_nb_steps
+        self.log_every_n_steps = log_every_n_steps
+        self._profiler = None
+        self._throughput_file = None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._data_wait = self._compute = 0.0
+        self._nb_samples = 0
+        self._epoch_start = self._last_batch_end = time.perf_counter()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        self._batch_start = time.perf_counter()
+        self._step_data_wait = self._batch_start - self._last_batch_end  # The batch has just been loaded
+        if self.profile_step is not None and trainer.global_step == self.profile_step and self._profiler is None:
+            self._profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                    record_shapes=True, profile_memory=True)
+            self._profiler.start()
+            self._profiled_steps = 0
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        now = time.perf_counter()
+        step_compute = now - self._batch_start
+        batch_size = next(t for t in batch if torch.is_tensor(t)).shape[0]
+        self._data_wait += self._step_data_wait
+        self._compute += step_compute
+        self._nb_samples += batch_size
+        if trainer.global_step % self.log_every_n_steps == 0:
+            tb = pl_module.logger.experiment
+            tb.add_scalar('Throughput/step_data_wait_ms', self._step_data_wait * 1000, trainer.global_step)
+            tb.add_scalar('Throughput/step_compute_ms', step_compute * 1000, trainer.global_step)
+        if self._profiler is not None and self._profiled_steps >= 0:
+            self._profiler.step()
+            self._profiled_steps += 1
+            if self._profiled_steps == self.profile_nb_steps:
+                self._stop_profiler(trainer)
+        self._last_batch_end = time.perf_counter()
+
+    def _stop_profiler(self, trainer):
+        self._profiler.stop()
+        self._profiled_steps = -1  # Only one profiler window
+        log_dir = Path(trainer.logger.log_dir if trainer.logger else '.')
+        log_dir.mkdir(parents=True, exist_ok=True)
+        trace_file = log_dir / f'profiler_trace_step_{self.profile_step}.json'
+        self._profiler.export_chrome_trace(str(trace_file))
+        with open(log_dir / f'profiler_step_{self.profile_step}.txt', 'w') as f:
+            f.write(self._profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=30))
+        print(f'Profiler trace saved in {trace_file}')
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        # In Lightning 1.x this hook runs after the validation loop of the epoch : the training ends at the last batch
+        epoch_duration = self._last_batch_end - self._epoch_start
+        samples_per_s = self._nb_samples / epoch_duration if epoch_duration > 0 else 0.0
+        data_wait_ratio = self._data_wait / max(self._data_wait + self._compute, 1e-9)
+        rss = peak_rss_mb()
+        tb = pl_module.logger.experiment
+        epoch = pl_module.current_epoch
+        tb.add_scalar('Throughput/data_wait_s', self._data_wait, epoch)
+        tb.add_scalar('Throughput/compute_s', self._compute, epoch)
+        tb.add_scalar('Throughput/data_wait_ratio', data_wait_ratio, epoch)
+        tb.add_scalar('Throughput/samples_per_s', samples_per_s, epoch)
+        tb.add_scalar('Throughput/peak_rss_mb', rss, epoch)
+        print(f'Epoch {epoch} : {samples_per_s:.1f} samples/s, data wait {self._data_wait:.1f} s ({data_wait_ratio:.0%}), compute {self._compute:.1f} s, peak RSS {rss:.0f} MB')
+        if self.courbe_folder:
+            if self._throughput_file is None:
+                Path(self.courbe_folder, 'train').mkdir(parents=True, exist_ok=True)
+                self._throughput_file = open(self.courbe_folder + '/train/throughput.txt', 'w')
+                self._throughput_file.write('epoch;data_wait_s;compute_s;samples_per_s;peak_rss_mb')
+            self._throughput_file.write(f'\n{epoch};{self._data_wait};{self._compute};{samples_per_s};{rss}')
+            self._throughput_file.flush()
+
+    def on_train_end(self, trainer, pl_module):
+        if self._profiler is not None and self._profiled_steps > 0:  # Training ended during the profiler window
+            self._stop_profiler(trainer)
+        if self._throughput_file is not None:
+            self._throughput_file.close()
+            self._throughput_file = None